@@ -162,6 +162,8 @@ optimizer=dict(type='SGD', lr=0.0025, momentum=0.9, weight_decay=0.0001)
 optimizer_config=dict(grad_clip=dict(max_norm=35, norm_type=2))
 ckpt_config=dict(interval=2)
 report_config=dict(interval=50)
+# run per-image work of heads, e.g. targets and prediction, in a pool on CPU
+#multi_apply=dict(backend='thread', num_workers=4, intra_op_threads=1)
 
 img_norm = dict(
     mean=[123.675, 116.28, 103.53], std=[58.395, 57.12, 57.375], to_rgb=True)
@@ -40,6 +40,9 @@ train_cfg = dict(
     ),
 
     allowed_border=-1,
+    # assign anchors of an image once and reuse them in later epochs, cache_dir keeps them on disk
+    # instead of in memory, where at most max_bytes of them are kept
+    #assign_cache=dict(cache_dir=None),
     total_epochs=14,
     log_file='train.log',
     log_level='DEBUG'
@@ -65,6 +68,7 @@ optimizer_config=dict(grad_clip=dict(max_norm=35, norm_type=2))
 #optimizer_config=dict(grad_clip=None)
 
 ckpt_config=dict(interval=2)
+#eval_config=dict(interval=2, num_imgs=500)
 
 img_norm = dict(
     mean=[123.675, 116.28, 103.53], std=[58.395, 57.12, 57.375], to_rgb=True)
@@ -98,6 +102,8 @@ data = dict(
         img_prefix=TRAIN_IMGS,
         pipeline=train_pipeline,
         loader=dict(batch_size=1, num_workers=4, shuffle=True),
+        # compute dense head targets in dataloader workers
+        #loader=dict(batch_size=1, num_workers=4, shuffle=True, dense_targets=True),
     ),
     test=dict(
         imgs_per_gpu=2,
@@ -9,13 +9,18 @@ import numpy as np
 # If gt_label is not None, the returned tar_labels contains 0 and positive specific labels of assigned gt.
 # Since 0 is reserved as negative(background), gt labels can't contain 0.
 def anchor_target(cls_out, reg_out, cls_channels, in_anchors, in_mask, gt_bbox, gt_label=None,
-                  assigner=None, sampler=None, target_means=None, target_stds=None):
+                  assigner=None, sampler=None, target_means=None, target_stds=None,
+                  assign_cache=None, cache_key=None, assigned_labels=None):
     '''
     Args:
         cls_out: [1, n], class predict of all anchors
         reg_out: [4, n], bbox predict of all anchors
         in_anchors: [4, m], anchors that are considered, m <= n
         in_mask: [1, n], mask of considered anchors, it has m 0's and (n-m) 1's
+        assign_cache: AssignCache, labels before sampling are taken from it under cache_key if
+                      they were computed before, sampling still runs every time
+        assigned_labels: [m], labels before sampling if they are computed already, e.g. in
+                         dataloader workers
     '''
     assert assigner is not None
     from .builder import build_module
@@ -23,7 +28,17 @@ def anchor_target(cls_out, reg_out, cls_channels, in_anchors, in_mask, gt_bbox,
     if isinstance(assigner, dict):
         assigner = build_module(assigner)
 
-    labels, overlap_ious = assigner(in_anchors, gt_bbox)
+    labels, overlap_ious = None, None
+    if assigned_labels is not None:
+        assert assigned_labels.numel() == in_anchors.shape[1]
+        # sampler changes labels in place
+        labels = assigned_labels.long().clone()
+    elif assign_cache is not None:
+        labels = assign_cache.get(cache_key, gt_bbox)
+    if labels is None:
+        labels, overlap_ious = assigner(in_anchors, gt_bbox)
+        if assign_cache is not None:
+            assign_cache.put(cache_key, gt_bbox, labels)
     logging.debug('labels before sample(-1, 0, >0): {}, {}, {}'\
                   .format((labels==-1).sum(), (labels==0).sum(), (labels>0).sum()))
     if sampler is not None:
@@ -36,7 +51,7 @@ def anchor_target(cls_out, reg_out, cls_channels, in_anchors, in_mask, gt_bbox,
     non_neg_places = (~neg_places)
     num_pos_places = pos_places.sum()
     logging.debug('average overlap iou after  sampling: {} with {} pos anchors'\
-                  .format(None if num_pos_places==0 else \
+                  .format(None if num_pos_places==0 or overlap_ious is None else \
                           overlap_ious[pos_places].sum()/num_pos_places, num_pos_places))
 
     # labels_ contains only -1, 0, 1
@@ -0,0 +1,183 @@
+import numpy as np
+import zipfile, struct, json, logging
+
+'''
+A compact binary index of COCO style annotations.
+
+All annotations are kept in a few contiguous numpy arrays and written into one uncompressed
+.npz file. Since members of an uncompressed .npz are stored as raw .npy blobs, they can be
+memory mapped directly, which makes loading close to free and lets dataloader workers share
+the same pages instead of each holding its own copy of the parsed json.
+
+Layout (n images, m annotations, k categories):
+    img_ids          [n]     int64
+    img_widths       [n]     int32
+    img_heights      [n]     int32
+    img_file_names   [n]     bytes
+    img_ann_offsets  [n+1]   int64, annotations of image i are [offsets[i], offsets[i+1])
+    ann_ids          [m]     int64
+    ann_bboxes       [m, 4]  float32, in xywh order as in COCO
+    ann_areas        [m]     float32
+    ann_cat_ids      [m]     int32
+    ann_iscrowd      [m]     uint8
+    ann_ignore       [m]     uint8
+    cat_ids          [k]     int32
+    cat_names        [k]     bytes
+'''
+
+INDEX_KEYS = ('img_ids', 'img_widths', 'img_heights', 'img_file_names', 'img_ann_offsets',
+              'ann_ids', 'ann_bboxes', 'ann_areas', 'ann_cat_ids', 'ann_iscrowd', 'ann_ignore',
+              'cat_ids', 'cat_names')
+
+ZIP_LOCAL_HEADER_SIZE = 30
+
+
+def build_ann_index(ann_file, out_file):
+    '''
+    Convert a COCO style json annotation file into a binary index.
+    Images keep the order of the json file, annotations are grouped by image.
+    '''
+    coco_json = json.load(open(ann_file))
+    images = coco_json['images']
+    annos = coco_json.get('annotations', [])
+    cats = coco_json['categories']
+
+    img_ids = np.array([img['id'] for img in images], dtype=np.int64)
+    img_pos = {iid: i for i, iid in enumerate(img_ids.tolist())}
+    anno_img_pos = np.array([img_pos[anno['image_id']] for anno in annos], dtype=np.int64)
+    # stable sort keeps the original order of annotations inside an image
+    order = np.argsort(anno_img_pos, kind='stable')
+    annos = [annos[i] for i in order]
+    counts = np.bincount(anno_img_pos, minlength=len(images))
+    offsets = np.zeros(len(images)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    index = {
+        'img_ids': img_ids,
+        'img_widths': np.array([img['width'] for img in images], dtype=np.int32),
+        'img_heights': np.array([img['height'] for img in images], dtype=np.int32),
+        'img_file_names': np.array([img['file_name'].encode() for img in images], dtype=np.bytes_),
+        'img_ann_offsets': offsets,
+        'ann_ids': np.array([anno['id'] for anno in annos], dtype=np.int64),
+        'ann_bboxes': np.array([anno['bbox'] for anno in annos], dtype=np.float32).reshape(-1, 4),
+        'ann_areas': np.array([anno['area'] for anno in annos], dtype=np.float32),
+        'ann_cat_ids': np.array([anno['category_id'] for anno in annos], dtype=np.int32),
+        'ann_iscrowd': np.array([anno.get('iscrowd', 0) for anno in annos], dtype=np.uint8),
+        'ann_ignore': np.array([anno.get('ignore', 0) for anno in annos], dtype=np.uint8),
+        'cat_ids': np.array([cat['id'] for cat in cats], dtype=np.int32),
+        'cat_names': np.array([cat['name'].encode() for cat in cats], dtype=np.bytes_)
+    }
+    # np.savez does not compress, which is required for memory mapping
+    np.savez(out_file, **index)
+    logging.info('Built annotation index with {} images and {} annotations: {}'.format(
+        len(images), len(annos), out_file))
+    return out_file
+
+
+def _memmap_npz_member(npz_file, info):
+    with open(npz_file, 'rb') as f:
+        f.seek(info.header_offset)
+        local_header = f.read(ZIP_LOCAL_HEADER_SIZE)
+        name_len, extra_len = struct.unpack('<HH', local_header[26:30])
+        f.seek(info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if int(np.prod(shape)) == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(npz_file, dtype=dtype, mode='r', offset=offset, shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+def load_npz_mmap(npz_file):
+    '''
+    Load every array of an .npz file, memory mapped when the member is stored uncompressed.
+    '''
+    arrays = {}
+    with zipfile.ZipFile(npz_file) as zf:
+        infos = zf.infolist()
+    stored = all(info.compress_type == zipfile.ZIP_STORED for info in infos)
+    if not stored:
+        logging.warning('{} is compressed, can not memory map it'.format(npz_file))
+        with np.load(npz_file) as npz:
+            return {k: npz[k] for k in npz.files}
+    for info in infos:
+        name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+        arrays[name] = _memmap_npz_member(npz_file, info)
+    return arrays
+
+
+class AnnIndex(object):
+    def __init__(self, index_file):
+        self.index_file = index_file
+        arrays = load_npz_mmap(index_file)
+        for k in INDEX_KEYS:
+            assert k in arrays, 'Annotation index {} misses array {}'.format(index_file, k)
+            setattr(self, k, arrays[k])
+        # for looking up position of an image by its id without a python dict
+        self._id_order = np.argsort(self.img_ids, kind='stable')
+        logging.info('Loaded annotation index {}: {} images, {} annotations'.format(
+            index_file, self.num_images, self.num_annos))
+
+    @property
+    def num_images(self):
+        return len(self.img_ids)
+
+    @property
+    def num_annos(self):
+        return len(self.ann_ids)
+
+    def ann_counts(self):
+        return np.diff(self.img_ann_offsets)
+
+    def img_pos(self, img_id):
+        i = np.searchsorted(self.img_ids, img_id, sorter=self._id_order)
+        assert i < self.num_images and self.img_ids[self._id_order[i]] == img_id, \
+            'Image id {} is not in annotation index'.format(img_id)
+        return int(self._id_order[i])
+
+    # the same img_info dicts as mmdet's CocoDataset
+    def img_infos(self):
+        file_names = [x.decode() for x in self.img_file_names.tolist()]
+        return [{'id': iid, 'file_name': fn, 'filename': fn, 'width': w, 'height': h}
+                for iid, fn, w, h in zip(self.img_ids.tolist(), file_names,
+                                         self.img_widths.tolist(), self.img_heights.tolist())]
+
+    # return views of the annotations of one image
+    def anns_of(self, img_id):
+        i = self.img_pos(img_id)
+        s, e = self.img_ann_offsets[i], self.img_ann_offsets[i+1]
+        return {
+            'bboxes': self.ann_bboxes[s:e],
+            'areas': self.ann_areas[s:e],
+            'cat_ids': self.ann_cat_ids[s:e],
+            'iscrowd': self.ann_iscrowd[s:e],
+            'ignore': self.ann_ignore[s:e]}
+
+    def to_coco(self):
+        '''
+        Build a pycocotools COCO object from the index, which skips parsing the json.
+        '''
+        from pycocotools.coco import COCO
+        img_pos = np.repeat(np.arange(self.num_images), self.ann_counts())
+        img_ids = self.img_ids[img_pos].tolist()
+        file_names = [x.decode() for x in self.img_file_names.tolist()]
+        dataset = {
+            'images': [{'id': iid, 'file_name': fn, 'width': w, 'height': h}
+                       for iid, fn, w, h in zip(self.img_ids.tolist(), file_names,
+                                                self.img_widths.tolist(), self.img_heights.tolist())],
+            'annotations': [{'id': aid, 'image_id': iid, 'bbox': bbox, 'area': area,
+                             'category_id': cid, 'iscrowd': crowd, 'ignore': ign}
+                            for aid, iid, bbox, area, cid, crowd, ign in zip(
+                                    self.ann_ids.tolist(), img_ids, self.ann_bboxes.tolist(),
+                                    self.ann_areas.tolist(), self.ann_cat_ids.tolist(),
+                                    self.ann_iscrowd.tolist(), self.ann_ignore.tolist())],
+            'categories': [{'id': cid, 'name': name.decode()}
+                           for cid, name in zip(self.cat_ids.tolist(), self.cat_names.tolist())]}
+        coco = COCO()
+        coco.dataset = dataset
+        coco.createIndex()
+        return coco
@@ -0,0 +1,102 @@
+import numpy as np
+import os.path as osp
+import os, json, hashlib, torch
+from collections import OrderedDict
+
+'''
+A cache of anchor assignment results across epochs. With MaxIoUAssigner, labels of anchors
+before sampling only depend on gt bboxes, the image(its size, flip and scale) and the anchor
+grid, not on network outputs, so they are computed once and only sampling runs every iteration.
+
+An entry is keyed by the hash of: image file name, flip, scale factor, image shape, grid sizes
+of all levels and the anchor config(anchor settings of the head, assigner and allowed_border).
+It stores the labels of in-image anchors(-1 ignore, 0 negative, i>0 matched to gt i-1) sparsely:
+the number of anchors, indices of ignored and positive anchors as int32 and their labels as int16,
+along with the gt bboxes they were computed from. An entry whose gt bboxes differ, e.g. from random
+crops, is computed again and replaced.
+
+Without cache_dir, entries are kept in memory up to max_bytes, the least recently used ones are
+dropped beyond it. With cache_dir, entries are only kept on disk as <key>.npz, so that memory
+does not grow with the dataset, and later runs and other processes on the same machine can read
+them.
+'''
+
+
+def assign_key(img_meta, grid_sizes, anchor_cfg):
+    parts = {'filename': img_meta['filename'], 'flip': img_meta.get('flip', False),
+             'scale_factor': img_meta.get('scale_factor'), 'img_shape': img_meta['img_shape'][:2],
+             'grid_sizes': [tuple(grid) for grid in grid_sizes], 'anchor_cfg': anchor_cfg}
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def entry_bytes(entry):
+    return sum(x.nbytes for x in entry)
+
+
+class AssignCache(object):
+    def __init__(self, cache_dir=None, max_bytes=512*1024*1024):
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits, self.misses = 0, 0
+
+    # entries in memory
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self, key):
+        if self.cache_dir is not None:
+            filename = osp.join(self.cache_dir, key + '.npz')
+            if not osp.exists(filename):
+                return None
+            with np.load(filename) as data:
+                if 'index' not in data:
+                    return None
+                return data['num'], data['index'], data['value'], data['gt_bbox']
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def get(self, key, gt_bbox):
+        '''
+        Labels before sampling as a new long tensor on the device of gt_bbox, None if not cached.
+        '''
+        entry = self.load(key)
+        gt = gt_bbox.detach().cpu().float().numpy()
+        if entry is None or entry[3].shape != gt.shape or not (entry[3] == gt).all():
+            self.misses += 1
+            return None
+        self.hits += 1
+        labels = np.zeros(int(entry[0]), dtype=np.int64)
+        labels[entry[1]] = entry[2]
+        return torch.from_numpy(labels).to(gt_bbox.device)
+
+    def put(self, key, gt_bbox, labels):
+        assert gt_bbox.shape[1] < np.iinfo(np.int16).max
+        labels = labels.cpu()
+        # most anchors are negative, keep the others only
+        index = torch.nonzero(labels != 0).view(-1)
+        entry = (np.array(labels.numel(), dtype=np.int64), index.numpy().astype(np.int32),
+                 labels[index].numpy().astype(np.int16), gt_bbox.detach().cpu().float().numpy())
+        if self.cache_dir is not None:
+            # write then rename, so that readers never see a partial file
+            filename = osp.join(self.cache_dir, key + '.npz')
+            tmp_file = '{}.{}.tmp.npz'.format(filename[:-4], os.getpid())
+            np.savez(tmp_file, num=entry[0], index=entry[1], value=entry[2], gt_bbox=entry[3])
+            os.replace(tmp_file, filename)
+            return
+        if key in self.entries:
+            self.nbytes -= entry_bytes(self.entries.pop(key))
+        self.entries[key] = entry
+        self.nbytes += entry_bytes(entry)
+        while self.nbytes > self.max_bytes and len(self.entries) > 0:
+            self.nbytes -= entry_bytes(self.entries.popitem(last=False)[1])
+
+    def stats(self):
+        total = self.hits + self.misses
+        return 'assign cache: {} entries, {} bytes in memory, {} hits, {} misses, hit rate {:.3f}'.format(
+            len(self), self.nbytes, self.hits, self.misses, self.hits / max(total, 1))
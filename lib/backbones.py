@@ -1,9 +1,127 @@
 import torchvision as tv
 import torch.nn as nn
 import logging, torch
+from . import utils
 
 from torch.nn.modules.batchnorm import _BatchNorm
+from .builder import register_module
+
+
+class FrozenBN(nn.Module):
+    '''
+    BatchNorm with fixed statistics, computed as a single per-channel affine x*scale+shift.
+    weight and bias stay trainable if the BN they come from was trainable. It has the same
+    state_dict keys as nn.BatchNorm2d.
+    '''
+    def __init__(self, num_features, eps=1e-5):
+        super(FrozenBN, self).__init__()
+        self.num_features = num_features
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(num_features))
+        self.bias = nn.Parameter(torch.zeros(num_features))
+        self.register_buffer('running_mean', torch.zeros(num_features))
+        self.register_buffer('running_var', torch.ones(num_features))
+        self.register_buffer('num_batches_tracked', torch.tensor(0, dtype=torch.long))
+
+    @classmethod
+    def from_bn(cls, bn):
+        frozen_bn = cls(bn.num_features, bn.eps)
+        frozen_bn.load_state_dict(bn.state_dict())
+        frozen_bn.weight.requires_grad = bn.weight.requires_grad
+        frozen_bn.bias.requires_grad = bn.bias.requires_grad
+        return frozen_bn.to(bn.weight.device)
+
+    @staticmethod
+    def affine(weight, bias, running_mean, running_var, eps):
+        scale = weight * (running_var + eps).rsqrt()
+        return scale, bias - running_mean * scale
+
+    def scale_shift(self):
+        return self.affine(self.weight, self.bias, self.running_mean, self.running_var, self.eps)
 
+    def forward(self, x):
+        scale, shift = self.scale_shift()
+        return torch.addcmul(shift.view(1, -1, 1, 1), x, scale.view(1, -1, 1, 1))
+
+    def extra_repr(self):
+        return '{}, eps={}'.format(self.num_features, self.eps)
+
+
+class FoldedBN(FrozenBN):
+    '''
+    A BN that is folded into the conv before it, it does nothing in forward and only keeps
+    the BN entries so that the state_dict stays in the unfused layout.
+    '''
+    def forward(self, x):
+        return x
+
+
+def fold_bn_into_conv(parent, conv_name, bn_name):
+    '''
+    Fold a frozen BN into the frozen conv before it, both are children of parent. The conv
+    gets the folded weight and a bias, the BN is replaced by FoldedBN. state_dict of parent is
+    converted back to the unfused layout on saving, and an unfused state_dict is folded on
+    loading, so ckpts of either model load into the other.
+    '''
+    conv = getattr(parent, conv_name)
+    folded_bn = FoldedBN.from_bn(getattr(parent, bn_name))
+    setattr(parent, bn_name, folded_bn)
+    with torch.no_grad():
+        scale, shift = folded_bn.scale_shift()
+        conv.weight.mul_(scale.view(-1, 1, 1, 1))
+    conv.bias = nn.Parameter(shift.detach().clone(), requires_grad=conv.weight.requires_grad)
+
+    def affine_of(state_dict, prefix):
+        keys = [prefix + bn_name + '.' + k for k in ['weight', 'bias', 'running_mean', 'running_var']]
+        if all(k in state_dict for k in keys):
+            return FrozenBN.affine(*[state_dict[k] for k in keys], folded_bn.eps)
+        return folded_bn.scale_shift()
+
+    def unfold_hook(module, state_dict, prefix, local_metadata):
+        scale, shift = affine_of(state_dict, prefix)
+        weight_key = prefix + conv_name + '.weight'
+        state_dict[weight_key] = state_dict[weight_key] / scale.view(-1, 1, 1, 1)
+        state_dict.pop(prefix + conv_name + '.bias')
+
+    def fold_hook(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        weight_key, bias_key = prefix + conv_name + '.weight', prefix + conv_name + '.bias'
+        if weight_key not in state_dict or bias_key in state_dict:
+            return
+        scale, shift = affine_of(state_dict, prefix)
+        state_dict[weight_key] = state_dict[weight_key] * scale.view(-1, 1, 1, 1)
+        state_dict[bias_key] = shift
+
+    # hooks of parent see the entries of both conv and BN
+    parent._register_state_dict_hook(unfold_hook)
+    parent._register_load_state_dict_pre_hook(fold_hook)
+
+
+def freeze_bns(module):
+    '''
+    Replace every nn.BatchNorm2d in module. A BN right after a conv is folded into the conv if
+    both are frozen, otherwise it becomes a FrozenBN. It is only valid for BNs that are always
+    in eval mode, as it is for the backbones here. FrozenBNs whose conv has been frozen since
+    are folded as well.
+    '''
+    num_folded, num_frozen = 0, 0
+    for parent in list(module.modules()):
+        prev_name, prev = None, None
+        for name, m in list(parent.named_children()):
+            if isinstance(m, (nn.BatchNorm2d, FrozenBN)) and not isinstance(m, FoldedBN):
+                if isinstance(prev, nn.Conv2d) and prev.bias is None and \
+                   not any(p.requires_grad for p in list(prev.parameters()) + list(m.parameters())):
+                    fold_bn_into_conv(parent, prev_name, name)
+                    num_folded += 1
+                elif isinstance(m, nn.BatchNorm2d):
+                    setattr(parent, name, FrozenBN.from_bn(m))
+                    num_frozen += 1
+            prev_name, prev = name, m
+    logging.info('Folded {} BNs into convs and replaced {} BNs with FrozenBN'.format(
+        num_folded, num_frozen))
+    return module
+
+
+@register_module()
 class VGG16(nn.Module):
     def __init__(self, freeze_first_layers=True, pretrained=True):
         super(VGG16, self).__init__()
@@ -31,12 +149,14 @@ class VGG16(nn.Module):
         return x
 
 
+@register_module()
 class ResNet50(nn.Module):
     def __init__(self,
                  out_layers=(3, ),
                  frozen_stages=1,
                  bn_requires_grad=True,
-                 pretrained=True):
+                 pretrained=True,
+                 freeze_bn=False):
         super(ResNet50, self).__init__()
         self.frozen_stages = frozen_stages
         self.pretrained = pretrained
@@ -62,6 +182,11 @@ class ResNet50(nn.Module):
                     m.weight.requires_grad=False
                     m.bias.requires_grad=False
 
+        # BN statistics are never updated, see train()
+        self.freeze_bn=freeze_bn
+        if freeze_bn:
+            freeze_bns(self)
+
                     
     def init_weights(self):
         pass
@@ -99,8 +224,9 @@ class ResNet50(nn.Module):
                 outs.append(x)
         return outs
 
+@register_module()
 class ResLayerC5(nn.Module):
-    def __init__(self, bn_requires_grad=True, pretrained=True):
+    def __init__(self, bn_requires_grad=True, pretrained=True, freeze_bn=False):
         self.bn_requires_grad=bn_requires_grad
         super(ResLayerC5, self).__init__()
         res50 = tv.models.resnet50(pretrained=True)
@@ -112,6 +238,10 @@ class ResLayerC5(nn.Module):
                     m.weight.requires_grad=False
                     m.bias.requires_grad=False
 
+        self.freeze_bn=freeze_bn
+        if freeze_bn:
+            freeze_bns(self)
+
 
     def train(self, mode=True):
         super(ResLayerC5, self).train(mode)
@@ -131,7 +261,7 @@ class ResLayerC5(nn.Module):
 ###
     
 class Bottleneck(nn.Module):
-    def __init__(self, in_channels, out_channels, downsample=False):
+    def __init__(self, in_channels, out_channels, downsample=False, with_cp=False):
         super(Bottleneck, self).__init__()
         is_first = in_channels*4==out_channels
         self.in_channels=in_channels
@@ -139,6 +269,7 @@ class Bottleneck(nn.Module):
         hidden_channels=out_channels//4
         self.hidden_channels=hidden_channels
         self.do_downsample=downsample
+        self.with_cp=with_cp
         
         self.conv1 = nn.Conv2d(in_channels, hidden_channels, kernel_size=1, stride=1, bias=False)
         self.bn1 = nn.BatchNorm2d(hidden_channels)
@@ -155,7 +286,7 @@ class Bottleneck(nn.Module):
                 stride=1 if is_first else 2)
 
             
-    def forward(self, x):
+    def residual(self, x):
         out = x
         out = self.bn1(self.conv1(out))
         out = self.relu(out)
@@ -165,13 +296,18 @@ class Bottleneck(nn.Module):
 
         if self.do_downsample:
             x = self.downsample(x)
-        return self.relu(x+out)
+        return x+out
+
+    def forward(self, x):
+        # with_cp only keeps the input of the block for backward
+        out = utils.checkpoint(self.residual, x, enabled=self.with_cp)
+        return self.relu(out)
 
 
-def make_reslayer(in_channels, out_channels, num_bns):
-    bns = [Bottleneck(in_channels, out_channels, True)]
+def make_reslayer(in_channels, out_channels, num_bns, with_cp=False):
+    bns = [Bottleneck(in_channels, out_channels, True, with_cp)]
     for i in range(num_bns-1):
-        bns.append(Bottleneck(out_channels, out_channels))
+        bns.append(Bottleneck(out_channels, out_channels, with_cp=with_cp))
     return nn.Sequential(*bns)
 
 
@@ -193,14 +329,23 @@ TORCH_RESNET = {
     152: tv.models.resnet152
 }
         
+# with_cp: activation checkpointing of bottlenecks, either a bool for all stages
+#          or a list of stages, e.g. (1, 2), to only checkpoint the large early stages
+# freeze_bn: fold BNs of frozen stages into convs and turn the other BNs into FrozenBN,
+#            state_dict keeps the layout of BNs, so ckpts load either way
+@register_module()
 class ResNet(nn.Module):
-    def __init__(self, depth=50, frozen_stages=1, out_layers=(1, 2, 3, 4), pretrained=True):
+    def __init__(self, depth=50, frozen_stages=1, out_layers=(1, 2, 3, 4), pretrained=True,
+                 with_cp=False, freeze_bn=False):
         super(ResNet, self).__init__()
         self.pretrained = pretrained
         self.depth = depth
         assert depth in RES_CONV_CFG
         self.frozen_stages = frozen_stages
         self.out_layers = out_layers
+        if isinstance(with_cp, bool):
+            with_cp = (1, 2, 3, 4) if with_cp else ()
+        self.with_cp = tuple(with_cp)
         conv_cfg = RES_CONV_CFG[depth]
         self.conv_cfg = conv_cfg
         self.conv1 = nn.Conv2d(3, 64, kernel_size=7, stride=2, padding=3, bias=False)
@@ -209,7 +354,13 @@ class ResNet(nn.Module):
         self.maxpool = nn.MaxPool2d(kernel_size=3, stride=2, padding=1, dilation=1, ceil_mode=False)
         for i in range(4):
             setattr(self, 'layer{}'.format(i+1),
-                    make_reslayer(RES_CHANNELS[i], RES_CHANNELS[i+1], conv_cfg[i]))
+                    make_reslayer(RES_CHANNELS[i], RES_CHANNELS[i+1], conv_cfg[i],
+                                  with_cp=(i+1) in self.with_cp))
+        self.freeze_bn = freeze_bn
+        if freeze_bn:
+            # which convs can take BNs in depends on frozen stages
+            self.freeze_stages(frozen_stages)
+            freeze_bns(self)
 
     def forward(self, x):
         out = x
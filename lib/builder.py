@@ -1,38 +1,109 @@
-from .backbones import ResNet50, VGG16, ResLayerC5, ResNet
-from .region import MaxIoUAssigner, RandomSampler, SingleRoIExtractor, BasicRoIExtractor, IoUBalancedNegSampler, \
-    ScalableRoIPool, ScalableRoIAlign
-from .necks import FPN, BFP
-from .losses import FocalLoss, SmoothL1Loss, CrossEntropyLoss, BalancedL1Loss, BoundedIoULoss, GIoULoss, IoULoss, DistributionFocalLoss, QualityFocalLoss
-from .detectors import RetinaNet, CascadeRCNN, FCOS
-from .heads import RetinaHead, RPNHead, RCNNHead, DoubleHead, GARPNHead, FCOSHead
-from torch.optim import SGD
-from torchvision.ops import RoIAlign, RoIPool
+import copy, importlib, logging
 
-import copy
-from .utils import sum_list
+# registered modules, name -> class
+MODULES = {}
 
+# modules that are registered by dotted path, name -> python module where it is defined.
+# Python modules are imported on the first lookup of a name, so building a model only
+# imports what its config needs, e.g. mmdet.ops is only imported for GARPNHead.
+# Relative paths are resolved against this package.
+LAZY_MODULES = {}
 
 
-_detectors_ = [RetinaNet, CascadeRCNN, FCOS]
-_backbones_ = [ResNet50, VGG16, ResLayerC5, ResNet]
-_necks_ = [FPN, BFP]
-_heads_ = [RetinaHead, RPNHead, RCNNHead, DoubleHead, GARPNHead, FCOSHead]
-_losses_ = [CrossEntropyLoss, SmoothL1Loss, FocalLoss, BalancedL1Loss, BoundedIoULoss, GIoULoss,
-            IoULoss, DistributionFocalLoss, QualityFocalLoss]
-_roi_extractors_ = [SingleRoIExtractor, BasicRoIExtractor, RoIAlign, RoIPool, ScalableRoIPool, ScalableRoIAlign]
-_optimizers_ = [SGD]
-_bbox_utils_ = [MaxIoUAssigner, RandomSampler, IoUBalancedNegSampler]
+def register_module(cls=None, name=None, force=False):
+    '''
+    Register a class by its name or a given name. It works as a decorator:
 
-_modules_ = sum_list([_detectors_, _backbones_, _necks_, _heads_, _losses_, _roi_extractors_, _optimizers_, _bbox_utils_])
+        @register_module()
+        class FPN(nn.Module):
+            ...
 
-MODULES = { cls.__name__:cls for cls in _modules_ }
+    or as a function: register_module(SGD)
+    '''
+    def _register(cls):
+        m_name = cls.__name__ if name is None else name
+        if not force and MODULES.get(m_name, cls) is not cls:
+            raise KeyError("'{}' is already registered by {}".format(m_name, MODULES[m_name]))
+        MODULES[m_name] = cls
+        return cls
+    if cls is not None:
+        return _register(cls)
+    return _register
+
+
+def register_lazy_module(name, path, force=False):
+    if not force and LAZY_MODULES.get(name, path) != path:
+        raise KeyError("'{}' is already registered at {}".format(name, LAZY_MODULES[name]))
+    LAZY_MODULES[name] = path
+
+
+def get_module(m_type):
+    if m_type in MODULES:
+        return MODULES[m_type]
+    if m_type not in LAZY_MODULES:
+        raise ValueError("'{}' is not registered".format(m_type))
+    path = LAZY_MODULES[m_type]
+    py_module = importlib.import_module(path, package=__package__)
+    logging.debug("Imported '{}' for '{}'".format(path, m_type))
+    if m_type not in MODULES:
+        # classes defined outside this repo are not decorated, e.g. torch.optim.SGD
+        register_module(getattr(py_module, m_type), m_type)
+    return MODULES[m_type]
+
+
+_lazy_modules_ = {
+    # detectors
+    'RetinaNet': '.detectors.retinanet',
+    'CascadeRCNN': '.detectors.cascade_rcnn',
+    'FCOS': '.detectors.fcos',
+    # backbones
+    'ResNet50': '.backbones',
+    'VGG16': '.backbones',
+    'ResLayerC5': '.backbones',
+    'ResNet': '.backbones',
+    # necks
+    'FPN': '.necks',
+    'BFP': '.necks',
+    # heads
+    'RetinaHead': '.heads.retina_head',
+    'RPNHead': '.heads.rpn_head',
+    'RCNNHead': '.heads.rcnn_head',
+    'DoubleHead': '.heads.double_head',
+    'GARPNHead': '.heads.guided_head',
+    'FCOSHead': '.heads.fcos_head',
+    # losses
+    'CrossEntropyLoss': '.losses',
+    'SmoothL1Loss': '.losses',
+    'FocalLoss': '.losses',
+    'BalancedL1Loss': '.losses',
+    'BoundedIoULoss': '.losses',
+    'GIoULoss': '.losses',
+    'IoULoss': '.losses',
+    'DIoULoss': '.losses',
+    'CIoULoss': '.losses',
+    'DistributionFocalLoss': '.losses',
+    'QualityFocalLoss': '.losses',
+    # roi extractors
+    'SingleRoIExtractor': '.region',
+    'BasicRoIExtractor': '.region',
+    'ScalableRoIPool': '.region',
+    'ScalableRoIAlign': '.region',
+    'RoIAlign': 'torchvision.ops',
+    'RoIPool': 'torchvision.ops',
+    # optimizers
+    'SGD': 'torch.optim',
+    # bbox utils
+    'MaxIoUAssigner': '.region',
+    'RandomSampler': '.region',
+    'IoUBalancedNegSampler': '.region'
+}
+
+for _name_, _path_ in _lazy_modules_.items():
+    register_lazy_module(_name_, _path_)
 
 
 def build_module(cfg, *args, **kwargs):
     cfg = copy.copy(cfg)
     assert 'type' in cfg
     m_type = cfg.pop('type')
-    if m_type not in MODULES:
-        raise ValueError("'{}' is not registered".format(m_type))
-    return MODULES[m_type](*args, **cfg, **kwargs)
-
+    return get_module(m_type)(*args, **cfg, **kwargs)
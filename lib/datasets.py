@@ -1,5 +1,7 @@
 from mmdet.datasets import CocoDataset 
 from mmdet.datasets import build_dataloader
+from .ann_index import AnnIndex
+import numpy as np
 
 VOC_CLASSES=(
     'aeroplane',
@@ -26,6 +28,56 @@ VOC_CLASSES=(
 
 
 
+# ann_file can either be a COCO style json or a binary annotation index(.npz) built by
+# scripts/build_ann_index, the latter is memory mapped and skips json parsing
 class VOCDataset(CocoDataset):
     CLASSES=VOC_CLASSES
 
+    def load_annotations(self, ann_file):
+        if not ann_file.endswith('.npz'):
+            self.ann_index = None
+            return super(VOCDataset, self).load_annotations(ann_file)
+        self.ann_index = AnnIndex(ann_file)
+        self.coco = None
+        self.cat_ids = self.ann_index.cat_ids.tolist()
+        self.cat2label = {cat_id: i + 1 for i, cat_id in enumerate(self.cat_ids)}
+        self.img_ids = self.ann_index.img_ids.tolist()
+        # lookup table from category id to label
+        self.cat2label_arr = np.zeros(max(self.cat_ids)+1, dtype=np.int64)
+        self.cat2label_arr[self.ann_index.cat_ids] = np.arange(1, len(self.cat_ids)+1)
+        return self.ann_index.img_infos()
+
+    def get_ann_info(self, idx):
+        if self.ann_index is None:
+            return super(VOCDataset, self).get_ann_info(idx)
+        img_info = self.img_infos[idx]
+        anns = self.ann_index.anns_of(img_info['id'])
+        # the same filtering as CocoDataset._parse_ann_info, in vectorized form
+        xywh = np.array(anns['bboxes'], dtype=np.float32)
+        keep = (anns['ignore'] == 0) & (anns['areas'] > 0) & (xywh[:, 2] >= 1) & (xywh[:, 3] >= 1)
+        xyxy = np.concatenate([xywh[:, :2], xywh[:, :2] + xywh[:, 2:] - 1], axis=1)
+        crowd = anns['iscrowd'] > 0
+        gt_bboxes = xyxy[keep & ~crowd]
+        gt_labels = self.cat2label_arr[anns['cat_ids'][keep & ~crowd]]
+        gt_bboxes_ignore = xyxy[keep & crowd]
+        seg_map = img_info['filename'].replace('jpg', 'png')
+        return dict(
+            bboxes=gt_bboxes.reshape(-1, 4),
+            labels=gt_labels.astype(np.int64),
+            bboxes_ignore=gt_bboxes_ignore.reshape(-1, 4),
+            masks=[],
+            seg_map=seg_map)
+
+    def _filter_imgs(self, min_size=32):
+        if self.ann_index is None:
+            return super(VOCDataset, self)._filter_imgs(min_size)
+        valid = np.minimum(self.ann_index.img_widths, self.ann_index.img_heights) >= min_size
+        if getattr(self, 'filter_empty_gt', True):
+            valid &= self.ann_index.ann_counts() > 0
+        return np.nonzero(valid)[0].tolist()
+
+    # COCO api of the ground truth, used for evaluation
+    def coco_api(self):
+        if self.ann_index is None:
+            return self.coco
+        return self.ann_index.to_coco()
@@ -0,0 +1,137 @@
+import types, logging, torch, mmcv
+
+'''
+Targets of dense heads(AnchorHead, FCOSHead and GuidedAnchor) only depend on gt, img_meta and
+grid sizes, so they can be computed in dataloader workers while the model runs on the previous
+batch. TargetCollate wraps the collate_fn of the dataloader: after images of a batch are padded,
+it derives grid sizes of each head from the padded input size and the strides of the head,
+computes targets of each image on CPU and puts them in img_meta['dense_targets'][key].
+
+A head computes its targets in the main process as before if it finds none, or if grid sizes
+of its outputs differ from the ones targets were computed for.
+'''
+
+
+class DenseTargets(object):
+    def __init__(self, grid_sizes, targets):
+        self.grid_sizes = grid_sizes
+        self.targets = targets
+
+    # img_metas get logged, do not print the tensors
+    def __repr__(self):
+        return 'DenseTargets(grid_sizes={})'.format(self.grid_sizes)
+
+
+class TargetView(object):
+    '''
+    It holds the attributes that the target methods of a head read, and runs the methods of the
+    head class on them, so that workers do not touch parameters or device state of the head.
+    '''
+    def __init__(self, head_cls, **attrs):
+        self.head_cls = head_cls
+        self.__dict__.update(attrs)
+
+    def __getattr__(self, name):
+        if name == 'head_cls':
+            raise AttributeError(name)
+        attr = getattr(self.head_cls, name)
+        return types.MethodType(attr, self) if callable(attr) else attr
+
+
+def grid_sizes_of(input_size, strides):
+    # convs with stride 2 and padding give ceil(x/2) on each level
+    return [tuple(-(-x // stride) for x in input_size) for stride in strides]
+
+
+def to_device(nested, device):
+    if isinstance(nested, (list, tuple)):
+        return type(nested)(to_device(x, device) for x in nested)
+    return nested.to(device)
+
+
+class DenseTargetFn(object):
+    '''
+    Targets of one image on CPU, target_view.image_targets has the signature:
+        image_targets(grid_sizes, gt_bbox, gt_label, img_meta, input_size, train_cfg, device)
+    '''
+    def __init__(self, target_view, strides, train_cfg):
+        self.target_view = target_view
+        self.strides = strides
+        self.train_cfg = train_cfg
+
+    def __call__(self, gt_bbox, gt_label, img_meta, input_size):
+        grid_sizes = grid_sizes_of(input_size, self.strides)
+        with torch.no_grad():
+            targets = self.target_view.image_targets(
+                tuple(grid_sizes), gt_bbox, gt_label, img_meta, tuple(input_size), self.train_cfg,
+                torch.device('cpu'))
+        return DenseTargets(grid_sizes, targets)
+
+
+class TargetCollate(object):
+    def __init__(self, collate_fn, target_fns):
+        self.collate_fn = collate_fn
+        self.target_fns = target_fns
+
+    def __call__(self, batch):
+        data = self.collate_fn(batch)
+        # one chunk per gpu, images in a chunk are padded to the same size
+        for imgs, img_metas, gt_bboxes, gt_labels in zip(
+                data['img'].data, data['img_meta'].data, data['gt_bboxes'].data, data['gt_labels'].data):
+            input_size = imgs.shape[-2:]
+            for img_meta, gt_bbox, gt_label in zip(img_metas, gt_bboxes, gt_labels):
+                img_meta['dense_targets'] = {
+                    key: fn(gt_bbox.t(), gt_label, img_meta, input_size) for key, fn in self.target_fns.items()}
+        return data
+
+
+def dense_heads(model, train_cfg):
+    '''
+    (key, head, train_cfg) of heads of a detector whose targets can be computed in workers.
+    '''
+    heads = []
+    bbox_head = getattr(model, 'bbox_head', None)
+    if hasattr(bbox_head, 'target_view'):
+        heads.append(('bbox_head', bbox_head, train_cfg))
+    rpn_head = getattr(model, 'rpn_head', None)
+    # GARPNHead assigns its guided anchors densely, its rpn targets depend on predicted shapes
+    rpn_head = getattr(rpn_head, 'guided_anchor', rpn_head)
+    if hasattr(rpn_head, 'target_view'):
+        heads.append(('rpn_head', rpn_head, train_cfg.rpn))
+    return heads
+
+
+def install(dataloader, model, train_cfg):
+    '''
+    Make workers of dataloader compute targets of the dense heads of model.
+    '''
+    target_fns = {}
+    for key, head, head_cfg in dense_heads(model, train_cfg):
+        head.dense_target_key = key
+        # train.py puts the dataloader in train_cfg, workers do not need it
+        head_cfg = mmcv.ConfigDict({k: v for k, v in head_cfg.items() if k != 'dataloader'})
+        target_fns[key] = DenseTargetFn(head.target_view(), head.target_strides(), head_cfg)
+    if len(target_fns) == 0:
+        logging.warning('{} has no dense head to compute targets in workers'.format(type(model).__name__))
+        return dataloader
+    if not isinstance(dataloader.collate_fn, TargetCollate):
+        dataloader.collate_fn = TargetCollate(dataloader.collate_fn, target_fns)
+    logging.info('Targets of {} are computed in {} dataloader workers'.format(
+        list(target_fns), dataloader.num_workers))
+    return dataloader
+
+
+def precomputed(img_meta, key, grid_sizes, device):
+    '''
+    Targets computed for img_meta in workers if their grid sizes match, otherwise None.
+    '''
+    if key is None:
+        return None
+    targets = img_meta.get('dense_targets', {}).get(key, None)
+    if targets is None:
+        return None
+    if targets.grid_sizes != [tuple(grid) for grid in grid_sizes]:
+        logging.warning('Grid sizes {} of precomputed targets differ from outputs {}, compute them again'.format(
+            targets.grid_sizes, [tuple(grid) for grid in grid_sizes]))
+        return None
+    return to_device(targets.targets, device)
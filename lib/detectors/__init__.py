@@ -1,3 +1,15 @@
-from .retinanet import RetinaNet
-from .cascade_rcnn import CascadeRCNN
-from .fcos import FCOS
+import importlib
+
+# detectors are imported on first access, see lib/heads/__init__.py
+_detectors_ = {
+    'RetinaNet': '.retinanet',
+    'CascadeRCNN': '.cascade_rcnn',
+    'FCOS': '.fcos'
+}
+
+__all__ = list(_detectors_.keys())
+
+def __getattr__(name):
+    if name in _detectors_:
+        return getattr(importlib.import_module(_detectors_[name], __name__), name)
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
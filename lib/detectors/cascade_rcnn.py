@@ -2,8 +2,10 @@ from torch import nn
 from .. import utils
 from ..utils import class_name
 import logging, torch
+from ..builder import register_module
 
 
+@register_module()
 class CascadeRCNN(nn.Module):
     def __init__(self,
                  num_stages=3,
@@ -158,18 +160,34 @@ class CascadeRCNN(nn.Module):
         logging.info('start to predict for detector')
         logging.debug('img_data: {}'.format(img_data.shape))
         logging.debug('img_metas: {}'.format(img_metas))
-        test_cfg = self.test_cfg
         feats = self.extract_feat(img_data)
         logging.debug('Feature size: {}'.format([feat.shape for feat in feats]))
+        return self.forward_feats(feats, img_metas)
+
+    # forward_test from outputs of extract_feat, e.g. features read from a FeatureCache
+    def forward_feats(self, feats, img_metas):
+        test_cfg = self.test_cfg
+        props, mi_cls_outs, reg_outs = self.predict_rcnn_outs(feats, img_metas)
+        img_sizes = [img_meta['img_shape'][:2] for img_meta in img_metas]
+        test_res = utils.unpack_multi_result(
+            utils.multi_apply(self.rcnn_head[-1].predict_bboxes_single_image,
+                              props,
+                              mi_cls_outs,
+                              reg_outs,
+                              img_sizes,
+                              test_cfg.rcnn))
 
-        rpn_props = self.rpn_head.predict_bboxes(feats, img_metas, test_cfg.rpn)
+        return test_res
+
+    # rpn and all rcnn stages in test, it returns inputs of the last stage, cls_outs averaged
+    # over stages and reg_outs of the last stage for each image
+    def predict_rcnn_outs(self, feats, img_metas):
+        rpn_props = self.rpn_head.predict_bboxes(feats, img_metas, self.test_cfg.rpn)
         
         props = rpn_props[0]
         logging.debug('{}: proposals from rpn: {}'.format(
             class_name(self), [pr.shape for pr in props]))
 
-        img_sizes = [img_meta['img_shape'][:2] for img_meta in img_metas]
-
         ms_cls_outs = []
         for i in range(self.num_stages):
             logging.info('test in stage: {}'.format(i).center(80, '+'))
@@ -191,16 +209,4 @@ class CascadeRCNN(nn.Module):
 
         mi_cls_outs = utils.unpack_multi_result(ms_cls_outs)
         mi_cls_outs = [sum(img_cls_out)/self.num_stages for img_cls_out in mi_cls_outs]
-
-        test_res = utils.unpack_multi_result(
-            utils.multi_apply(self.rcnn_head[-1].predict_bboxes_single_image,
-                              props,
-                              mi_cls_outs,
-                              reg_outs,
-                              img_sizes,
-                              test_cfg.rcnn))
-
-        return test_res
-        
-        
-
+        return props, mi_cls_outs, reg_outs
@@ -1,6 +1,8 @@
 from torch import nn
 import logging
+from ..builder import register_module
 
+@register_module()
 class RetinaNet(nn.Module):
     def __init__(self,
                  backbone=None,
@@ -54,6 +56,19 @@ class RetinaNet(nn.Module):
 
     def forward_test(self, img_data, img_metas):
         logging.info('start to predict for detector')
-        test_cfg = self.test_cfg
         feats = self.extract_feat(img_data)
-        return self.bbox_head.predict_bboxes(feats, img_metas, test_cfg)
+        return self.forward_feats(feats, img_metas)
+
+    # forward_test from outputs of extract_feat, e.g. features read from a FeatureCache
+    def forward_feats(self, feats, img_metas):
+        return self.bbox_head.predict_bboxes(feats, img_metas, self.test_cfg)
+
+    # static part of forward_test, it can be compiled or traced, see StaticDetector
+    def forward_dense(self, img_data, img_sizes, scale_factors):
+        feats = self.extract_feat(img_data)
+        cls_outs, reg_outs = self.bbox_head(feats)
+        return self.bbox_head.predict_dense(cls_outs, reg_outs, img_sizes, scale_factors, self.test_cfg)
+
+    # data dependent part of forward_test, it runs on outputs of forward_dense
+    def forward_post(self, dense_outs, img_metas):
+        return self.bbox_head.predict_post(*dense_outs, img_metas, self.test_cfg)
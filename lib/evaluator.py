@@ -0,0 +1,390 @@
+import numpy as np
+import logging
+
+'''
+A vectorized COCO style bbox evaluator that gives the same numbers as COCOeval of pycocotools.
+
+COCOeval loops over images, categories, area ranges, iou thresholds, detections and ground
+truths in python. Here each category is evaluated at once: detections and ground truths of its
+images are padded into [images, detections] and [images, ground truths] arrays, ious of all of
+them are computed together, and the greedy matching of COCOeval steps over the detection slot
+only, for all images, area ranges and iou thresholds at once. Categories are independent, so
+they are spread over a process pool.
+
+StreamingEvaluator matches (image, category) groups of a few images at a time instead, and
+keeps matches of detections only, which is what a periodic evaluation during training needs.
+
+The semantics of COCOeval are kept, including the ones that are easy to miss:
+    - only iscrowd marks a ground truth ignored, 'ignore' of annotations is not used
+    - area of a ground truth is its 'area' field, area of a detection is w*h of its bbox
+    - detections of an image are sorted by score with a stable sort, at most 100 are kept
+    - a detection prefers unignored ground truths, among equal ious the later one is matched
+    - ious of crowd ground truths are intersection over area of the detection
+    - detections are rounded as results2json does, so that numbers match the json path
+'''
+
+IOU_THRS = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+REC_THRS = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
+MAX_DETS = [1, 10, 100]
+AREA_RNGS = np.array([[0, 1e5 ** 2], [0, 32 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]])
+
+
+def box_ious(dt, gt, crowd):
+    '''
+    Args:
+        dt: [..., D, 4], gt: [..., G, 4] in xywh, crowd: [..., G]
+    Returns:
+        ious [..., D, G], same as maskUtils.iou for bboxes
+    '''
+    dt, gt = dt[..., :, None, :], gt[..., None, :, :]
+    w = np.minimum(dt[..., 0] + dt[..., 2], gt[..., 0] + gt[..., 2]) - np.maximum(dt[..., 0], gt[..., 0])
+    h = np.minimum(dt[..., 1] + dt[..., 3], gt[..., 1] + gt[..., 3]) - np.maximum(dt[..., 1], gt[..., 1])
+    inter = np.clip(w, 0, None) * np.clip(h, 0, None)
+    dt_area = dt[..., 2] * dt[..., 3]
+    union = np.where(crowd[..., None, :], dt_area, dt_area + gt[..., 2] * gt[..., 3] - inter)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(union > 0, inter / union, 0.0)
+
+
+def last_argmax(x):
+    # index of the last maximum along the last axis, 0 if it is empty
+    if x.shape[-1] == 0:
+        return np.zeros(x.shape[:-1], dtype=np.int64)
+    return x.shape[-1] - 1 - np.argmax(x[..., ::-1], axis=-1)
+
+
+def area_ignored(areas, crowd):
+    # [A, n], ground truths that are ignored in each area range
+    lo, hi = AREA_RNGS[:, :1], AREA_RNGS[:, 1:]
+    return crowd[None] | (areas[None] < lo) | (areas[None] > hi)
+
+
+def pad_by_group(groups, num_groups, arrays, max_len=None):
+    '''
+    Put rows of arrays into [num_groups, L, ...] arrays by groups(sorted), rows beyond max_len
+    of a group are dropped.
+
+    Returns:
+        valid: [num_groups, L] mask of filled slots
+        padded: list of padded arrays
+        slots: [n] slot of each row in its group
+    '''
+    counts = np.bincount(groups, minlength=num_groups)
+    L = int(counts.max()) if len(groups) > 0 else 0
+    if max_len is not None:
+        L = min(L, max_len)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    slots = np.arange(len(groups)) - starts[groups]
+    keep = slots < L
+    valid = np.zeros((num_groups, L), dtype=bool)
+    valid[groups[keep], slots[keep]] = True
+    padded = []
+    for arr in arrays:
+        out = np.zeros((num_groups, L) + arr.shape[1:], dtype=arr.dtype)
+        out[groups[keep], slots[keep]] = arr[keep]
+        padded.append(out)
+    return valid, padded, slots
+
+
+def match_images(dt_box, dt_valid, gt_box, gt_area, gt_crowd, gt_valid):
+    '''
+    Greedy matching of COCOeval.evaluateImg for I images of a category at once, or any I groups
+    of detections and ground truths of the same image and category.
+
+    Args:
+        dt_*: [I, D, ...], detections sorted by score in each image
+        gt_*: [I, G, ...]
+    Returns:
+        dt_matched, dt_ignored: [T, A, I, D]
+    '''
+    T, A = len(IOU_THRS), len(AREA_RNGS)
+    I, D = dt_valid.shape
+    G = gt_valid.shape[1]
+    lo, hi = AREA_RNGS[:, 0].reshape(A, 1, 1), AREA_RNGS[:, 1].reshape(A, 1, 1)
+    gt_ig = gt_crowd[None] | (gt_area[None] < lo) | (gt_area[None] > hi)
+    # ground truths are visited unignored first, the sort of COCOeval is stable
+    order = np.argsort(np.where(gt_valid[None], gt_ig, 2), axis=-1, kind='stable')
+    gt_ig = np.take_along_axis(gt_ig, order, -1)
+    valid = np.take_along_axis(np.broadcast_to(gt_valid, (A, I, G)), order, -1)
+    crowd = np.take_along_axis(np.broadcast_to(gt_crowd, (A, I, G)), order, -1)
+    ious = box_ious(dt_box, gt_box, gt_crowd)
+    ious = np.take_along_axis(np.broadcast_to(ious, (A, I, D, G)), order[:, :, None, :], -1)
+
+    thrs = np.minimum(IOU_THRS, 1 - 1e-10).reshape(T, 1, 1, 1)
+    gt_matched = np.zeros((T, A, I, G), dtype=bool)
+    dt_matched = np.zeros((T, A, I, D), dtype=bool)
+    dt_ignored = np.zeros((T, A, I, D), dtype=bool)
+    for d in range(D):
+        iou = ious[None, :, :, d, :]
+        cand = (iou >= thrs) & valid[None] & (~gt_matched | crowd[None]) & dt_valid[None, None, :, d, None]
+        cand_unig, cand_ig = cand & ~gt_ig[None], cand & gt_ig[None]
+        has_unig, has_ig = cand_unig.any(-1), cand_ig.any(-1)
+        best_unig = last_argmax(np.where(cand_unig, iou, -1.0))
+        best_ig = last_argmax(np.where(cand_ig, iou, -1.0))
+        matched = has_unig | has_ig
+        best = np.where(has_unig, best_unig, best_ig)
+        dt_matched[..., d] = matched
+        dt_ignored[..., d] = matched & ~has_unig
+        t, a, i = np.nonzero(matched)
+        gt_matched[t, a, i, best[t, a, i]] = True
+    # unmatched detections out of the area range are ignored
+    dt_area = dt_box[..., 2] * dt_box[..., 3]
+    dt_out = (dt_area[None] < lo) | (dt_area[None] > hi)
+    dt_ignored |= ~dt_matched & dt_out[None]
+    return dt_matched, dt_ignored
+
+
+def match_groups(gt, dt, chunk_size=512):
+    '''
+    Match detections to ground truths of the same group, a group is an image of one category.
+
+    Args:
+        gt: dict of groups [n], bboxes [n, 4], areas [n], crowd [n], sorted by groups
+        dt: dict of groups [m], bboxes [m, 4], sorted by groups, then by score(stable) in a group
+    Returns:
+        keep: [m] mask of the first 100 detections of each group, which are evaluated
+        slots: [k] rank of kept detections in their groups
+        matched, ignored: [T, A, k] of kept detections
+    '''
+    T, A = len(IOU_THRS), len(AREA_RNGS)
+    groups = np.unique(np.concatenate([gt['groups'], dt['groups']]))
+    gt_groups, dt_groups = np.searchsorted(groups, gt['groups']), np.searchsorted(groups, dt['groups'])
+    gt_valid, (gt_box, gt_area, gt_crowd), _ = pad_by_group(
+        gt_groups, len(groups), [gt['bboxes'], gt['areas'], gt['crowd']])
+    dt_valid, (dt_box, ), slots = pad_by_group(dt_groups, len(groups), [dt['bboxes']], MAX_DETS[-1])
+    keep = slots < MAX_DETS[-1]
+    matched, ignored = np.zeros((T, A, 0), dtype=bool), np.zeros((T, A, 0), dtype=bool)
+    for i in range(0, len(groups), chunk_size):
+        s = slice(i, i + chunk_size)
+        res = match_images(dt_box[s], dt_valid[s], gt_box[s], gt_area[s], gt_crowd[s], gt_valid[s])
+        # filled slots in row major order are kept detections in order
+        matched = np.concatenate([matched, res[0][:, :, dt_valid[s]]], axis=2)
+        ignored = np.concatenate([ignored, res[1][:, :, dt_valid[s]]], axis=2)
+    return keep, slots[keep], matched, ignored
+
+
+def accumulate(img_inds, slots, scores, matched, ignored, num_pos):
+    '''
+    Precision [T, R, A, M] and recall [T, A, M] of one category from its matched detections, -1
+    where there is no unignored ground truth, same as COCOeval.accumulate.
+
+    Args:
+        img_inds, slots, scores: [k], image and rank in the image of detections
+        matched, ignored: [T, A, k]
+        num_pos: [A] number of unignored ground truths
+    '''
+    T, R, A, M = len(IOU_THRS), len(REC_THRS), len(AREA_RNGS), len(MAX_DETS)
+    precision = -np.ones((T, R, A, M))
+    recall = -np.ones((T, A, M))
+    for m, max_det in enumerate(MAX_DETS):
+        # COCOeval concatenates the first max_det detections of images in order and sorts them
+        # by score with a stable sort
+        sel = np.nonzero(slots < max_det)[0]
+        sel = sel[np.lexsort((slots[sel], img_inds[sel], -scores[sel]))]
+        nd = len(sel)
+        for a in range(A):
+            if num_pos[a] == 0:
+                continue
+            if nd == 0:
+                recall[:, a, m] = 0
+                precision[:, :, a, m] = 0
+                continue
+            tp_sum = np.cumsum(matched[:, a, sel] & ~ignored[:, a, sel], axis=1).astype(float)
+            fp_sum = np.cumsum(~matched[:, a, sel] & ~ignored[:, a, sel], axis=1).astype(float)
+            for t in range(T):
+                rc = tp_sum[t] / num_pos[a]
+                pr = tp_sum[t] / (fp_sum[t] + tp_sum[t] + np.spacing(1))
+                recall[t, a, m] = rc[-1]
+                pr = np.maximum.accumulate(pr[::-1])[::-1]
+                inds = np.searchsorted(rc, REC_THRS, side='left')
+                precision[t, :, a, m] = np.where(inds < nd, pr[np.minimum(inds, nd - 1)], 0)
+    return precision, recall
+
+
+def evaluate_category(gt, dt):
+    '''
+    Args:
+        gt, dt: see match_groups, groups are images, dt also has scores [m]
+    '''
+    keep, slots, matched, ignored = match_groups(gt, dt)
+    num_pos = (~area_ignored(gt['areas'], gt['crowd'])).sum(1)
+    return accumulate(dt['groups'][keep], slots, dt['scores'][keep], matched, ignored, num_pos)
+
+
+def _evaluate_category(args):
+    return evaluate_category(*args)
+
+
+def summarize(precision, recall):
+    '''
+    The 12 numbers of COCOeval.stats.
+    '''
+    def mean(s):
+        s = s[s > -1]
+        return -1 if len(s) == 0 else float(np.mean(s))
+    stats = [mean(precision[:, :, :, 0, 2]),
+             mean(precision[0, :, :, 0, 2]),
+             mean(precision[5, :, :, 0, 2])]
+    stats += [mean(precision[:, :, :, a, 2]) for a in (1, 2, 3)]
+    stats += [mean(recall[:, :, 0, m]) for m in range(3)]
+    stats += [mean(recall[:, :, a, 2]) for a in (1, 2, 3)]
+    return np.array(stats)
+
+
+def print_stats(stats):
+    names = [('Precision', 'AP', '0.50:0.95', 'all', 100), ('Precision', 'AP', '0.50', 'all', 100),
+             ('Precision', 'AP', '0.75', 'all', 100), ('Precision', 'AP', '0.50:0.95', 'small', 100),
+             ('Precision', 'AP', '0.50:0.95', 'medium', 100), ('Precision', 'AP', '0.50:0.95', 'large', 100),
+             ('Recall', 'AR', '0.50:0.95', 'all', 1), ('Recall', 'AR', '0.50:0.95', 'all', 10),
+             ('Recall', 'AR', '0.50:0.95', 'all', 100), ('Recall', 'AR', '0.50:0.95', 'small', 100),
+             ('Recall', 'AR', '0.50:0.95', 'medium', 100), ('Recall', 'AR', '0.50:0.95', 'large', 100)]
+    for (title, short, iou, area, max_det), s in zip(names, stats):
+        print(' {:<18} {} @[ IoU={:<9} | area={:>6s} | maxDets={:>3d} ] = {:0.3f}'.format(
+            'Average ' + title, '(' + short + ')', iou, area, max_det, s))
+
+
+class COCOEvaluator(object):
+    '''
+    Evaluate predictions of BasicTester.inference in process.
+
+    Args:
+        gt: COCO api of ground truth
+        img_ids: evaluate only on these images, all images of gt if None
+        num_workers: size of the process pool over categories, 0 evaluates in this process
+    '''
+    def __init__(self, gt, img_ids=None, num_workers=0):
+        self.img_ids = sorted(gt.getImgIds() if img_ids is None else set(img_ids))
+        self.cat_ids = sorted(gt.getCatIds())
+        self.num_workers = num_workers
+        self.img_pos = {iid: i for i, iid in enumerate(self.img_ids)}
+        self.cat_pos = {cid: k for k, cid in enumerate(self.cat_ids)}
+        anns = gt.loadAnns(gt.getAnnIds(imgIds=self.img_ids, catIds=self.cat_ids))
+        # all ground truths sorted by image, in the order of annotations inside an image
+        self.gt = self.sort_by_image(
+            np.arange(len(anns)),
+            img_inds=np.array([self.img_pos[ann['image_id']] for ann in anns], dtype=np.int64),
+            cat_inds=np.array([self.cat_pos[ann['category_id']] for ann in anns], dtype=np.int64),
+            bboxes=np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape(-1, 4),
+            areas=np.array([ann['area'] for ann in anns], dtype=np.float64),
+            crowd=np.array([bool(ann.get('iscrowd', 0)) for ann in anns], dtype=bool))
+        self.num_pos = np.stack([(~area_ignored(self.gt['areas'], self.gt['crowd'])
+                                  & (self.gt['cat_inds'] == k)).sum(1) for k in range(len(self.cat_ids))])
+
+    @staticmethod
+    def sort_by_image(secondary, **arrays):
+        order = np.lexsort((secondary, arrays['img_inds']))
+        return {name: arr[order] for name, arr in arrays.items()}
+
+    def category_split(self, arrays, k):
+        sel = arrays['cat_inds'] == k
+        res = {name: arr[sel] for name, arr in arrays.items()}
+        res['groups'] = res['img_inds']
+        return res
+
+    def detections(self, infer_res):
+        '''
+        Detections of all categories from infer_res sorted by image and score, rounded as
+        results2json.
+        '''
+        img_inds, cat_inds, bboxes, scores = \
+            [np.zeros(0, np.int64)], [np.zeros(0, np.int64)], [np.zeros((0, 4))], [np.zeros(0)]
+        for pred in infer_res:
+            if pred['image_id'] not in self.img_pos:
+                continue
+            category = np.asarray(pred['category']).reshape(-1)
+            keep = np.array([c in self.cat_pos for c in category.tolist()], dtype=bool)
+            img_inds.append(np.full(int(keep.sum()), self.img_pos[pred['image_id']], dtype=np.int64))
+            cat_inds.append(np.array([self.cat_pos[c] for c in category[keep].tolist()], dtype=np.int64))
+            bboxes.append(np.asarray(pred['bbox'], dtype=np.float64).reshape(-1, 4)[keep])
+            scores.append(np.asarray(pred['score'], dtype=np.float64).reshape(-1)[keep])
+        # bboxes of results2json are rounded from float32 tensors
+        bboxes = np.round(np.concatenate(bboxes).astype(np.float32).astype(np.float64), 2)
+        scores = np.round(np.concatenate(scores).astype(np.float32).astype(np.float64), 3)
+        # COCOeval sorts detections of an image by score with a stable sort
+        rank = np.lexsort((np.arange(len(scores)), -scores)).argsort()
+        return self.sort_by_image(rank, img_inds=np.concatenate(img_inds), cat_inds=np.concatenate(cat_inds),
+                                  bboxes=bboxes, scores=scores)
+
+    def summarize(self, results):
+        self.precision = np.stack([r[0] for r in results], axis=1)
+        self.recall = np.stack([r[1] for r in results], axis=1)
+        stats = summarize(self.precision, self.recall)
+        logging.info('Evaluated {} images and {} categories: mAP {:.4f}, AP50 {:.4f}'.format(
+            len(self.img_ids), len(self.cat_ids), stats[0], stats[1]))
+        return stats
+
+    def evaluate(self, infer_res):
+        '''
+        Returns:
+            stats: the 12 numbers of COCOeval.stats
+        '''
+        dts = self.detections(infer_res)
+        tasks = [(self.category_split(self.gt, k), self.category_split(dts, k)) for k in range(len(self.cat_ids))]
+        if self.num_workers > 0:
+            import multiprocessing as mp
+            with mp.get_context('fork').Pool(self.num_workers) as pool:
+                results = pool.map(_evaluate_category, tasks, chunksize=1)
+        else:
+            results = [evaluate_category(*task) for task in tasks]
+        return self.summarize(results)
+
+
+class StreamingEvaluator(COCOEvaluator):
+    '''
+    Same numbers as COCOEvaluator, but predictions are added batch by batch, each image once.
+    Detections are matched for every flush_imgs images, after that only their matches are kept,
+    i.e. scores and matched/ignored flags, not the list of predictions.
+
+    Args:
+        gt, img_ids: same as COCOEvaluator, images that are never added have no detections
+        flush_imgs: number of images that are matched together
+    '''
+    def __init__(self, gt, img_ids=None, flush_imgs=64):
+        super(StreamingEvaluator, self).__init__(gt, img_ids)
+        self.flush_imgs = flush_imgs
+        self.reset()
+
+    def reset(self):
+        self.pending, self.matches = [], []
+
+    def add(self, infer_res):
+        self.pending.extend(infer_res)
+        if len(self.pending) >= self.flush_imgs:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        dt = self.detections(self.pending)
+        self.pending = []
+        # a group is an image of a category, matched together with all other groups
+        num_cats = len(self.cat_ids)
+        gt_sel = np.isin(self.gt['img_inds'], dt['img_inds'])
+        gt = {name: arr[gt_sel] for name, arr in self.gt.items()}
+        gt['groups'] = gt['img_inds'] * num_cats + gt['cat_inds']
+        dt['groups'] = dt['img_inds'] * num_cats + dt['cat_inds']
+        # sorting by group keeps the order of annotations and scores inside a group
+        gt = {name: arr[np.argsort(gt['groups'], kind='stable')] for name, arr in gt.items()}
+        dt = {name: arr[np.argsort(dt['groups'], kind='stable')] for name, arr in dt.items()}
+        keep, slots, matched, ignored = match_groups(gt, dt)
+        self.matches.append(dict(img_inds=dt['img_inds'][keep], cat_inds=dt['cat_inds'][keep], slots=slots,
+                                 scores=dt['scores'][keep], matched=matched, ignored=ignored))
+
+    def evaluate(self):
+        '''
+        Returns:
+            stats: the 12 numbers of COCOeval.stats of all added images, the evaluator is reset
+        '''
+        self.flush()
+        empty = dict(img_inds=np.zeros(0, np.int64), cat_inds=np.zeros(0, np.int64), slots=np.zeros(0, np.int64),
+                     scores=np.zeros(0), matched=np.zeros((len(IOU_THRS), len(AREA_RNGS), 0), dtype=bool),
+                     ignored=np.zeros((len(IOU_THRS), len(AREA_RNGS), 0), dtype=bool))
+        matches = {name: np.concatenate([m[name] for m in [empty] + self.matches], axis=-1) for name in empty}
+        results = []
+        for k in range(len(self.cat_ids)):
+            sel = np.nonzero(matches['cat_inds'] == k)[0]
+            results.append(accumulate(matches['img_inds'][sel], matches['slots'][sel], matches['scores'][sel],
+                                      matches['matched'][:, :, sel], matches['ignored'][:, :, sel],
+                                      self.num_pos[k]))
+        self.reset()
+        return self.summarize(results)
@@ -0,0 +1,256 @@
+import json, logging, torch
+import os.path as osp
+from collections import OrderedDict
+from torch import nn
+from . import utils
+from .region import BasicRoIExtractor
+from .utils import class_name
+
+'''
+Export of detectors to ONNX. Only the network part is exported, decoding and nms are done by
+the NumPy post-processor in onnx_post.py, since anchors and grid points depend on the input
+size and nms has a data dependent output size.
+
+Graphs of each detector:
+    RetinaNet, FCOS: 'dense': img -> cls_i, reg_i(, ctr_i) of all levels
+    CascadeRCNN:     'rpn':   img -> feat_i of all levels, rpn_cls_i, rpn_reg_i of all levels
+                     'rcnn':  feat_i, props(, img_size) -> cls_out, reg_out, props
+                              all stages with refinement between stages, cls_out is averaged
+                              over stages and props are the inputs of the last stage. Unused
+                              inputs would be dropped from the exported graph, so it only takes
+                              the levels read by roi extractors, and img_size with > 1 stages,
+                              meta['rcnn_inputs'] are its input names
+'''
+
+
+class DenseExportModel(nn.Module):
+    def __init__(self, detector):
+        super(DenseExportModel, self).__init__()
+        self.detector = detector
+
+    def forward(self, img):
+        feats = self.detector.extract_feat(img)
+        return tuple(x for level_outs in self.detector.bbox_head(feats) for x in level_outs)
+
+
+class RPNExportModel(nn.Module):
+    def __init__(self, detector):
+        super(RPNExportModel, self).__init__()
+        self.detector = detector
+
+    def forward(self, img):
+        feats = tuple(self.detector.extract_feat(img))
+        cls_outs, reg_outs = self.detector.rpn_head(feats)
+        return feats + tuple(cls_outs) + tuple(reg_outs)
+
+
+# number of feature levels an roi extractor reads, the first ones of the neck outputs
+def roi_levels(extractor):
+    if isinstance(extractor, BasicRoIExtractor):
+        return len(extractor.roi_layers)
+    return len(extractor.featmap_strides)
+
+
+class RCNNExportModel(nn.Module):
+    '''
+    All rcnn stages of CascadeRCNN on one image, same as the loop in CascadeRCNN.forward_test.
+    Unlike the roi extractors it has no boolean indexing: rois of all levels are computed for
+    all props and the level of each prop is selected with where, so the graph has no data
+    dependent shapes.
+
+    Inputs are feat_i of the first num_feats levels, props and img_size, img_size is only
+    needed by refinement between stages.
+    '''
+    def __init__(self, detector):
+        super(RCNNExportModel, self).__init__()
+        self.detector = detector
+        self.num_feats = max(roi_levels(extractor) for extractor in detector.roi_extractors)
+        self.input_names = ['feat_{}'.format(i) for i in range(self.num_feats)] + ['props']
+        if detector.num_stages > 1:
+            self.input_names.append('img_size')
+
+    def level_rois(self, extractor, feat, props, i):
+        if isinstance(extractor, BasicRoIExtractor):
+            rois = torch.cat([torch.zeros_like(props[:1]), props]).t()
+            return extractor.roi_layers[i](feat, rois)
+        return extractor.forward_one_level(feat, props, 1.0 / extractor.featmap_strides[i])
+
+    def extract_rois(self, extractor, feats, props):
+        num_lvls = roi_levels(extractor)
+        if num_lvls == 1:
+            tar_lvls = None
+        elif isinstance(extractor, BasicRoIExtractor):
+            tar_lvls = extractor.map_rois_to_levels(props, num_lvls)
+        else:
+            tar_lvls = extractor.map_props_to_levels(props, num_lvls)
+        roi_outs = self.level_rois(extractor, feats[0], props, 0)
+        for i in range(1, num_lvls):
+            roi_outs = torch.where((tar_lvls == i).view(-1, 1, 1, 1),
+                                   self.level_rois(extractor, feats[i], props, i), roi_outs)
+        return roi_outs
+
+    # same as BBoxHead.refine_bboxes_single_image, img_size is a tensor here
+    def refine(self, head, props, label, reg_out, img_size):
+        if not head.reg_class_agnostic:
+            num_props = reg_out.shape[0]
+            reg_out = reg_out.view(num_props, 4, head.num_classes).gather(
+                2, label.view(-1, 1, 1).expand(-1, 4, 1)).squeeze(2)
+        x1, y1, x2, y2 = utils.param2bbox(props, reg_out.t(), head.target_means, head.target_stds)
+        max_y, max_x = img_size[0] - 1, img_size[1] - 1
+        return torch.stack([torch.min(x1.clamp(min=0.0), max_x), torch.min(y1.clamp(min=0.0), max_y),
+                            torch.min(x2.clamp(min=0.0), max_x), torch.min(y2.clamp(min=0.0), max_y)])
+
+    def forward(self, *inputs):
+        feats, props = inputs[:self.num_feats], inputs[self.num_feats]
+        img_size = inputs[self.num_feats + 1] if len(inputs) > self.num_feats + 1 else None
+        detector = self.detector
+        cls_sum = 0
+        for i in range(detector.num_stages):
+            head = detector.rcnn_head[i]
+            roi_outs = self.extract_rois(detector.roi_extractors[i], feats, props)
+            cls_outs, reg_outs = head([roi_outs])
+            cls_out, reg_out = cls_outs[0], reg_outs[0]
+            cls_sum = cls_sum + cls_out
+            if i < detector.num_stages - 1:
+                label = cls_out.argmax(1)
+                if head.use_sigmoid:
+                    label = label + 1
+                props = self.refine(head, props, label, reg_out, img_size)
+        return cls_sum / detector.num_stages, reg_out, props
+
+
+def anchor_head_meta(head):
+    return {'num_classes': head.num_classes,
+            'cls_channels': head.cls_channels,
+            'use_sigmoid': head.use_sigmoid,
+            'anchor_scales': list(head.anchor_scales),
+            'anchor_ratios': list(head.anchor_ratios),
+            'anchor_strides': list(head.anchor_strides),
+            'anchor_base_sizes': list(head.anchor_base_sizes),
+            'anchor_center_lt': head.anchor_center_lt,
+            'target_means': list(head.target_means),
+            'target_stds': list(head.target_stds)}
+
+def fcos_head_meta(head):
+    meta = {'cls_channels': head.cls_channels,
+            'strides': list(head.strides),
+            'reg_std': head.reg_std,
+            'reg_mean': head.reg_mean,
+            'use_centerness': head.use_centerness,
+            'use_dfl': head.use_dfl}
+    if head.use_dfl:
+        meta.update(dfl_cls_channels=head.loss_dfl.cls_channels, dfl_stride=head.loss_dfl.stride)
+    return meta
+
+def bbox_head_meta(head):
+    assert not head.use_sigmoid, 'sigmoid rcnn head is not supported in prediction'
+    return {'num_classes': head.num_classes,
+            'reg_class_agnostic': head.reg_class_agnostic,
+            'target_means': list(head.target_means),
+            'target_stds': list(head.target_stds)}
+
+def to_plain(cfg):
+    return json.loads(json.dumps(cfg, default=dict))
+
+
+def export_graphs(detector, img_size=(800, 1088)):
+    '''
+    Graphs of a detector to export and the meta info needed to post-process their outputs.
+
+    Returns:
+        graphs: OrderedDict, name -> dict(model, inputs, input_names, output_names, dynamic_axes)
+        meta: dict, see PostProcessor
+    '''
+    name = class_name(detector)
+    img = torch.randn(1, 3, *img_size)
+    img_axes = {0: 'batch', 2: 'height', 3: 'width'}
+    graphs = OrderedDict()
+    meta = {'detector': name, 'test_cfg': to_plain(detector.test_cfg)}
+    if name in ('RetinaNet', 'FCOS'):
+        model = DenseExportModel(detector)
+        with torch.no_grad():
+            num_outs = len(model(img))
+        groups = ['cls', 'reg', 'ctr'] if name == 'FCOS' else ['cls', 'reg']
+        num_levels = num_outs // len(groups)
+        output_names = ['{}_{}'.format(g, i) for g in groups for i in range(num_levels)]
+        graphs['dense'] = dict(model=model, inputs=(img, ), input_names=['img'], output_names=output_names,
+                               dynamic_axes={'img': img_axes, **{
+                                   out: {0: 'batch', 2: out+'_height', 3: out+'_width'}
+                                   for out in output_names}})
+        meta['bbox_head'] = anchor_head_meta(detector.bbox_head) if name == 'RetinaNet' \
+                            else fcos_head_meta(detector.bbox_head)
+    elif name == 'CascadeRCNN':
+        assert class_name(detector.rpn_head) == 'RPNHead', \
+            '{} is not supported in export'.format(class_name(detector.rpn_head))
+        rpn_model = RPNExportModel(detector)
+        with torch.no_grad():
+            rpn_outs = rpn_model(img)
+        num_levels = len(detector.rpn_head.anchor_strides)
+        num_feats = len(rpn_outs) - 2 * num_levels
+        feats = rpn_outs[:num_feats]
+        feat_names = ['feat_{}'.format(i) for i in range(num_feats)]
+        rpn_names = feat_names + ['rpn_{}_{}'.format(g, i) for g in ['cls', 'reg'] for i in range(num_levels)]
+        graphs['rpn'] = dict(model=rpn_model, inputs=(img, ), input_names=['img'], output_names=rpn_names,
+                             dynamic_axes={'img': img_axes, **{
+                                 out: {0: 'batch', 2: out+'_height', 3: out+'_width'} for out in rpn_names}})
+        props = torch.tensor([[0.0, 0.0, 31.0, 31.0], [16.0, 16.0, 255.0, 127.0],
+                              [0.0, 0.0, img_size[1] - 1.0, img_size[0] - 1.0]]).t().contiguous()
+        rcnn_model = RCNNExportModel(detector)
+        rcnn_inputs = tuple(feats[:rcnn_model.num_feats]) + (props, torch.tensor(img_size, dtype=torch.float))
+        graphs['rcnn'] = dict(model=rcnn_model, inputs=rcnn_inputs[:len(rcnn_model.input_names)],
+                              input_names=rcnn_model.input_names,
+                              output_names=['cls_out', 'reg_out', 'props_out'],
+                              dynamic_axes={**{f: {2: f+'_height', 3: f+'_width'}
+                                               for f in feat_names[:rcnn_model.num_feats]},
+                                            'props': {1: 'num_props'}, 'cls_out': {0: 'num_props'},
+                                            'reg_out': {0: 'num_props'}, 'props_out': {1: 'num_props'}})
+        meta.update(num_feats=num_feats, rcnn_inputs=rcnn_model.input_names,
+                    rpn_head=anchor_head_meta(detector.rpn_head),
+                    rcnn_head=bbox_head_meta(detector.rcnn_head[-1]))
+    else:
+        raise ValueError('{} is not supported in export'.format(name))
+    meta['num_levels'] = num_levels
+    return graphs, meta
+
+
+def export_onnx(detector, out_prefix, img_size=(800, 1088), opset=16):
+    '''
+    Export graphs of a detector to <out_prefix>_<graph>.onnx and meta info for post-processing
+    to <out_prefix>.json, the json file is the input of OnnxDetector.
+    '''
+    # adaptive pooling to sizes of other levels can not be exported with dynamic H and W
+    unsupported = [class_name(m) for m in detector.modules() if class_name(m) in ('BFP', )]
+    if len(unsupported) > 0:
+        raise ValueError('{} is not supported in ONNX export'.format(unsupported[0]))
+    detector.eval()
+    graphs, meta = export_graphs(detector, img_size)
+    meta['graphs'] = OrderedDict()
+    for name, graph in graphs.items():
+        filename = '{}_{}.onnx'.format(out_prefix, name)
+        with torch.no_grad():
+            torch.onnx.export(graph['model'], graph['inputs'], filename,
+                              input_names=graph['input_names'], output_names=graph['output_names'],
+                              dynamic_axes=graph['dynamic_axes'], opset_version=opset,
+                              do_constant_folding=True, dynamo=False)
+        meta['graphs'][name] = osp.basename(filename)
+        logging.info('Exported graph {} of {} to {}'.format(name, meta['detector'], filename))
+    with open(out_prefix + '.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def torch_runner(graphs):
+    '''
+    A run function of PostProcessor that runs the graphs to export in torch, the reference for
+    outputs of exported graphs.
+    '''
+    def run(name, feeds):
+        graph = graphs[name]
+        # same as onnxruntime, feeds must be exactly the inputs of the graph
+        assert sorted(feeds) == sorted(graph['input_names']), \
+            'inputs of graph {} are {}, but {} are fed'.format(name, graph['input_names'], sorted(feeds))
+        inputs = [torch.from_numpy(feeds[input_name]) for input_name in graph['input_names']]
+        with torch.no_grad():
+            outs = graph['model'](*inputs)
+        return [out.numpy() for out in outs]
+    return run
@@ -0,0 +1,177 @@
+import numpy as np
+import os.path as osp
+import os, json, hashlib, logging, torch
+
+'''
+A cache of backbone/neck features(outputs of extract_feat) of test images, so that heads and
+test_cfg can be evaluated again without running the backbone.
+
+The cache of a ckpt is a directory named by the hash of the ckpt file, under it:
+    feats.bin   features of all images as raw fp16 or fp32 arrays, appended image by image,
+                all levels of one image are contiguous, it is memory mapped for reading
+    index.json  written after all images, i.e. a cache without it is incomplete:
+                dtype, fingerprint of the config parts and the test images features depend on,
+                image ids in order, image ids of each batch, and for each image id:
+                offset(in elements), shapes of levels, img_meta
+
+Each image keeps its features as computed in its batch, including the padding to the largest
+image of the batch, and the cache is read in the same batches. Heads then see the same inputs
+as without cache, whatever imgs_per_gpu is: cropping features of smaller images and padding
+them with zeros again would change outputs of convs near the padding.
+'''
+
+
+def file_hash(filename, chunk_size=1 << 24):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def config_fingerprint(config, img_ids):
+    '''
+    Hash of what cached features depend on besides the ckpt: backbone, neck, test pipeline,
+    annotation file, image prefix, ids of the test images and imgs_per_gpu, which decides the
+    padding of images in a batch.
+    '''
+    parts = {'backbone': config.model.get('backbone'), 'neck': config.model.get('neck'),
+             'pipeline': config.data.test.pipeline, 'ann_file': config.data.test.ann_file,
+             'img_prefix': config.data.test.img_prefix, 'img_ids': list(img_ids),
+             'imgs_per_gpu': config.data.test.imgs_per_gpu}
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def image_id(img_meta):
+    # same as BasicTester, VOC image ids are file names without extension
+    return int(osp.basename(img_meta['filename'])[:-4])
+
+
+# ids of the images a dataloader of dataset yields, in the same form as image_id
+def dataset_img_ids(dataset):
+    return [int(osp.basename(img_info['filename'])[:-4]) for img_info in dataset.img_infos]
+
+
+def jsonable(obj):
+    if isinstance(obj, dict):
+        return {k: jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [jsonable(v) for v in obj]
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def cache_dir(cache_root, ckpt):
+    return osp.join(cache_root, file_hash(ckpt)[:16])
+
+
+class FeatureCacheWriter(object):
+    '''
+    Appends features of batches to the cache, close() writes the index.
+    '''
+    def __init__(self, cache_dir, fingerprint, fp16=True):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint
+        self.dtype = np.float16 if fp16 else np.float32
+        # an index left from an earlier run must not mark the new data file complete
+        if osp.exists(osp.join(cache_dir, 'index.json')):
+            os.remove(osp.join(cache_dir, 'index.json'))
+        self.data_file = open(osp.join(cache_dir, 'feats.bin'), 'wb')
+        self.offset = 0
+        self.entries = {}
+        self.img_ids = []
+        self.batch_ids = []
+
+    def add(self, feats, img_metas):
+        '''
+        Args:
+            feats: list(Tensor) [N, C, H_i, W_i] of all levels
+            img_metas: metas of the N images
+        '''
+        feats = [feat.detach().float().cpu() for feat in feats]
+        batch_ids = []
+        for i, img_meta in enumerate(img_metas):
+            iid = image_id(img_meta)
+            shapes = []
+            for feat in feats:
+                # the whole map of the batch, padding included
+                arr = feat[i].numpy().astype(self.dtype)
+                self.data_file.write(np.ascontiguousarray(arr).tobytes())
+                shapes.append(list(arr.shape))
+            self.entries[iid] = {'offset': self.offset, 'shapes': shapes, 'img_meta': jsonable(img_meta)}
+            self.offset += sum(int(np.prod(s)) for s in shapes)
+            self.img_ids.append(iid)
+            batch_ids.append(iid)
+        self.batch_ids.append(batch_ids)
+
+    def close(self):
+        self.data_file.close()
+        index = {'dtype': np.dtype(self.dtype).name, 'fingerprint': self.fingerprint,
+                 'img_ids': self.img_ids, 'batch_ids': self.batch_ids,
+                 'entries': {str(k): v for k, v in self.entries.items()}}
+        with open(osp.join(self.cache_dir, 'index.json'), 'w') as f:
+            json.dump(index, f)
+        logging.info('Cached features of {} images in {}, {:.1f} MB'.format(
+            len(self.img_ids), self.cache_dir, self.offset * np.dtype(self.dtype).itemsize / 2**20))
+
+
+class FeatureCache(object):
+    '''
+    Reads a complete cache written by FeatureCacheWriter.
+    '''
+    def __init__(self, cache_dir):
+        with open(osp.join(cache_dir, 'index.json')) as f:
+            index = json.load(f)
+        self.fingerprint = index['fingerprint']
+        self.img_ids = index['img_ids']
+        self.batch_ids = index['batch_ids']
+        self.entries = index['entries']
+        self.data = np.memmap(osp.join(cache_dir, 'feats.bin'), dtype=np.dtype(index['dtype']), mode='r')
+
+    @staticmethod
+    def exists(cache_dir, fingerprint=None):
+        index_file = osp.join(cache_dir, 'index.json')
+        if not osp.exists(index_file):
+            return False
+        return fingerprint is None or json.load(open(index_file))['fingerprint'] == fingerprint
+
+    def __len__(self):
+        return len(self.img_ids)
+
+    def load(self, iid):
+        '''
+        Features [C, h, w] of all levels and img_meta of an image.
+        '''
+        entry = self.entries[str(iid)]
+        offset, feats = entry['offset'], []
+        for shape in entry['shapes']:
+            size = int(np.prod(shape))
+            feats.append(torch.from_numpy(self.data[offset:offset+size].astype(np.float32)).view(*shape))
+            offset += size
+        img_meta = dict(entry['img_meta'])
+        for key in ('img_shape', 'pad_shape', 'ori_shape'):
+            img_meta[key] = tuple(img_meta[key])
+        return feats, img_meta
+
+    def batches(self, img_ids=None, device='cpu'):
+        '''
+        Yield (feats, img_metas) in the batches features were computed in, features of images in
+        a batch have the same shapes. img_ids select images(all cached images if None), batches
+        are ordered by their first image in img_ids.
+        '''
+        batch_ids = self.batch_ids
+        if img_ids is not None:
+            pos = {iid: i for i, iid in enumerate(img_ids)}
+            batch_ids = [[iid for iid in ids if iid in pos] for ids in batch_ids]
+            batch_ids = sorted([ids for ids in batch_ids if len(ids) > 0],
+                               key=lambda ids: min(pos[iid] for iid in ids))
+        for ids in batch_ids:
+            loaded = [self.load(iid) for iid in ids]
+            img_metas = [img_meta for _, img_meta in loaded]
+            feats = [torch.stack([img_feats[lvl] for img_feats, _ in loaded]).to(device)
+                     for lvl in range(len(loaded[0][0]))]
+            yield feats, img_metas
@@ -1,6 +1,19 @@
-from .retina_head import RetinaHead
-from .rpn_head import RPNHead
-from .rcnn_head import RCNNHead
-from .double_head import DoubleHead
-from .guided_head import GARPNHead
-from .fcos_head import FCOSHead
+import importlib
+
+# heads are imported on first access, so that dependencies of one head, e.g. mmdet.ops of
+# GARPNHead, are not required by models that do not use it
+_heads_ = {
+    'RetinaHead': '.retina_head',
+    'RPNHead': '.rpn_head',
+    'RCNNHead': '.rcnn_head',
+    'DoubleHead': '.double_head',
+    'GARPNHead': '.guided_head',
+    'FCOSHead': '.fcos_head'
+}
+
+__all__ = list(_heads_.keys())
+
+def __getattr__(name):
+    if name in _heads_:
+        return getattr(importlib.import_module(_heads_[name], __name__), name)
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
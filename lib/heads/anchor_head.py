@@ -2,10 +2,11 @@ from torch import nn
 from ..anchor import AnchorCreator
 from ..region import inside_grid_mask, inside_anchor_mask
 from ..anchor import anchor_target
+from ..assign_cache import AssignCache, assign_key
 from ..utils import class_name
 from .. import losses
-from .. import utils
-import logging, torch
+from .. import utils, dense_targets
+import logging, torch, copy
 
 '''
 Anchor head, as a typical head, takes in some input(features or rois) and does two predictions, 
@@ -48,6 +49,9 @@ class AnchorHead(nn.Module):
 
         self.use_sigmoid=self.loss_cls.use_sigmoid
         self.cls_channels=num_classes-1 if self.use_sigmoid else num_classes
+        self.assign_cache=None
+        # set by dense_targets.install if targets are computed in dataloader workers
+        self.dense_target_key=None
 
     def to(self, device):
         super(AnchorHead, self).to(device)
@@ -66,6 +70,58 @@ class AnchorHead(nn.Module):
     def create_anchors(self, grid_sizes):
         return [actr(self.anchor_strides[i], grid_sizes[i]) for i, actr in enumerate(self.anchor_creators)]
 
+    def get_assign_cache(self, train_cfg):
+        # assign_cache=dict(cache_dir=None) in train_cfg turns on the cross-epoch assignment cache
+        cache_cfg = train_cfg.get('assign_cache', None)
+        if cache_cfg is None:
+            return None
+        if self.assign_cache is None:
+            self.assign_cache = AssignCache(**cache_cfg)
+            logging.info('{} caches anchor assignment, cache_dir={}'.format(
+                class_name(self), self.assign_cache.cache_dir))
+        return self.assign_cache
+
+    # everything besides the image that anchor assignment depends on
+    def assign_cfg(self, train_cfg):
+        return {'anchor_scales': self.anchor_scales, 'anchor_ratios': self.anchor_ratios,
+                'anchor_strides': self.anchor_strides, 'anchor_center_lt': self.anchor_center_lt,
+                'assigner': train_cfg.assigner, 'allowed_border': train_cfg.allowed_border}
+
+    # mask of anchors that are inside image and inside the grid area of image
+    def inside_mask(self, anchors, img_meta, grid_sizes, train_cfg, device):
+        img_size = img_meta['img_shape'][:2]
+        in_img_mask = inside_anchor_mask(anchors, img_size, train_cfg.allowed_border)
+        in_grid_masks = [inside_grid_mask(self.num_anchors, img_size, grid_sizes[lvl], stride, device)
+                         for lvl, stride in enumerate(self.anchor_strides)]
+        in_grid_mask = torch.cat(in_grid_masks)
+        logging.debug('in_img_mask: {}'.format(in_img_mask.sum().item()))
+        logging.debug('in_grid_mask: {}'.format(in_grid_mask.sum().item()))
+        return in_img_mask & in_grid_mask.bool()
+
+    def target_strides(self):
+        return self.anchor_strides
+
+    # what image_targets reads, anchors are created on CPU in workers
+    def target_view(self):
+        anchor_creators = copy.deepcopy(self.anchor_creators)
+        for actr in anchor_creators:
+            actr.to(torch.device('cpu'))
+        return dense_targets.TargetView(type(self), anchor_creators=anchor_creators,
+                                        anchor_strides=self.anchor_strides, num_anchors=self.num_anchors)
+
+    def image_targets(self, grid_sizes, gt_bbox, gt_label, img_meta, input_size, train_cfg, device):
+        '''
+        Labels of inside anchors before sampling, as the assigner gives them to anchor_target.
+        '''
+        from ..builder import build_module
+        anchors = torch.cat([lvl_anchors.view(4, -1) for lvl_anchors in self.create_anchors(grid_sizes)], dim=1)
+        in_mask = self.inside_mask(anchors, img_meta, grid_sizes, train_cfg, device)
+        assigner = train_cfg.assigner
+        if isinstance(assigner, dict):
+            assigner = build_module(assigner)
+        labels, _ = assigner(anchors[:, in_mask], gt_bbox)
+        return (labels, )
+
     def single_image_targets(self, level_cls_outs, level_reg_outs, gt_bbox, gt_label,
                              level_anchors, input_size, grid_sizes, img_meta, train_cfg):
         '''
@@ -79,33 +135,35 @@ class AnchorHead(nn.Module):
         '''
         logging.debug(' {}: find targets for one image '.format(class_name(self)).center(50, '*'))
         device=level_cls_outs[0].device
-        cls_outs = [lvl_cls_out.view(self.cls_channels, -1) for lvl_cls_out in level_cls_outs]
-        reg_outs = [lvl_reg_out.view(4, -1) for lvl_reg_out in level_reg_outs]
-        cls_out = torch.cat(cls_outs, dim=1)
-        reg_out = torch.cat(reg_outs, dim=1)
+        cls_out = utils.concate_grid_channels(level_cls_outs, self.cls_channels)
+        reg_out = utils.concate_grid_channels(level_reg_outs, 4)
         logging.debug('cls_out: {}'.format(cls_out.shape))
         logging.debug('reg_out: {}'.format(reg_out.shape))
         
         anchors = [lvl_anchors.view(4, -1) for lvl_anchors in level_anchors]
         anchors = torch.cat(anchors, dim=1)
         logging.debug('anchors:    {}'.format(anchors.shape))
-        img_size = img_meta['img_shape'][:2]
-        in_img_mask = inside_anchor_mask(anchors, img_size, train_cfg.allowed_border)
-        in_grid_masks = [inside_grid_mask(self.num_anchors, img_size, grid_sizes[lvl], stride, device)
-                         for lvl, stride in enumerate(self.anchor_strides)]
-        in_grid_mask = torch.cat(in_grid_masks)
-        logging.debug('in_img_mask: {}'.format(in_img_mask.sum().item()))
-        logging.debug('in_grid_mask: {}'.format(in_grid_mask.sum().item()))
-        in_mask = in_img_mask & in_grid_mask.bool()
+        in_mask = self.inside_mask(anchors, img_meta, grid_sizes, train_cfg, device)
         in_anchors = anchors[:, in_mask]
 
         logging.debug('in_mask: {}'.format(in_mask.sum().item()))
         logging.debug('in_anchors: {}'.format(in_anchors.shape))
+        # labels before sampling may come from dataloader workers or the assignment cache
+        assigned = dense_targets.precomputed(img_meta, self.dense_target_key, grid_sizes, device)
+        assigned_labels = None if assigned is None else assigned[0]
+        assign_cache, cache_key = None, None
+        if assigned_labels is None:
+            assign_cache = self.get_assign_cache(train_cfg)
+        if assign_cache is not None:
+            cache_key = assign_key(img_meta, grid_sizes, self.assign_cfg(train_cfg))
         tar_cls_out, tar_reg_out, tar_labels, tar_anchors, tar_bbox, tar_param \
             = anchor_target(cls_out, reg_out, self.cls_channels,
                                in_anchors, in_mask, gt_bbox, gt_label,
                                train_cfg.assigner, train_cfg.get('sampler', None),
-                               self.target_means, self.target_stds)
+                               self.target_means, self.target_stds,
+                               assign_cache, cache_key, assigned_labels)
+        if assign_cache is not None:
+            logging.debug(assign_cache.stats())
         logging.debug('after calc targets, pos={}, neg={}'.format((tar_labels==0).sum().item(),
                                                                   (tar_labels> 0).sum().item()))
         return tar_cls_out, tar_reg_out, tar_labels, tar_param
@@ -212,9 +270,10 @@ class AnchorHead(nn.Module):
             level_anchors: [4, 9, 152, 100], [4, 9, 76, 50], ...
         '''
         logging.info(' {}: predict one image '.format(class_name(self)).center(50, '*'))
-        cls_outs = [lvl_cls_out.view(self.cls_channels, -1) for lvl_cls_out in level_cls_outs]
-        reg_outs = [lvl_reg_out.view(4, -1) for lvl_reg_out in level_reg_outs]
-        anchors = [anchor.view(4, -1) for anchor in level_anchors]
+        # [n, A, H*W] views work for both contiguous and channels_last outputs
+        cls_outs = [utils.grid_channels_view(x, self.cls_channels) for x in level_cls_outs]
+        reg_outs = [utils.grid_channels_view(x, 4) for x in level_reg_outs]
+        anchors = [anchor.view(4, self.num_anchors, -1) for anchor in level_anchors]
         num_levels = len(level_cls_outs)
         device = level_cls_outs[0].device
         img_size = img_meta['img_shape'][:2]
@@ -229,15 +288,19 @@ class AnchorHead(nn.Module):
                 cls_score = cls_out.sigmoid()
             else:
                 cls_score = cls_out.softmax(dim=0)
-            if test_cfg.pre_nms > 0 and test_cfg.pre_nms < cls_score.shape[1]:
+            if test_cfg.pre_nms > 0 and test_cfg.pre_nms < cls_score[0].numel():
                 if self.use_sigmoid:
                     max_score, _ = cls_score.max(0)
                 else:
-                    max_score, _ = cls_score[1:, :].max(0)
-                _, topk_inds = max_score.topk(test_cfg.pre_nms)
-                cls_score = cls_score[:, topk_inds]
-                reg_out = reg_out[:, topk_inds]
-                anchor = anchor[:, topk_inds]
+                    max_score, _ = cls_score[1:].max(0)
+                _, topk_inds = max_score.reshape(-1).topk(test_cfg.pre_nms)
+                cls_score = utils.take_grid_channels(cls_score, topk_inds)
+                reg_out = utils.take_grid_channels(reg_out, topk_inds)
+                anchor = utils.take_grid_channels(anchor, topk_inds)
+            else:
+                cls_score = cls_score.reshape(cls_score.shape[0], -1)
+                reg_out = reg_out.reshape(4, -1)
+                anchor = anchor.reshape(4, -1)
             pred_bbox = utils.param2bbox(anchor, reg_out, self.target_means, self.target_stds, img_size)
             if min_size > 0:
                 non_small = (pred_bbox[2]-pred_bbox[0] + 1 >= min_size) \
@@ -248,6 +311,9 @@ class AnchorHead(nn.Module):
             pred_bboxes.append(pred_bbox)
         mlvl_cls_score = torch.cat(cls_scores, dim=1)
         mlvl_pred_bbox = torch.cat(pred_bboxes, dim=1)
+        return self.nms_single_image(mlvl_pred_bbox, mlvl_cls_score, test_cfg)
+
+    def nms_single_image(self, mlvl_pred_bbox, mlvl_cls_score, test_cfg):
         if self.use_sigmoid:
             nms_label_set = list(range(0, self.num_classes-1))
             label_adjust = 1
@@ -261,6 +327,60 @@ class AnchorHead(nn.Module):
         keep_label += label_adjust
         return keep_bbox.t(), keep_score, keep_label
 
+    def predict_dense(self, cls_outs, reg_outs, img_sizes, scale_factors, test_cfg):
+        '''
+        The static part of prediction, it selects pre_nms candidates on each level and decodes
+        them for all images at once. Shapes of outputs only depend on shapes of inputs and it
+        has no python side effects, so it can be compiled or traced with the rest of the network.
+
+        Args:
+            cls_outs: list(Tensor) [2, 180, 100, 152], ...
+            reg_outs: list(Tensor) [2, 36, 100, 152], ...
+            img_sizes: [N, 2], (h, w) of images, unused since bboxes are clamped in predict_post
+            scale_factors: [N], unused since small bboxes are removed in predict_post
+        Returns:
+            bboxes: [N, 4, K], decoded bboxes of K candidates of all levels
+            scores: [N, cls_channels, K]
+        '''
+        _ = [ac.to(cls_outs[0].device) for ac in self.anchor_creators]
+        level_anchors = self.create_anchors([cls_out.shape[-2:] for cls_out in cls_outs])
+        bboxes, scores = [], []
+        for cls_out, reg_out, anchor in zip(cls_outs, reg_outs, level_anchors):
+            num_imgs = cls_out.shape[0]
+            cls_out = utils.grid_channels_view(cls_out, self.cls_channels)
+            reg_out = utils.grid_channels_view(reg_out, 4)
+            anchor = anchor.view(4, -1)
+            cls_score = cls_out.sigmoid() if self.use_sigmoid else cls_out.softmax(dim=1)
+            max_score, _ = (cls_score if self.use_sigmoid else cls_score[:, 1:]).max(1)
+            max_score = max_score.reshape(num_imgs, -1)
+            k = max_score.shape[1]
+            if test_cfg.pre_nms > 0:
+                k = min(test_cfg.pre_nms, k)
+            _, topk_inds = max_score.topk(k, dim=1)
+            cls_score = utils.take_grid_channels(cls_score, topk_inds)
+            reg_out = utils.take_grid_channels(reg_out, topk_inds)
+            # decode all images at once as [4, N*k]
+            param = reg_out.permute(1, 0, 2).reshape(4, -1)
+            anchor = anchor[:, topk_inds.view(-1)]
+            bbox = utils.param2bbox(anchor, param, self.target_means, self.target_stds)
+            bboxes.append(bbox.view(4, num_imgs, k).permute(1, 0, 2))
+            scores.append(cls_score)
+        return torch.cat(bboxes, dim=2), torch.cat(scores, dim=2)
+
+    def predict_post(self, bboxes, scores, img_metas, test_cfg):
+        '''
+        The data dependent part of prediction: clamp, remove small bboxes and nms for each image.
+        '''
+        preds = []
+        for bbox, score, img_meta in zip(bboxes, scores, img_metas):
+            bbox = utils.clamp_bbox(bbox, img_meta['img_shape'][:2])
+            min_size = img_meta['scale_factor'] * test_cfg.min_bbox_size
+            if min_size > 0:
+                non_small = (bbox[2]-bbox[0] + 1 >= min_size) & (bbox[3]-bbox[1] + 1 >= min_size)
+                bbox, score = bbox[:, non_small], score[:, non_small]
+            preds.append(self.nms_single_image(bbox, score, test_cfg))
+        return utils.unpack_multi_result(preds)
+
     def predict_bboxes(self, feats, img_metas, test_cfg):
         cls_outs, reg_outs = self.forward(feats)
         return self.predict_bboxes_from_output(cls_outs, reg_outs, img_metas, test_cfg)
@@ -119,6 +119,15 @@ class BBoxHead(nn.Module):
                                    img_meta['img_shape'] if img_meta is not None else None)
         return refined
 
+    # decoded bboxes before nms: bbox [4*num_classes, n] or [4, n] if reg_class_agnostic, score [n, num_classes]
+    def decode_bboxes_single_image(self, props, cls_out, reg_out, img_size=None):
+        if self.use_sigmoid:
+            raise NotImplementedError('Need to be implemented')
+        score = cls_out.softmax(dim=1)
+        bbox = utils.batched_param2bbox(
+            props, reg_out.t(), self.target_means, self.target_stds, img_size)
+        return bbox, score
+
     def predict_bboxes_single_image(self, props, cls_out, reg_out, img_size=None, cfg=None):
         logging.info('{}: predict_bboxes_single_image'.format(class_name(self)))
         logging.debug('props: {}'.format(props.shape))
@@ -127,17 +136,7 @@ class BBoxHead(nn.Module):
         logging.debug('img_size: {}'.format(img_size))
         logging.debug('self.reg_class_agnostic: {}'.format(self.reg_class_agnostic))
         with torch.no_grad():
-            n_props = cls_out.shape[0]
-            if self.use_sigmoid:
-                raise NotImplementedError('Need to be implemented')
-                sig = cls_out.sigmoid()
-                score, label = sig.max(dim=1)
-                label += 1
-            else:
-                score = cls_out.softmax(dim=1)
-                _, label = score.max(dim=1)
-            preds = utils.batched_param2bbox(
-                props, reg_out.t(), self.target_means, self.target_stds, img_size)
+            preds, score = self.decode_bboxes_single_image(props, cls_out, reg_out, img_size)
             nms_mode = cfg.get('nms_type', 'official')
             preds, score, label = utils.multiclass_nms(
                 preds.t(), score, range(1, self.num_classes), cfg.nms_iou, cfg.min_score,
@@ -6,8 +6,10 @@ from .. import debug
 import logging, torch
 import torch.nn.functional as F
 from mmcv.cnn import normal_init, constant_init
+from ..builder import register_module
 
 
+@register_module()
 class DoubleHead(BBoxHead):
     def __init__(self,
                  in_channels,
@@ -110,8 +112,7 @@ class DoubleHead(BBoxHead):
     def forward(self, rois):
         roi_sizes = [roi.shape[0] for roi in rois]
         x = torch.cat(rois, dim=0)
-        batch_size = x.shape[0]
-        fc_x = x.view(batch_size, -1)
+        fc_x = x.flatten(1)
         fc_x = self.fc_layer(fc_x)
         fc_cls_out = self.fc_classifier(fc_x)
 
@@ -126,7 +127,7 @@ class DoubleHead(BBoxHead):
             conv_x_max_h, _  = conv_x.max(dim=-2, keepdim=True)
             conv_x = conv_x_max_w + conv_x_max_h
             
-        conv_x = conv_x.view(batch_size, -1)
+        conv_x = conv_x.flatten(1)
 
         conv_x = self.reg_fc_layer(conv_x)
         conv_reg_out = self.conv_regressor(conv_x)
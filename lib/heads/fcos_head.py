@@ -2,45 +2,11 @@ from torch import nn
 from mmcv.cnn import normal_init
 from collections import OrderedDict
 import numpy as np
-import logging, torch
-
-from .. import utils, debug, region, anchor, losses
-
-# turn length representation to class representation, according to paper Generalized Focal Loss
-def length2class(length, cls_channels, stride):
-    '''
-    length: a tensor of length
-    cls_channels: integer, number of discretization
-    stride: real number, size of the discretization length
-    '''
-    len_shape = length.shape
-    len_flat = length.view(-1).float()
-    numel = len_flat.numel()
-    max_len = (cls_channels - 1) * stride
-    len_flat = len_flat.clamp(0, max_len)
-    left_pt = (len_flat / stride).long() 
-    right_pt = left_pt + 1
-    left_bound, right_bound = left_pt * stride, right_pt * stride
-    right_prob = (len_flat - left_bound) / stride
-    left_prob = (right_bound - len_flat) / stride
-    distr = len_flat.new_full((numel, cls_channels), 0, dtype=torch.float)
-    distr[torch.arange(numel), left_pt] = left_prob
-    distr[torch.arange(numel), right_pt] = right_prob
-    return distr.view(*len_shape, -1), left_pt
-
-# turn class representation to length representation, according to paper Generalized Focal Loss
-def class2length(cls_score, stride):
-    '''
-    cls_score: [..., cls_channels], i.e. cls channels are in the last dim
-    stride: real number
-    '''
-    cls_channels = cls_score.shape[-1]
-    cls_shape = cls_score.shape[:-1]
-    cls_flat = cls_score.view(-1, cls_channels)
-    rand_var = cls_score.new([i*stride for i in range(cls_channels)])
-    inner_prod = (cls_score * rand_var).sum(-1)
-    return inner_prod
+import logging, torch, copy
 
+from .. import utils, debug, region, anchor, losses, dense_targets
+from ..losses import length2bins, length2class, class2length
+from ..builder import register_module
 
 # create tensor of shape [grid_heigh, grid_width, dim] with all values equal to 'value'
 def make_level_blanks(grids, dim, value, dtype, device):
@@ -60,18 +26,19 @@ def centerness(ltrb):
 
 # transform from ltrb representation to xyxy representation
 # ltrb: [grid_h, grid_w, 4]
+# ltrb: [4, h, w] or batched [N, 4, h, w]
 def ltrb2bbox(ltrb, stride):
-    grid_size = ltrb.shape[1:]
+    grid_size = ltrb.shape[-2:]
     full_idx = utils.full_index(grid_size).to(
         device=ltrb.device, dtype=ltrb.dtype)
     
     coor = full_idx * stride + stride / 2
     bbox = torch.stack([
-        coor[:, :, 1] - ltrb[0, :, :],
-        coor[:, :, 0] - ltrb[1, :, :],
-        ltrb[2, :, :] + coor[:, :, 1],
-        ltrb[3, :, :] + coor[:, :, 0]
-    ])
+        coor[:, :, 1] - ltrb[..., 0, :, :],
+        coor[:, :, 0] - ltrb[..., 1, :, :],
+        ltrb[..., 2, :, :] + coor[:, :, 1],
+        ltrb[..., 3, :, :] + coor[:, :, 0]
+    ], dim=-3)
     return bbox
 
 # transform xyxy representation to ltrb representation
@@ -86,12 +53,14 @@ def bbox2ltrb(bbox, grid, stride):
     ], dim=-1)
     return ltrb
 
-# 
-def paint_value(canvas, bbox, scale, val):
-    bbox = bbox * scale
-    bbox = bbox.round().long()
-    canvas[bbox[1]:bbox[3]+1, bbox[0]:bbox[2]+1] = val
-    return canvas
+# paint 0 to the image area of all levels of [h, w, 1] targets
+def paint_image_area(tars, img_w, img_h, scales):
+    num_lvl = len(tars)
+    device = tars[0].device
+    bboxes = torch.tensor([[0, 0, img_w, img_h]], dtype=torch.float, device=device).t().repeat(1, num_lvl)
+    levels = torch.arange(num_lvl, device=device)
+    region.paint_regions([tar[..., 0] for tar in tars], bboxes, levels, levels.new_zeros(num_lvl), scales)
+    return tars
 
 # with center (x, y)
 def simple_ltrb2bbox(ltrb, ctr_xy):
@@ -121,6 +90,7 @@ TODO:
 We mix FCOS, ATSS, Generalized Focal Loss(QFL, DFL) in one FCOSHead, which can be chaotic.
 The logic is that GFL only support ATSS, and one can use QFL, DFL or both.
 '''
+@register_module()
 class FCOSHead(nn.Module):
     def __init__(self,
                  num_classes=21,
@@ -137,7 +107,8 @@ class FCOSHead(nn.Module):
                  loss_cls=None,
                  loss_bbox=None,
                  loss_dfl=None,
-                 loss_centerness=None):
+                 loss_centerness=None,
+                 with_cp=False):
         super(FCOSHead, self).__init__()
         from ..builder import build_module
         # common settings
@@ -145,6 +116,9 @@ class FCOSHead(nn.Module):
         self.cls_channels=num_classes-1
         self.in_channels=in_channels
         self.stacked_convs=stacked_convs
+        self.with_cp=with_cp
+        # set by dense_targets.install if targets are computed in dataloader workers
+        self.dense_target_key=None
         self.feat_channels=feat_channels
         self.strides=strides
         self.anchor_center_lt=anchor_center_lt
@@ -185,7 +159,8 @@ class FCOSHead(nn.Module):
             assert self.use_dfl
             self.loss_bbox = None
         else:
-            assert loss_bbox.type == 'GIoULoss', 'Bbox loss only support GIoULoss for FCOSHead'
+            assert loss_bbox.type in ('GIoULoss', 'IoULoss', 'DIoULoss', 'CIoULoss'), \
+                'Bbox loss only support IoU family losses for FCOSHead'
             self.loss_bbox=build_module(loss_bbox)
 
         # check if use DFL
@@ -264,8 +239,9 @@ class FCOSHead(nn.Module):
         logging.info('Initialized weights for RetinaHead.')
 
     def forward(self, xs):
-        cls_conv_outs = [self.cls_convs(x) for x in xs]
-        reg_conv_outs = [self.reg_convs(x) for x in xs]
+        # with_cp only keeps inputs of the conv towers for backward
+        cls_conv_outs = [utils.checkpoint(self.cls_convs, x, enabled=self.with_cp) for x in xs]
+        reg_conv_outs = [utils.checkpoint(self.reg_convs, x, enabled=self.with_cp) for x in xs]
         cls_outs = [self.fcos_cls(x) for x in cls_conv_outs]
         ctr_outs = [self.fcos_center(x) for x in reg_conv_outs]
         if self.use_dfl:
@@ -280,15 +256,41 @@ class FCOSHead(nn.Module):
                         for i, x in enumerate(reg_conv_outs)]
         return cls_outs, reg_outs, ctr_outs
 
-    def single_image_targets_atss(self, cls_outs, reg_outs, ctr_outs,
-                                  lvl_anchors, gt_bboxes, gt_labels, img_meta, train_cfg):
+    def target_strides(self):
+        return self.strides
+
+    # what image_targets reads, anchors are created on CPU in workers
+    def target_view(self):
+        attrs = {'strides': self.strides, 'use_atss': self.use_atss}
+        if self.use_atss:
+            anchor_creators = copy.deepcopy(self.anchor_creators)
+            for actr in anchor_creators:
+                actr.to(torch.device('cpu'))
+            attrs.update(anchor_creators=anchor_creators, atss_cfg=self.atss_cfg)
+        else:
+            attrs.update(level_scale_thr=self.level_scale_thr)
+        return dense_targets.TargetView(type(self), **attrs)
+
+    def create_anchors(self, grids):
+        return tuple(self.anchor_creators[i](stride, grids[i]).squeeze() for i, stride in enumerate(self.strides))
+
+    def image_targets(self, grids, gt_bboxes, gt_labels, img_meta, input_size, train_cfg, device,
+                      lvl_anchors=None):
+        '''
+        cls_tars, reg_tars, ctr_tars of one image, each a list of [h, w, c] maps of levels.
+        '''
+        if self.use_atss:
+            if lvl_anchors is None:
+                lvl_anchors = self.create_anchors(grids)
+            return self.single_image_targets_atss(grids, lvl_anchors, gt_bboxes, gt_labels, img_meta,
+                                                  train_cfg, device)
+        return self.single_image_targets(grids, gt_bboxes, gt_labels, img_meta, train_cfg, device)
+
+    def single_image_targets_atss(self, grids, lvl_anchors, gt_bboxes, gt_labels, img_meta, train_cfg, device):
         logging.debug('Use ATSS to find targets'.center(50, '*'))
         logging.debug('GT lables for current image: {}'.format(gt_labels.tolist()))
         logging.debug('GT bboxes for current image: {}'.format(gt_bboxes.tolist()))
-        assert len(cls_outs) == len(reg_outs) \
-            == len(self.strides) == len(lvl_anchors) 
-        device = cls_outs[0].device
-        grids = [x.shape[-2:] for x in cls_outs]
+        assert len(grids) == len(self.strides) == len(lvl_anchors)
         img_size = img_meta['img_shape'][:2]
         img_h, img_w = img_size
         scales = [1/stride for stride in self.strides]
@@ -303,11 +305,8 @@ class FCOSHead(nn.Module):
         max_ious = make_level_blanks(grids, 1,  0, dtype=torch.float, device=device)
 
         # then find areas inside image
-        for i in range(num_lvl):
-            paint_value(cls_tars[i], torch.tensor([0, 0, img_w, img_h], dtype=torch.float),
-                        scales[i], 0)
-            paint_value(ctr_tars[i], torch.tensor([0, 0, img_w, img_h], dtype=torch.float),
-                        scales[i], 0)
+        paint_image_area(cls_tars, img_w, img_h, scales)
+        paint_image_area(ctr_tars, img_w, img_h, scales)
 
         # assign positive grids on each level for each gt, we assign centerness later
         for i in range(num_gt):
@@ -368,11 +367,8 @@ class FCOSHead(nn.Module):
         return cls_tars, reg_tars, ctr_tars
 
 
-    def single_image_targets(self, cls_outs, reg_outs, ctr_outs,
-                             gt_bboxes, gt_labels, img_meta, train_cfg):
+    def single_image_targets(self, grids, gt_bboxes, gt_labels, img_meta, train_cfg, device):
         gt_bboxes, gt_labels = utils.sort_bbox(gt_bboxes, labels=gt_labels, descending=True)
-        device = cls_outs[0].device
-        grids = [x.shape[-2:] for x in cls_outs]
         img_size = img_meta['img_shape'][:2]
         img_h, img_w = img_meta['img_shape'][:2]
         scales = [1/stride for stride in self.strides]
@@ -386,11 +382,8 @@ class FCOSHead(nn.Module):
         ctr_tars = make_level_blanks(grids, 1, -1, dtype=torch.float, device=device) 
 
         # then find areas inside image
-        for i in range(num_lvl):
-            paint_value(cls_tars[i], torch.tensor([0, 0, img_w, img_h], dtype=torch.float),
-                        scales[i], 0)
-            paint_value(ctr_tars[i], torch.tensor([0, 0, img_w, img_h], dtype=torch.float),
-                        scales[i], 0)
+        paint_image_area(cls_tars, img_w, img_h, scales)
+        paint_image_area(ctr_tars, img_w, img_h, scales)
 
         # assign positive grids on each level for each gt, we assign centerness later
         for i in range(num_gt):
@@ -460,7 +453,7 @@ class FCOSHead(nn.Module):
             cls_channels = self.loss_dfl.cls_channels
             stride = self.loss_dfl.stride
             pos_reg_tars = pos_reg_tars.contiguous().view(-1) # [4, m ] to [4m], ltrb
-            _, left_idx = length2class(pos_reg_tars, cls_channels, stride) # [4m, 16]
+            left_idx, _, _ = length2bins(pos_reg_tars, cls_channels, stride) # [4m]
             pos_reg_outs = pos_reg_outs.view(cls_channels, -1).t() # [16*4, m] to [16, 4m] to [4m, 16]
             dfl_loss = self.loss_dfl(pos_reg_outs, pos_reg_tars, left_idx,
                                      weight=cls_as_weight.repeat(4).view(-1), avg_factor=4.0) 
@@ -473,7 +466,7 @@ class FCOSHead(nn.Module):
         else:
             if self.use_dfl:
                 stride = self.loss_dfl.stride
-                pos_reg_out_ltrb = class2length(pos_reg_outs.softmax(-1), stride).view(4, -1) # [4m] to [4, m]
+                pos_reg_out_ltrb = class2length(pos_reg_outs, stride, logits=True).view(4, -1) # [4m] to [4, m]
                 pos_reg_tar_ltrb = pos_reg_tars.view(4, -1) # [4m] to [4, m]
                 pos_reg_out_simple = simple_ltrb2bbox(pos_reg_out_ltrb, (0.0, 0.0))
                 pos_reg_tar_simple = simple_ltrb2bbox(pos_reg_tar_ltrb, (0.0, 0.0))
@@ -533,37 +526,32 @@ class FCOSHead(nn.Module):
             ctr_outs_img = utils.split_by_image(ctr_outs)
 
         device = feats[0].device
-        grids = [x.shape[-2:] for x in cls_outs_img[0]]
+        grids = tuple(tuple(x.shape[-2:]) for x in cls_outs_img[0])
 
         input_size = utils.input_size(img_metas)
         logging.debug('Input size infered: '.format(input_size))
 
-        if self.use_atss:
-            _ = [x.to(device=device) for x in self.anchor_creators]
-            lvl_anchors = tuple((
-                self.anchor_creators[i](stride, grids[i]).squeeze() \
-                for i, stride in enumerate(self.strides)
-            ))
-            tars = utils.unpack_multi_result(utils.multi_apply(
-                self.single_image_targets_atss,
-                cls_outs_img,
-                reg_outs_img,
-                ctr_outs_img,
-                lvl_anchors,
-                gt_bboxes,
-                gt_labels,
-                img_metas,
-                train_cfg))
-        else:
-            tars = utils.unpack_multi_result(utils.multi_apply(
-                self.single_image_targets,
-                cls_outs_img,
-                reg_outs_img,
-                ctr_outs_img,
-                gt_bboxes,
-                gt_labels,
-                img_metas,
-                train_cfg))
+        # targets of images may be computed in dataloader workers already
+        img_tars = [dense_targets.precomputed(img_meta, self.dense_target_key, grids, device)
+                    for img_meta in img_metas]
+        todo = [i for i, img_tar in enumerate(img_tars) if img_tar is None]
+        if len(todo) > 0:
+            lvl_anchors = None
+            if self.use_atss:
+                _ = [x.to(device=device) for x in self.anchor_creators]
+                lvl_anchors = self.create_anchors(grids)
+            todo_tars = utils.multi_apply(self.image_targets,
+                                          grids,
+                                          [gt_bboxes[i] for i in todo],
+                                          [gt_labels[i] for i in todo],
+                                          [img_metas[i] for i in todo],
+                                          tuple(input_size),
+                                          train_cfg,
+                                          device,
+                                          lvl_anchors)
+            for i, img_tar in zip(todo, todo_tars):
+                img_tars[i] = img_tar
+        tars = utils.unpack_multi_result(img_tars)
         tars = [cls_outs_img, reg_outs_img, ctr_outs_img] + list(tars)
         return self.calc_loss(*tars)
 
@@ -579,10 +567,10 @@ class FCOSHead(nn.Module):
             if self.use_dfl:
                 lvl_reg_out = reg_outs[i] # [16*4, m, n]
                 lvl_grid_size = lvl_reg_out.shape[-2:] # [m, n]
-                lvl_reg_out = lvl_reg_out.view(self.loss_dfl.cls_channels, -1).t()
-                # from [16*4, m, n] to [16, 4*m*n] to [4*m*n, 16]
-                lvl_reg_out = lvl_reg_out.softmax(-1)
-                lvl_ltrb = class2length(lvl_reg_out, self.loss_dfl.stride) # [4*m*n]
+                lvl_reg_out = utils.grid_channels_view(lvl_reg_out, self.loss_dfl.cls_channels)
+                # from [16*4, m, n] to [16, 4, m*n] to [4, m*n, 16], no copy for channels_last
+                lvl_reg_out = lvl_reg_out.permute(1, 2, 0)
+                lvl_ltrb = class2length(lvl_reg_out, self.loss_dfl.stride, logits=True) # [4, m*n]
                 lvl_ltrb = lvl_ltrb * self.reg_std + self.reg_mean
                 lvl_ltrb = lvl_ltrb.view(4, *lvl_grid_size)
                 bbox = ltrb2bbox(lvl_ltrb, self.strides[i])
@@ -619,6 +607,9 @@ class FCOSHead(nn.Module):
         mlvl_score = torch.cat(scores, dim=1)
         mlvl_bbox  = torch.cat(bboxes, dim=1)
         mlvl_ctr = torch.cat(centerness, dim=1).view(-1) if use_center else None
+        return self.nms_single_image(mlvl_bbox, mlvl_score, mlvl_ctr, test_cfg)
+
+    def nms_single_image(self, mlvl_bbox, mlvl_score, mlvl_ctr, test_cfg):
         nms_label_set = list(range(0, self.cls_channels))
         label_adjust = 1
 
@@ -650,3 +641,72 @@ class FCOSHead(nn.Module):
 
     def predict_bboxes_from_output(self):
         pass
+
+    def predict_dense(self, cls_outs, reg_outs, ctr_outs, img_sizes, scale_factors, test_cfg):
+        '''
+        The static part of prediction, it decodes all levels of all images at once and selects
+        pre_nms candidates among bboxes that are not too small. Shapes of outputs only depend on
+        shapes of inputs and it has no python side effects, so it can be compiled or traced with
+        the rest of the network.
+
+        Args:
+            img_sizes: [N, 2], (h, w) of images
+            scale_factors: [N], scale factors of images
+        Returns:
+            bboxes: [N, 4, K], clamped bboxes of K candidates of all levels
+            scores: [N, cls_channels, K]
+            ctr_scores: [N, K], all ones if centerness is not used
+            valid: [N, K], False for small bboxes that only fill up places of topk
+        '''
+        num_imgs = cls_outs[0].shape[0]
+        dtype = cls_outs[0].dtype
+        max_x = img_sizes[:, 1].view(-1, 1).to(dtype) - 1
+        max_y = img_sizes[:, 0].view(-1, 1).to(dtype) - 1
+        min_size = (scale_factors * test_cfg.min_bbox_size).view(-1, 1).to(dtype)
+        bboxes, scores, ctr_scores, valid = [], [], [], []
+        for i in range(len(cls_outs)):
+            grid_size = cls_outs[i].shape[-2:]
+            if self.use_dfl:
+                reg_out = utils.grid_channels_view(reg_outs[i], self.loss_dfl.cls_channels)
+                # from [N, 16*4, m, n] to [N, 16, 4, m*n] to [N, 4, m*n, 16]
+                reg_out = reg_out.permute(0, 2, 3, 1)
+                ltrb = class2length(reg_out, self.loss_dfl.stride, logits=True)
+                ltrb = ltrb * self.reg_std + self.reg_mean
+                ltrb = ltrb.view(num_imgs, 4, *grid_size)
+            else:
+                ltrb = reg_outs[i] * self.reg_std + self.reg_mean
+            x1, y1, x2, y2 = ltrb2bbox(ltrb, self.strides[i]).reshape(num_imgs, 4, -1).unbind(1)
+            x1, x2 = torch.min(x1.clamp(min=0.0), max_x), torch.min(x2.clamp(min=0.0), max_x)
+            y1, y2 = torch.min(y1.clamp(min=0.0), max_y), torch.min(y2.clamp(min=0.0), max_y)
+            non_small = (x2-x1 + 1 > min_size) & (y2-y1 + 1 > min_size)
+            bbox = torch.stack([x1, y1, x2, y2], dim=1)
+            score = cls_outs[i].sigmoid().reshape(num_imgs, self.cls_channels, -1)
+            if self.use_centerness:
+                ctr_score = ctr_outs[i].sigmoid().reshape(num_imgs, -1)
+                max_score, _ = (score * ctr_score.unsqueeze(1)).max(1)
+            else:
+                ctr_score = score.new_ones(num_imgs, score.shape[-1])
+                max_score, _ = score.max(1)
+
+            # same as taking topk after removing small bboxes, which are masked out instead
+            k = max_score.shape[1]
+            if test_cfg.pre_nms > 0:
+                k = min(test_cfg.pre_nms, k)
+            max_score = max_score.masked_fill(~non_small, -1.0)
+            _, topk_inds = max_score.topk(k, dim=1)
+            bboxes.append(bbox.gather(2, topk_inds.unsqueeze(1).expand(-1, 4, -1)))
+            scores.append(score.gather(2, topk_inds.unsqueeze(1).expand(-1, self.cls_channels, -1)))
+            ctr_scores.append(ctr_score.gather(1, topk_inds))
+            valid.append(non_small.gather(1, topk_inds))
+        return torch.cat(bboxes, dim=2), torch.cat(scores, dim=2), \
+            torch.cat(ctr_scores, dim=1), torch.cat(valid, dim=1)
+
+    def predict_post(self, bboxes, scores, ctr_scores, valid, img_metas, test_cfg):
+        '''
+        The data dependent part of prediction: nms for each image.
+        '''
+        preds = []
+        for bbox, score, ctr_score, img_valid in zip(bboxes, scores, ctr_scores, valid):
+            ctr_score = ctr_score[img_valid] if self.use_centerness else None
+            preds.append(self.nms_single_image(bbox[:, img_valid], score[:, img_valid], ctr_score, test_cfg))
+        return utils.unpack_multi_result(preds)
@@ -4,9 +4,10 @@ from mmdet.ops.dcn import DeformConv
 from mmcv.cnn import normal_init
 import logging, torch
 import torchvision.ops as tvops
-from .. import debug, utils, region, losses
+from .. import debug, utils, region, losses, dense_targets
 from ..utils import multi_apply, unpack_multi_result
 from ..anchor import anchor_target
+from ..builder import register_module
 
 
 # not used
@@ -38,6 +39,14 @@ def paint_bbox(canvas, bbox, scale, bbox_val):
     canvas[:, bbox[1]:bbox[3]+1, bbox[0]:bbox[2]+1] = bbox_val.view(4, 1, 1)
     return canvas
 
+# the center part of bboxes [4, n] with width and height times ratio
+def center_region(bbox, ratio):
+    x1, y1, x2, y2 = bbox.float()
+    w, h = x2 - x1 + 1, y2 - y1 + 1
+    w, h = w*ratio, h*ratio
+    ctr_x, ctr_y = (x2 + x1) / 2, (y2 + y1) / 2
+    return torch.stack([ctr_x - w/2, ctr_y - h/2, ctr_x + w/2, ctr_y + h/2])
+
 # it is actually multi-level guided anchor
 class GuidedAnchor(nn.Module):
     def __init__(self,
@@ -64,6 +73,8 @@ class GuidedAnchor(nn.Module):
         self.deformable_groups=deformable_groups
         self.sigma=sigma
         self.loc_filter_thr=loc_filter_thr
+        # set by dense_targets.install when workers compute loc targets
+        self.dense_target_key=None
         
         from ..builder import build_module
         self.loss_loc=build_module(loss_loc)
@@ -206,23 +217,12 @@ class GuidedAnchor(nn.Module):
         tar_bboxes = [so.new_full([4] + list(so.shape[-2:]), 0, dtype=torch.float, device=device) \
                      for so in shape_outs]
 
-        debug_tar_places = []
-        for i in range(gt_bbox.shape[1]):
-            lvl = gt_lvl[i]
-            bbox = gt_bbox[:, i]
-            x1, y1, x2, y2 = bbox.float()
-            w, h = x2-x1+1, y2-y1+1
-            w, h = w*ctr_ratio, h*ctr_ratio
-            ctr_x, ctr_y = (x2+x1)/2, (y2+y1)/2
-            ctr_bbox = torch.tensor([ctr_x-w/2, ctr_y-h/2, ctr_x+w/2, ctr_y+h/2], dtype=torch.float)
-            paint_value(tar_masks[lvl], ctr_bbox, scales[lvl], 1)
-            debug_tar_places.append(tar_masks[lvl].sum().item())
-            # TODO: do we do the following instead?
-            # tar_bboxes[lvl][:, tar_masks[lvl]] = bbox
-            # TODO: what order should we paint bbox values to tar_bboxes?
-            # Stride from low to hight or inverse?
-            paint_bbox(tar_bboxes[lvl], ctr_bbox, scales[lvl], bbox)
-        logging.debug('target places for each gt: {}'.format(debug_tar_places))
+        # TODO: what order should we paint bbox values to tar_bboxes?
+        # Stride from low to hight or inverse?
+        ctr_bbox = center_region(gt_bbox, ctr_ratio)
+        region.paint_regions(tar_masks, ctr_bbox, gt_lvl, gt_lvl.new_ones(gt_lvl.shape), scales)
+        region.paint_regions(tar_bboxes, ctr_bbox, gt_lvl, gt_bbox.float(), scales)
+        logging.debug('target places for each level: {}'.format([tm.sum().item() for tm in tar_masks]))
         # tar_bboxes: [[4, 200, 300], [4, 100, 150], ...]
         # tar_masks:  [[200, 300], [100, 150], ...]
         tar_masks  = [tm.view(-1) for tm in tar_masks]
@@ -281,21 +281,11 @@ class GuidedAnchor(nn.Module):
         in_mask = torch.cat(in_masks)
 
         # now we want to find the anchor(out of 9 anchors) that overlap gt
-        # the most for all grid position
-        max_ious = []
-        for i in range(num_anchors):
-            cur_anchor = anchors[:, i, :]
-            iou_tab = utils.calc_iou(gt_bbox, cur_anchor)
-            max_iou, max_gt_idx = iou_tab.max(dim=0)
-            max_ious.append(max_iou)
-        max_ious = torch.stack(max_ious) # [9, 80297]
-        # find out which anchor overlaps the most with gt
-        max_iou_with_gt, max_anchor_with_gt = max_ious.max(0)
-        max_anchors = anchors[:, max_anchor_with_gt, torch.arange(anchors.shape[-1])]
+        # the most for all grid position inside image, the assigner reuses their ious
+        in_anchors, iou_tab = region.approx_max_iou(anchors[:, :, in_mask.bool()], gt_bbox)
 
         assigner = build_module(cfg.ga_assigner)
-        in_anchors = max_anchors[:, in_mask.bool()]
-        labels, overlap_ious = assigner(in_anchors, gt_bbox)
+        labels, overlap_ious = assigner(in_anchors, gt_bbox, iou_tab)
         sampler = cfg.ga_sampler
         if sampler is not None:
             if isinstance(sampler, dict):
@@ -350,13 +340,31 @@ class GuidedAnchor(nn.Module):
         '''
         loc_outs = [lo.squeeze() for lo in loc_outs]
         device = loc_outs[0].device
+        grid_sizes = tuple(tuple(lo.shape[-2:]) for lo in loc_outs)
+        # targets may be computed in dataloader workers already
+        targets = dense_targets.precomputed(img_meta, self.dense_target_key, grid_sizes, device)
+        if targets is None:
+            targets = self.image_targets(grid_sizes, gt_bbox, gt_label, img_meta, input_size, cfg, device)
+        return targets[0], loc_outs
+
+    def target_strides(self):
+        return self.anchor_strides
+
+    # what image_targets reads
+    def target_view(self):
+        return dense_targets.TargetView(type(self), anchor_strides=self.anchor_strides,
+                                        anchor_scales=self.anchor_scales)
+
+    def image_targets(self, grid_sizes, gt_bbox, gt_label, img_meta, input_size, cfg, device):
+        '''
+        Loc targets of levels: -1 ignore, 0 negative and 1 positive.
+        '''
         scales = [1.0 / x for x in self.anchor_strides]
-        num_lvls = len(loc_outs)
+        num_lvls = len(grid_sizes)
         img_size = img_meta['img_shape'][:2]
-        grid_sizes = [lo.shape[-2:] for lo in loc_outs]
 
         # first set all targets to -1 which is ignore, this mainly targets out-of-grid locations
-        targets = [lo.new_full(lo.shape[-2:], -1, dtype=torch.long) for lo in loc_outs]
+        targets = [torch.full(grid_size, -1, dtype=torch.long, device=device) for grid_size in grid_sizes]
         
         # then set all in grid areas to 0 which is negative
         in_masks = [region.inside_grid_mask(1, input_size, img_size, grid_size, device)
@@ -367,34 +375,19 @@ class GuidedAnchor(nn.Module):
 
         gt_lvl = region.map_gt2level(self.anchor_scales[0], self.anchor_strides, gt_bbox)
         logging.debug('mapped gt in levels: {}'.format(gt_lvl))
-        # second set all ignore areas
-        ig_thr = cfg.ignore_ratio
-        for i in range(gt_bbox.shape[1]):
-            lvl = gt_lvl[i]
-            bbox = gt_bbox[:, i]
-            x1, y1, x2, y2 = bbox.float()
-            w, h = x2 - x1 + 1, y2 - y1 + 1
-            w, h = w*cfg.ignore_ratio, h*cfg.ignore_ratio
-            ctr_x, ctr_y = (x2 + x1) / 2, (y2 + y1) / 2
-            ig_bbox = [ctr_x - w/2, ctr_y - h/2, ctr_x + w/2, ctr_y + h/2]
-            ig_bbox = torch.tensor(ig_bbox, dtype=torch.float)
-            paint_value(targets[lvl], ig_bbox, scales[lvl], -1)
-            if lvl - 1 >= 0:
-                paint_value(targets[lvl-1], ig_bbox, scales[lvl-1], -1)
-            if lvl + 1 <  num_lvls:
-                paint_value(targets[lvl+1], ig_bbox, scales[lvl+1], -1)
-        # third, set all positive areas
-        for i in range(gt_bbox.shape[1]):
-            lvl = gt_lvl[i]
-            bbox = gt_bbox[:, i]
-            x1, y1, x2, y2 = bbox
-            w, h = x2 - x1 + 1, y2 - y1 + 1
-            w, h = w*cfg.center_ratio, h*cfg.center_ratio
-            ctr_x, ctr_y = (x2 + x1) / 2, (y2 + y1) / 2
-            ctr_bbox = [ctr_x - w/2, ctr_y - h/2, ctr_x + w/2, ctr_y + h/2]
-            ctr_bbox = torch.tensor(ctr_bbox, dtype=torch.float)
-            paint_value(targets[lvl], ctr_bbox, scales[lvl], 1)
-        return targets, loc_outs
+        # second set all ignore areas, on the gt level and its neighbours
+        ig_bbox = center_region(gt_bbox, cfg.ignore_ratio)
+        ig_lvl = torch.cat([gt_lvl - 1, gt_lvl, gt_lvl + 1])
+        ig_keep = (ig_lvl >= 0) & (ig_lvl < num_lvls)
+        ig_bbox, ig_lvl = ig_bbox.repeat(1, 3)[:, ig_keep], ig_lvl[ig_keep]
+        # third, set all positive areas, they are painted after and over ignore areas
+        ctr_bbox = center_region(gt_bbox, cfg.center_ratio)
+        region.paint_regions(targets,
+                             torch.cat([ig_bbox, ctr_bbox], dim=1),
+                             torch.cat([ig_lvl, gt_lvl]),
+                             torch.cat([ig_lvl.new_full(ig_lvl.shape, -1), gt_lvl.new_ones(gt_lvl.shape)]),
+                             scales)
+        return (targets, )
     
     # finished
     def forward(self, feats):
@@ -457,6 +450,7 @@ class GuidedAnchor(nn.Module):
 
 
 
+@register_module()
 class GARPNHead(nn.Module):
     def __init__(self,
                  in_channels=256,
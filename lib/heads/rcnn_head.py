@@ -3,8 +3,10 @@ from .. import utils
 from ..utils import init_module_normal
 from torch import nn
 import logging, torch
+from ..builder import register_module
 
 
+@register_module()
 class RCNNHead(BBoxHead):
     def __init__(self,
                  in_channels,
@@ -78,7 +80,7 @@ class RCNNHead(BBoxHead):
         x = torch.cat(rois, dim=0)
         if self.with_avg_pool:
             x = self.avg_pool(x)
-        x = x.view(x.shape[0], -1)
+        x = x.flatten(1)
         if self.with_shared_fcs:
             x = self.shared_fcs(x)
         cls_out = self.classifier(x)
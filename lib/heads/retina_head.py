@@ -3,7 +3,10 @@ from .anchor_head import AnchorHead
 from mmcv.cnn import normal_init
 import numpy as np
 import logging
+from ..builder import register_module
+from .. import utils
 
+@register_module()
 class RetinaHead(AnchorHead):
     def __init__(self,
                  num_classes,
@@ -18,13 +21,15 @@ class RetinaHead(AnchorHead):
                  target_means=[0.0, 0.0, 0.0, 0.0],
                  target_stds=[1.0, 1.0, 1.0, 1.0],
                  loss_cls=None,
-                 loss_bbox=None):
+                 loss_bbox=None,
+                 with_cp=False):
         self.in_channels = in_channels
         self.feat_channels = feat_channels
         self.num_classes = num_classes
         self.cls_channels = num_classes-1
 
         self.stacked_convs = stacked_convs
+        self.with_cp = with_cp
         self.octave_base_scale = octave_base_scale
         self.scales_per_octave = scales_per_octave
         octave_scales = [2**(i/scales_per_octave) for i in range(scales_per_octave)]
@@ -85,8 +90,9 @@ class RetinaHead(AnchorHead):
 
 
     def forward(self, xs):
-        cls_conv_outs = [self.cls_convs(x) for x in xs]
-        reg_conv_outs = [self.reg_convs(x) for x in xs]
+        # with_cp only keeps inputs of the conv towers for backward
+        cls_conv_outs = [utils.checkpoint(self.cls_convs, x, enabled=self.with_cp) for x in xs]
+        reg_conv_outs = [utils.checkpoint(self.reg_convs, x, enabled=self.with_cp) for x in xs]
         cls_outs = [self.retina_cls(x) for x in cls_conv_outs]
         reg_outs = [self.retina_reg(x) for x in reg_conv_outs]
         return cls_outs, reg_outs
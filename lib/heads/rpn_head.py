@@ -6,7 +6,9 @@ import logging, torch
 import torchvision.ops as tvops
 from ..utils import class_name
 from .. import utils
+from ..builder import register_module
 
+@register_module()
 class RPNHead(AnchorHead):
     def __init__(self,
                  in_channels,
@@ -68,9 +70,10 @@ class RPNHead(AnchorHead):
     def predict_single_image(self, level_cls_outs, level_reg_outs, level_anchors, img_meta, test_cfg):
         logging.info(' {}: predict one image '.format(class_name(self)).center(50, '*'))
         logging.info('img_meta: {}'.format(img_meta))
-        cls_outs = [lvl_cls_out.view(self.cls_channels, -1) for lvl_cls_out in level_cls_outs]
-        reg_outs = [lvl_reg_out.view(4, -1) for lvl_reg_out in level_reg_outs]
-        anchors = [anchor.view(4, -1) for anchor in level_anchors]
+        # [n, A, H*W] views work for both contiguous and channels_last outputs
+        cls_outs = [utils.grid_channels_view(x, self.cls_channels) for x in level_cls_outs]
+        reg_outs = [utils.grid_channels_view(x, 4) for x in level_reg_outs]
+        anchors = [anchor.view(4, self.num_anchors, -1) for anchor in level_anchors]
         num_levels = len(level_cls_outs)
         device = level_cls_outs[0].device
         img_size = img_meta['img_shape'][:2]
@@ -88,11 +91,15 @@ class RPNHead(AnchorHead):
                 cls_soft = cls_out.softmax(dim=0)
                 cls_score = cls_soft[1]
             
+            cls_score = cls_score.reshape(-1)
             if test_cfg.pre_nms > 0 and test_cfg.pre_nms < len(cls_score):
                 _, topk_inds = cls_score.topk(test_cfg.pre_nms)
                 cls_score = cls_score[topk_inds]
-                reg_out = reg_out[:, topk_inds]
-                anchor  = anchor[:, topk_inds]
+                reg_out = utils.take_grid_channels(reg_out, topk_inds)
+                anchor  = utils.take_grid_channels(anchor, topk_inds)
+            else:
+                reg_out = reg_out.reshape(4, -1)
+                anchor  = anchor.reshape(4, -1)
             pred_bbox = utils.param2bbox(anchor, reg_out, self.target_means, self.target_stds, img_size)
             if min_size > 0:
                 non_small = (pred_bbox[2]-pred_bbox[0] + 1 >= min_size) \
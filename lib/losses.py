@@ -3,6 +3,7 @@ import torch, logging
 import torch.nn.functional as F
 from . import utils
 import numpy as np
+from .builder import register_module
 
 def iou_loss(a, b):
     assert a.shape == b.shape and a.shape[0]==b.shape[0]==4
@@ -30,6 +31,110 @@ def giou_loss(a, b):
     return 1 - giou
 
 
+class IoULossFunction(torch.autograd.Function):
+    '''
+    Per box loss of the IoU family with the analytic gradient of pred, target gets no gradient.
+    Boxes are x1, y1, x2, y2 along box_dim, e.g. [n, 4] with box_dim=-1 or [4, n] with box_dim=0,
+    widths have no +1, same as giou_loss. The mode is one of
+        iou:  -log(iou)
+        giou: 1 - iou + (C - U) / C, C the area of the enclosing box, U the union
+        diou: 1 - iou + d^2 / c^2, d the distance of centers, c the diagonal of the enclosing box
+        ciou: diou + a * v, v = 4/pi^2 * (atan(w_g/h_g) - atan(w/h))^2, a = v / (1 - iou + v) is
+              taken as a constant as in the paper
+    Only boxes are saved, backward recomputes the few [n] terms it needs.
+    '''
+    @staticmethod
+    def forward(ctx, pred, target, mode, box_dim, eps):
+        ctx.save_for_backward(pred, target)
+        ctx.setting = (mode, box_dim, eps)
+        return IoULossFunction.terms(pred, target, mode, box_dim, eps, grad=False)
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        pred, target = ctx.saved_tensors
+        mode, box_dim, eps = ctx.setting
+        grads = IoULossFunction.terms(pred, target, mode, box_dim, eps, grad=True)
+        grad = torch.stack([g * grad_loss for g in grads], dim=box_dim % pred.dim())
+        return grad.to(pred.dtype), None, None, None, None
+
+    @staticmethod
+    def terms(pred, target, mode, box_dim, eps, grad):
+        '''
+        The loss if grad is False, otherwise gradients of x1, y1, x2, y2 of pred.
+        '''
+        dtype = torch.promote_types(pred.dtype, torch.float)
+        x1, y1, x2, y2 = pred.to(dtype).unbind(box_dim)
+        gx1, gy1, gx2, gy2 = target.to(dtype).unbind(box_dim)
+        w, h = x2 - x1, y2 - y1
+        iw = torch.min(x2, gx2) - torch.max(x1, gx1)
+        ih = torch.min(y2, gy2) - torch.max(y1, gy1)
+        overlap = (iw > 0) & (ih > 0)
+        inter = torch.where(overlap, iw * ih, torch.zeros_like(iw))
+        union = w * h + (gx2 - gx1) * (gy2 - gy1) - inter
+        iou = inter / union
+        if mode != 'iou':
+            cw = torch.max(x2, gx2) - torch.min(x1, gx1)
+            ch = torch.max(y2, gy2) - torch.min(y1, gy1)
+        if mode in ('diou', 'ciou'):
+            dx, dy = (x1 + x2 - gx1 - gx2) / 2, (y1 + y2 - gy1 - gy2) / 2
+            diag = cw * cw + ch * ch + eps
+            dist = dx * dx + dy * dy
+        if mode == 'ciou':
+            angle = torch.atan2(gx2 - gx1, gy2 - gy1) - torch.atan2(w, h)
+            v = 4 / np.pi ** 2 * angle * angle
+            alpha = v / (1 - iou + v + eps)
+        if not grad:
+            if mode == 'iou':
+                return -iou.log()
+            if mode == 'giou':
+                area_c = cw * ch
+                return 1 - iou + (area_c - union) / area_c
+            loss = 1 - iou + dist / diag
+            return loss + alpha * v if mode == 'ciou' else loss
+
+        # derivatives of inter, union and the enclosing box with respect to x1, y1, x2, y2
+        zero = torch.zeros_like(iw)
+        d_inter = [torch.where(overlap & (x1 > gx1), -ih, zero), torch.where(overlap & (y1 > gy1), -iw, zero),
+                   torch.where(overlap & (x2 < gx2), ih, zero), torch.where(overlap & (y2 < gy2), iw, zero)]
+        d_union = [-h - d_inter[0], -w - d_inter[1], h - d_inter[2], w - d_inter[3]]
+        d_iou = [(di - iou * du) / union for di, du in zip(d_inter, d_union)]
+        if mode == 'iou':
+            return [-d / iou for d in d_iou]
+        d_cw = [-(x1 < gx1).to(dtype), zero, (x2 > gx2).to(dtype), zero]
+        d_ch = [zero, -(y1 < gy1).to(dtype), zero, (y2 > gy2).to(dtype)]
+        if mode == 'giou':
+            area_c = cw * ch
+            # loss = 2 - iou - union / area_c
+            return [-di - du / area_c + union * (dcw * ch + dch * cw) / (area_c * area_c)
+                    for di, du, dcw, dch in zip(d_iou, d_union, d_cw, d_ch)]
+        d_dist = [dx, dy, dx, dy]
+        grads = [-di + dd / diag - dist * 2 * (cw * dcw + ch * dch) / (diag * diag)
+                 for di, dd, dcw, dch in zip(d_iou, d_dist, d_cw, d_ch)]
+        if mode == 'ciou':
+            # d atan(w/h) = (h*dw - w*dh) / (w^2 + h^2)
+            k = alpha * 8 / np.pi ** 2 * angle / (w * w + h * h + eps)
+            grads = [grads[0] + k * h, grads[1] - k * w, grads[2] - k * h, grads[3] + k * w]
+        return grads
+
+
+def iou_family_loss(pred, target, mode='giou', box_dim=-1, eps=1e-7):
+    '''
+    Per box loss [n] of IoULossFunction, it falls back to autograd of giou_loss/iou_loss when
+    target needs gradient.
+
+    Args:
+        pred, target: [n, 4] with box_dim=-1, or [4, n] with box_dim=0
+    '''
+    assert mode in ('iou', 'giou', 'diou', 'ciou')
+    assert pred.shape == target.shape and pred.shape[box_dim] == 4
+    if target.requires_grad:
+        assert mode in ('iou', 'giou'), 'target of {} loss can not have gradient'.format(mode)
+        if box_dim != 0:
+            pred, target = pred.transpose(0, box_dim), target.transpose(0, box_dim)
+        return iou_loss(pred, target) if mode == 'iou' else giou_loss(pred, target)
+    return IoULossFunction.apply(pred, target, mode, box_dim, eps).to(pred.dtype)
+
+
 def sigmoid_focal_loss(pred, target, alpha=0.25, gamma=2.0, fix_alpha=False):
     '''
     Args:
@@ -61,6 +166,104 @@ def sigmoid_focal_loss(pred, target, alpha=0.25, gamma=2.0, fix_alpha=False):
     return focal_loss.sum()
 
 
+class SigmoidFocalLossFunction(torch.autograd.Function):
+    '''
+    Sum of sigmoid focal loss over all elements of logits, computed from integer labels and
+    optional soft targets(quality) of labelled elements.
+
+    Each element is first taken as a negative, labels then correct the one positive element of
+    their rows, so no one-hot target is built. Rows are processed in chunks of chunk_size and
+    only logits and targets are saved, backward recomputes the analytic gradient chunk by chunk
+    into the gradient of logits. With p = sigmoid(x), q the target of a positive(1 if no
+    quality) and d = p - q:
+        negative: loss = -alpha_neg * p^gamma * log(1-p)
+                  grad =  alpha_neg * p^gamma * (p - gamma*(1-p)*log(1-p))
+        positive: loss =  alpha_pos * |d|^gamma * bce(x, q)
+                  grad =  alpha_pos * (gamma*|d|^(gamma-1)*sign(d)*p*(1-p)*bce(x, q) + |d|^gamma * d)
+    where bce(x, q) = -q*log(p) - (1-q)*log(1-p). Focal loss is q=1, quality focal loss of GFL is
+    alpha=1 with q the IoU.
+    '''
+    @staticmethod
+    def forward(ctx, pred, target, quality, alpha_pos, alpha_neg, gamma, chunk_size):
+        ctx.save_for_backward(pred, target, quality)
+        ctx.setting = (alpha_pos, alpha_neg, gamma, chunk_size)
+        # half logits are computed in float
+        dtype = torch.promote_types(pred.dtype, torch.float)
+        loss = pred.new_zeros((), dtype=dtype)
+        for start in range(0, pred.shape[0], chunk_size):
+            x = pred[start:start+chunk_size].to(dtype)
+            rows, cols, x_pos, q = positive_elements(x, target, quality, start, chunk_size)
+            # -log(1-p) = softplus(x), -log(p) = softplus(-x)
+            neg = x.sigmoid().pow_(gamma).mul_(F.softplus(x))
+            neg[rows, cols] = 0
+            loss += alpha_neg * neg.sum()
+            d = x_pos.sigmoid() - q
+            loss += alpha_pos * (d.abs().pow(gamma) * (F.softplus(-x_pos) + (1 - q) * x_pos)).sum()
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        pred, target, quality = ctx.saved_tensors
+        alpha_pos, alpha_neg, gamma, chunk_size = ctx.setting
+        dtype = torch.promote_types(pred.dtype, torch.float)
+        grad = torch.empty_like(pred)
+        for start in range(0, pred.shape[0], chunk_size):
+            x = pred[start:start+chunk_size].to(dtype)
+            rows, cols, x_pos, q = positive_elements(x, target, quality, start, chunk_size)
+            p = x.sigmoid()
+            g = (1 - p).mul_(F.softplus(x)).mul_(gamma).add_(p).mul_(p.pow(gamma)).mul_(alpha_neg)
+            p_pos = x_pos.sigmoid()
+            d = p_pos - q
+            bce = F.softplus(-x_pos) + (1 - q) * x_pos
+            # d^(gamma-1) is not finite at d=0 for gamma < 1, where the product is 0
+            focal_grad = torch.where(d != 0, gamma * d.abs().pow(gamma - 1) * d.sign(), torch.zeros_like(d))
+            g[rows, cols] = alpha_pos * (focal_grad * p_pos * (1 - p_pos) * bce + d.abs().pow(gamma) * d)
+            grad[start:start+chunk_size] = g.mul_(grad_loss)
+        return grad, None, None, None, None, None, None
+
+
+def positive_elements(x, target, quality, start, chunk_size):
+    '''
+    Rows, columns, logits and targets of positive elements in rows [start, start+chunk_size),
+    label 0 is background and has none.
+    '''
+    target = target[start:start+chunk_size]
+    rows = torch.nonzero(target > 0).squeeze(1)
+    cols = target[rows] - 1
+    x_pos = x[rows, cols]
+    q = x_pos.new_ones(len(rows)) if quality.numel() == 0 else quality[start:start+chunk_size][rows].to(x.dtype)
+    return rows, cols, x_pos, q
+
+
+def sigmoid_focal_loss_fused(pred, target, alpha=0.25, gamma=2.0, fix_alpha=False, chunk_size=16384):
+    '''
+    Same as sigmoid_focal_loss without [n, num_cls] intermediates of all rows, see
+    SigmoidFocalLossFunction. gamma=0 and alpha=1 with fix_alpha is binary cross entropy.
+
+    Args:
+        pred: [n, num_cls]
+        target: [n], where 0 means background
+    '''
+    alpha_neg = alpha if fix_alpha else 1 - alpha
+    loss = SigmoidFocalLossFunction.apply(
+        pred, target.long(), pred.new_zeros(0), alpha, alpha_neg, gamma, chunk_size)
+    return loss.to(pred.dtype)
+
+
+def quality_focal_loss_fused(pred, quality, label, beta=2.0, chunk_size=16384):
+    '''
+    Sum of quality focal loss of GFL, see SigmoidFocalLossFunction.
+
+    Args:
+        pred: [n, num_cls]
+        quality: [n], target of the labelled element of each row
+        label: [n], where 0 means background
+    '''
+    loss = SigmoidFocalLossFunction.apply(
+        pred, label.long(), quality.detach(), 1.0, 1.0, beta, chunk_size)
+    return loss.to(pred.dtype)
+
+
 def zero_loss(device):
     return torch.tensor(0.0, device=device, requires_grad=True)
 
@@ -99,14 +302,18 @@ def normalize_weight(filt_weight, bias):
         bloss.append(torch.abs(bnorm-1)/num_b)
     return sum(wloss), sum(bloss)
 
+@register_module()
 class FocalLoss(nn.Module):
-    def __init__(self, alpha=0.25, gamma=2.0, use_sigmoid=True, loss_weight=1.0):
+    def __init__(self, alpha=0.25, gamma=2.0, use_sigmoid=True, loss_weight=1.0, fused=True, chunk_size=16384):
         assert use_sigmoid == True, 'FocalLoss for non sigmoid is not implemented'
         super(FocalLoss, self).__init__()
         self.use_sigmoid=True
         self.alpha=0.25
         self.gamma=2.0
         self.loss_weight=1.0
+        # fused: use sigmoid_focal_loss_fused, which keeps no [n, num_cls] intermediates
+        self.fused=fused
+        self.chunk_size=chunk_size
 
     def forward(self, pred, target):
         '''
@@ -114,8 +321,12 @@ class FocalLoss(nn.Module):
             pred: [n, 20] where 20 is number of class channels
             target: [n] it contains n labels
         '''
+        if self.fused:
+            return self.loss_weight * sigmoid_focal_loss_fused(
+                pred, target, self.alpha, self.gamma, chunk_size=self.chunk_size)
         return self.loss_weight * sigmoid_focal_loss(pred, target, self.alpha, self.gamma)
 
+@register_module()
 class SmoothL1Loss(nn.Module):
     def __init__(self, beta=1.0, loss_weight=1.0):
         super(SmoothL1Loss, self).__init__()
@@ -126,13 +337,18 @@ class SmoothL1Loss(nn.Module):
         return self.loss_weight * smooth_l1_loss_v2(x, y, self.beta)
 
 
+@register_module()
 class CrossEntropyLoss(nn.Module):
     def __init__(self,
                  use_sigmoid=False,
-                 loss_weight=1.0):
+                 loss_weight=1.0,
+                 fused=True,
+                 chunk_size=16384):
         super(CrossEntropyLoss, self).__init__()
         self.use_sigmoid=use_sigmoid
         self.loss_weight=loss_weight
+        self.fused=fused
+        self.chunk_size=chunk_size
 
     def forward(self, pred, label):
         '''
@@ -145,6 +361,10 @@ class CrossEntropyLoss(nn.Module):
             if n_classes == 1:
                 loss = F.binary_cross_entropy_with_logits(pred, label.view(-1, 1).float(), reduction='none')
                 return loss.sum() * self.loss_weight
+            elif self.fused:
+                # binary cross entropy is focal loss with gamma=0 and a weight of 1
+                loss = sigmoid_focal_loss_fused(pred, label, 1.0, 0.0, fix_alpha=True, chunk_size=self.chunk_size)
+                return loss * self.loss_weight
             else:
                 tar_one_hot = utils.one_hot_embedding(label, n_classes+1)
                 tar_one_hot = tar_one_hot[:, 1:]
@@ -167,6 +387,7 @@ def balanced_l1_loss(pred, target, beta=1.0, alpha=0.5, gamma=1.5):
     )
     return loss
 
+@register_module()
 class BalancedL1Loss(nn.Module):
     def __init__(self, alpha=0.5, gamma=1.5, beta=1.0, loss_weight=1.0):
         super(BalancedL1Loss, self).__init__()
@@ -179,6 +400,34 @@ class BalancedL1Loss(nn.Module):
         b_loss = balanced_l1_loss(pred, label, beta=self.beta, alpha=self.alpha, gamma=self.gamma)
         return b_loss.sum() * self.loss_weight
 
+class BoundedIoULossFunction(torch.autograd.Function):
+    '''
+    Sum of smooth l1(beta) of 1 - min(x/y, y/x), the bounded iou of one side, with the analytic
+    gradient of x, y gets no gradient.
+    '''
+    @staticmethod
+    def forward(ctx, x, y, beta):
+        ctx.save_for_backward(x, y)
+        ctx.beta = beta
+        dtype = torch.promote_types(x.dtype, torch.float)
+        x, y = x.to(dtype) + 1e-6, y.to(dtype) + 1e-6
+        t = 1 - torch.min(x / y, y / x)
+        return torch.where(t < beta, 0.5 * t * t / beta, t - 0.5 * beta).sum()
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        x, y = ctx.saved_tensors
+        beta = ctx.beta
+        dtype = torch.promote_types(x.dtype, torch.float)
+        x, y = x.to(dtype) + 1e-6, y.to(dtype) + 1e-6
+        smaller = x < y
+        t = 1 - torch.where(smaller, x / y, y / x)
+        # dt/dx is -1/y where t = 1 - x/y, y/x^2 where t = 1 - y/x
+        grad = torch.where(t < beta, t / beta, torch.ones_like(t)) * torch.where(smaller, -1 / y, y / (x * x))
+        return (grad * grad_loss).to(ctx.saved_tensors[0].dtype), None, None
+
+
+@register_module()
 class BoundedIoULoss(nn.Module):
     def __init__(self, beta=0.2, loss_weight=1.0):
         self.beta=beta
@@ -187,35 +436,51 @@ class BoundedIoULoss(nn.Module):
 
     def forward(self, x, y):
         assert x.shape == y.shape
+        if not y.requires_grad:
+            return BoundedIoULossFunction.apply(x, y, self.beta).to(x.dtype)
         x = x + 1e-6
         y = y + 1e-6
         loss = 1-torch.min(x/y, y/x)
         return smooth_l1_loss_v2(loss, loss.new_zeros(loss.size()), self.beta).sum()
 
 
-class GIoULoss(nn.Module):
-    def __init__(self, loss_weight=1.0):
-        super(GIoULoss, self).__init__()
+class IoUFamilyLoss(nn.Module):
+    '''
+    Boxes are [4, n] as other bbox losses unless box_dim=-1 for [n, 4], see iou_family_loss.
+    '''
+    mode = None
+
+    def __init__(self, loss_weight=1.0, box_dim=0, eps=1e-7):
+        super(IoUFamilyLoss, self).__init__()
         self.loss_weight = loss_weight
+        self.box_dim = box_dim
+        self.eps = eps
 
     def forward(self, a, b, weight=None, avg_factor=1.0):
-        loss = giou_loss(a, b)
+        loss = iou_family_loss(a, b, self.mode, self.box_dim, self.eps)
         if weight is not None:
             loss = loss * weight
         return loss.sum() * self.loss_weight / avg_factor
 
-class IoULoss(nn.Module):
-    def __init__(self, loss_weight=1.0):
-        super(IoULoss, self).__init__()
-        self.loss_weight = loss_weight
+
+@register_module()
+class GIoULoss(IoUFamilyLoss):
+    mode = 'giou'
+
+@register_module()
+class IoULoss(IoUFamilyLoss):
+    mode = 'iou'
 
     def forward(self, a, b, weight=None, avg_factor=None):
-        loss = iou_loss(a, b)
-        if weight is not None:
-            loss = loss * weight
-        if avg_factor is not None:
-            loss = loss / avg_factor
-        return loss.sum() * self.loss_weight
+        return super(IoULoss, self).forward(a, b, weight, 1.0 if avg_factor is None else avg_factor)
+
+@register_module()
+class DIoULoss(IoUFamilyLoss):
+    mode = 'diou'
+
+@register_module()
+class CIoULoss(IoUFamilyLoss):
+    mode = 'ciou'
 
 # pred has the same shape as tar, and pred is logits
 def generalized_focal_loss(pred, tar, beta=2.0):
@@ -223,12 +488,16 @@ def generalized_focal_loss(pred, tar, beta=2.0):
     focal_weight = (tar - pred_sig).abs().pow(beta)
     return focal_weight * F.binary_cross_entropy_with_logits(pred, tar, reduction='none')
     
+@register_module()
 class QualityFocalLoss(nn.Module):
-    def __init__(self, beta=2.0, use_sigmoid=True, loss_weight=1.0):
+    def __init__(self, beta=2.0, use_sigmoid=True, loss_weight=1.0, fused=True, chunk_size=16384):
         assert use_sigmoid, 'QualityFocalLoss only support sigmoid activation'
         self.use_sigmoid = use_sigmoid
         self.beta = beta
         self.loss_weight = loss_weight
+        # fused: use quality_focal_loss_fused when there is no element-wise weight
+        self.fused = fused
+        self.chunk_size = chunk_size
         super(QualityFocalLoss, self).__init__()
 
     def forward(self, pred, quality, label, weight=None, avg_factor=1.0):
@@ -237,6 +506,9 @@ class QualityFocalLoss(nn.Module):
         quality: [n], score of each label 
         label: [n], n labels
         '''
+        if self.fused and weight is None:
+            loss = quality_focal_loss_fused(pred, quality, label, self.beta, self.chunk_size)
+            return loss * self.loss_weight / avg_factor
         n, n_cls = pred.shape
         tar = pred.new_full((n, n_cls+1), 0.0)
         tar[torch.arange(n), label] = quality
@@ -253,31 +525,108 @@ def log_softmax_with_logits(logits):
     logits_stable = logits - C.unsqueeze(1)
     return logits_stable - logits_stable.exp().sum(1).log().unsqueeze(1)
             
+# turn length representation to class representation, according to paper Generalized Focal Loss,
+# the sparse form of length2class: left bins of lengths and probabilities of left and right bins
+def length2bins(length, cls_channels, stride):
+    '''
+    length: a tensor of length
+    cls_channels: integer, number of discretization
+    stride: real number, size of the discretization length
+    '''
+    len_flat = length.reshape(-1).float()
+    max_len = (cls_channels - 1) * stride
+    len_flat = len_flat.clamp(0, max_len)
+    # the max length falls in the last bin as its right bound
+    left_pt = (len_flat / stride).long().clamp(max=cls_channels-2)
+    right_prob = (len_flat - left_pt * stride) / stride
+    left_prob = ((left_pt + 1) * stride - len_flat) / stride
+    return left_pt.view(length.shape), left_prob.view(length.shape), right_prob.view(length.shape)
+
+def length2class(length, cls_channels, stride):
+    '''
+    The dense distribution [..., cls_channels] of lengths and left bins, see length2bins.
+    '''
+    left_pt, left_prob, right_prob = [x.reshape(-1) for x in length2bins(length, cls_channels, stride)]
+    numel = left_pt.numel()
+    distr = left_prob.new_zeros((numel, cls_channels))
+    distr[torch.arange(numel), left_pt] = left_prob
+    distr[torch.arange(numel), left_pt+1] = right_prob
+    return distr.view(*length.shape, -1), left_pt
+
+# turn class representation to length representation, according to paper Generalized Focal Loss
+def class2length(cls_score, stride, logits=False):
+    '''
+    cls_score: [..., cls_channels], i.e. cls channels are in the last dim, probabilities or
+               logits if logits=True, which are normalized by softmax first
+    stride: real number
+    '''
+    if logits:
+        cls_score = cls_score.softmax(-1)
+    cls_channels = cls_score.shape[-1]
+    rand_var = torch.arange(cls_channels, dtype=cls_score.dtype, device=cls_score.device) * stride
+    # the expectation as a matmul, no [..., cls_channels] product is made
+    return torch.matmul(cls_score, rand_var)
+
+
+class DistributionFocalLossFunction(torch.autograd.Function):
+    '''
+    Sum of distribution focal loss from logits, i.e. cross entropy of the two bins around
+    targets, with w_l, w_r the weights of left and right bins and lse = logsumexp(x):
+        loss = (w_l + w_r) * lse - w_l * x_l - w_r * x_r
+        grad = (w_l + w_r) * softmax(x) - w_l * onehot(l) - w_r * onehot(l+1)
+    only logits, weights and left bins are saved.
+    '''
+    @staticmethod
+    def forward(ctx, pred, weight, left_idx):
+        dtype = torch.promote_types(pred.dtype, torch.float)
+        x = pred.to(dtype)
+        idx = torch.stack([left_idx, left_idx + 1], dim=1)
+        weight = weight.to(dtype)
+        ctx.save_for_backward(pred, weight, idx)
+        loss = (weight.sum(1) * torch.logsumexp(x, dim=1)).sum() - (weight * x.gather(1, idx)).sum()
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        pred, weight, idx = ctx.saved_tensors
+        dtype = torch.promote_types(pred.dtype, torch.float)
+        grad = pred.to(dtype).softmax(1).mul_(weight.sum(1, keepdim=True))
+        grad.scatter_add_(1, idx, -weight)
+        return grad.mul_(grad_loss).to(pred.dtype), None, None
+
+
+@register_module()
 class DistributionFocalLoss(nn.Module):
-    def __init__(self, cls_channels, stride, norm_prob, loss_weight=1.0):
+    def __init__(self, cls_channels, stride, norm_prob, loss_weight=1.0, fused=True):
         # TODO: the calc of loss does not use strides, it simply store the setting for detectors
         self.stride = stride
         self.cls_channels = cls_channels
         self.loss_weight = loss_weight
         self.norm_prob = norm_prob
+        self.fused = fused
         super(DistributionFocalLoss, self).__init__()        
 
-    def forward(self, pred, y, left_idx, weight=None, avg_factor=1.0):
+    def forward(self, pred, y, left_idx=None, weight=None, avg_factor=1.0):
         '''
         pred:   [n, cls_channels], logits
         y: [n], target value
-        left_idx: [n], left discrete bound next to y
+        left_idx: [n], left discrete bound next to y, it is found by length2bins if None
         '''
         n, n_cls = pred.shape
         stride = self.stride
-        log_sigma = log_softmax_with_logits(pred)
+        if left_idx is None:
+            left_idx, _, _ = length2bins(y, n_cls, stride)
         right_idx = left_idx + 1
         y_left, y_right = left_idx * stride, right_idx * stride
-        left_pred = pred[torch.arange(n), left_idx]
-        right_pred = pred[torch.arange(n), right_idx]
+        if self.fused:
+            bin_weight = torch.stack([y_right - y, y - y_left], dim=1).detach()
+            loss = DistributionFocalLossFunction.apply(pred, bin_weight, left_idx).to(pred.dtype)
+            if self.norm_prob:
+                loss = loss / self.stride
+            return loss * self.loss_weight / avg_factor
+        log_sigma = log_softmax_with_logits(pred)
         loss = (y_right - y) * log_sigma[torch.arange(n), left_idx] \
                + (y - y_left) * log_sigma[torch.arange(n), right_idx]
         if self.norm_prob:
             loss = loss / self.stride
         return -loss.sum() * self.loss_weight / avg_factor
-
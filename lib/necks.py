@@ -2,8 +2,11 @@ import torch, logging
 import torch.nn.functional as F
 from torch import nn
 from mmcv.cnn import xavier_init
+from . import utils
+from .builder import register_module
         
     
+@register_module()
 class FPN(nn.Module):
     def __init__(self,
                  in_channels,
@@ -14,7 +17,8 @@ class FPN(nn.Module):
                  extra_use_convs=False,
                  extra_convs_on_inputs=True,
                  relu_before_extra_convs=False,
-                 with_activation=False):
+                 with_activation=False,
+                 with_cp=False):
         super(FPN, self).__init__()
         assert with_activation is False, 'with_activation is not supported for FPN'
         assert isinstance(in_channels, list)
@@ -35,6 +39,8 @@ class FPN(nn.Module):
         self.extra_use_convs=extra_use_convs
         self.extra_convs_on_inputs=extra_convs_on_inputs
         self.relu_before_extra_convs=relu_before_extra_convs
+        # with_cp recomputes lateral and top-down features in backward
+        self.with_cp=with_cp
 
         
         self.lateral_convs = nn.ModuleList()
@@ -66,15 +72,19 @@ class FPN(nn.Module):
                 xavier_init(m, distribution='uniform')
         logging.info('Initialized weights for neck.')
 
-    def forward(self, inputs):
-        assert len(inputs) == self.num_ins
-        start, end = self.start_level, self.end_level
-        lateral_outs = [self.lateral_convs[i-start](inputs[i]) \
-                        for i in range(start, end)]
+    # lateral, top-down and fpn convs on used input levels
+    def forward_used_levels(self, *used_inputs):
+        lateral_outs = [self.lateral_convs[i](x) for i, x in enumerate(used_inputs)]
         for i in range(self.used_ins-2, -1, -1):
             prev_shape = lateral_outs[i].shape[2:]
             lateral_outs[i] += F.interpolate(lateral_outs[i+1], size=prev_shape, mode='nearest')
-        outs = [self.fpn_convs[i](lateral_outs[i]) for i in range(self.used_ins)]
+        return tuple(self.fpn_convs[i](lateral_outs[i]) for i in range(self.used_ins))
+
+    def forward(self, inputs):
+        assert len(inputs) == self.num_ins
+        start, end = self.start_level, self.end_level
+        outs = list(utils.checkpoint(self.forward_used_levels, *inputs[start:end],
+                                     enabled=self.with_cp))
         if self.num_outs > self.used_ins:
             for i in range(self.used_ins, self.num_outs):
                 if self.extra_use_convs:
@@ -90,6 +100,7 @@ class FPN(nn.Module):
         return outs
 
 
+@register_module()
 class BFP(nn.Module):
     def __init__(self,
                  in_channels=256,
@@ -0,0 +1,378 @@
+import json, logging
+import os.path as osp
+import numpy as np
+
+'''
+Reference post-processing of exported detectors in NumPy, it does not import torch so that
+it can be deployed together with onnxruntime only.
+
+It mirrors the prediction code of the heads: anchor creation, decoding, topk, clamping,
+removing small bboxes and nms. Bboxes are in [4, n] xyxy layout as in the rest of the repo
+and all computation is in float32 so that results match forward_test of the torch model.
+'''
+
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+def softmax(x, axis):
+    e = np.exp(x - x.max(axis=axis, keepdims=True))
+    return e / e.sum(axis=axis, keepdims=True)
+
+# indices of the k largest values in descending order
+def topk_inds(x, k):
+    if k < len(x):
+        inds = np.argpartition(-x, k-1)[:k]
+    else:
+        inds = np.arange(len(x))
+    return inds[np.argsort(-x[inds], kind='stable')]
+
+# same as AnchorCreator, returns anchors [4, A, H, W]
+def create_anchors(base, scales, ratios, center_lt, stride, grid):
+    grid_h, grid_w = grid
+    ws = np.array([base * s * np.sqrt(ar) for s in scales for ar in ratios], dtype=np.float32)
+    hs = np.array([base * s / np.sqrt(ar) for s in scales for ar in ratios], dtype=np.float32)
+    center_h = np.arange(grid_h, dtype=np.float32) * np.float32(stride)
+    center_w = np.arange(grid_w, dtype=np.float32) * np.float32(stride)
+    if not center_lt:
+        center_h, center_w = center_h + np.float32(stride/2), center_w + np.float32(stride/2)
+    mesh_h, mesh_w = np.meshgrid(center_h, center_w, indexing='ij')
+    ws, hs = ws.reshape(-1, 1, 1), hs.reshape(-1, 1, 1)
+    return np.stack([mesh_w - ws/2, mesh_h - hs/2, mesh_w + ws/2, mesh_h + hs/2])
+
+def clamp_bbox(bbox, img_size):
+    H, W = img_size[:2]
+    return np.stack([bbox[0].clip(0.0, W-1),
+                     bbox[1].clip(0.0, H-1),
+                     bbox[2].clip(0.0, W-1),
+                     bbox[3].clip(0.0, H-1)]).astype(np.float32)
+
+# base: [4, n], param: [4, n] or [4, m, n] for m class specific params
+def param2bbox(base, param, means, stds, img_size=None):
+    shape = (4, ) + (1, ) * (param.ndim - 1)
+    param = param * np.array(stds, dtype=np.float32).reshape(shape) \
+        + np.array(means, dtype=np.float32).reshape(shape)
+    base_w, base_h = base[2] - base[0] + 1, base[3] - base[1] + 1
+    ctr_x, ctr_y = (base[2] + base[0]) / 2, (base[3] + base[1]) / 2
+    x, y = param[0] * base_w + ctr_x, param[1] * base_h + ctr_y
+    w, h = np.exp(param[2]) * base_w, np.exp(param[3]) * base_h
+    bbox = np.stack([x - w/2, y - h/2, x + w/2, y + h/2])
+    if img_size is not None:
+        bbox = clamp_bbox(bbox, img_size)
+    return bbox
+
+# same as fcos_head.ltrb2bbox, ltrb: [4, H, W]
+def ltrb2bbox(ltrb, stride):
+    grid_h, grid_w = ltrb.shape[-2:]
+    ys = np.arange(grid_h, dtype=np.float32) * np.float32(stride) + np.float32(stride/2)
+    xs = np.arange(grid_w, dtype=np.float32) * np.float32(stride) + np.float32(stride/2)
+    ys, xs = ys.reshape(-1, 1), xs.reshape(1, -1)
+    return np.stack([xs - ltrb[0], ys - ltrb[1], ltrb[2] + xs, ltrb[3] + ys])
+
+# same as torchvision.ops.nms, bbox: [n, 4], returns indices of kept bboxes by descending score
+def nms(bbox, score, nms_iou):
+    x1, y1, x2, y2 = bbox.T
+    areas = (x2 - x1) * (y2 - y1)
+    order = np.argsort(-score, kind='stable')
+    keep = []
+    while order.size > 0:
+        i, order = order[0], order[1:]
+        keep.append(i)
+        w = (np.minimum(x2[i], x2[order]) - np.maximum(x1[i], x1[order])).clip(min=0)
+        h = (np.minimum(y2[i], y2[order]) - np.maximum(y1[i], y1[order])).clip(min=0)
+        inter = w * h
+        iou = inter / (areas[i] + areas[order] - inter)
+        order = order[iou <= nms_iou]
+    return np.array(keep, dtype=np.int64)
+
+# bbox:[n, 4], score:[n], label:[n]
+def batched_nms(bbox, score, label, nms_iou):
+    if score.size == 0:
+        return bbox, score, label
+    nms_bbox = bbox + (label.astype(np.float32) * bbox.max()).reshape(-1, 1)
+    keep = nms(nms_bbox, score, nms_iou)
+    return bbox[keep], score[keep], label[keep]
+
+# same as utils.multiclass_nms, bbox[n, 4] or [n, 4*cls_channel], score: [n, cls_channel]
+def multiclass_nms(bbox, score, nms_channel, nms_iou, min_score=-1,
+                   max_num=None, score_factor=None, mode='official'):
+    assert mode in ['official', 'strict']
+    num_bbox, cls_channel = score.shape
+    nms_channel = list(nms_channel)
+    simple_bbox = bbox.shape[1] == 4
+    if mode == 'official':
+        label = np.full(score.shape, -1, dtype=np.int64)
+        label[:, nms_channel] = nms_channel
+        if simple_bbox:
+            bbox = np.broadcast_to(bbox[:, None, :], (num_bbox, cls_channel, 4))
+        else:
+            bbox = bbox.reshape(num_bbox, 4, cls_channel).transpose(0, 2, 1)
+        chosen = (score >= min_score) & (label != -1)
+        if score_factor is not None:
+            score = score * score_factor.reshape(num_bbox, -1)
+    else:
+        label = score.argmax(1)
+        score = score.max(1)
+        chosen = np.isin(label, nms_channel)
+        if not simple_bbox:
+            bbox = bbox.reshape(num_bbox, 4, cls_channel)[np.arange(num_bbox), :, label]
+        chosen = (score >= min_score) & chosen
+        if score_factor is not None:
+            score = score * score_factor
+    keep_bbox, keep_score, keep_label = batched_nms(bbox[chosen], score[chosen], label[chosen], nms_iou)
+    if max_num is not None and keep_score.size > max_num:
+        keep_bbox, keep_score, keep_label = keep_bbox[:max_num], keep_score[:max_num], keep_label[:max_num]
+    return keep_bbox, keep_score, keep_label
+
+
+class AnchorHeadPost(object):
+    '''
+    Post-processing of AnchorHead(RetinaHead), same as AnchorHead.predict_single_image.
+    '''
+    def __init__(self, head, test_cfg):
+        self.head = head
+        self.test_cfg = test_cfg
+        self.anchors = {}
+
+    def level_anchors(self, i, grid):
+        key = (i, tuple(grid))
+        if key not in self.anchors:
+            head = self.head
+            self.anchors[key] = create_anchors(
+                head['anchor_base_sizes'][i], head['anchor_scales'], head['anchor_ratios'],
+                head['anchor_center_lt'], head['anchor_strides'][i], grid).reshape(4, -1)
+        return self.anchors[key]
+
+    # cls_outs: [cls_channels*A, H, W] of each level, reg_outs: [4*A, H, W] of each level
+    def decode(self, cls_outs, reg_outs, img_meta):
+        head, test_cfg = self.head, self.test_cfg
+        img_size = img_meta['img_shape'][:2]
+        min_size = img_meta['scale_factor'] * test_cfg['min_bbox_size']
+        cls_scores, pred_bboxes = [], []
+        for i, (cls_out, reg_out) in enumerate(zip(cls_outs, reg_outs)):
+            anchor = self.level_anchors(i, cls_out.shape[-2:])
+            cls_out = cls_out.reshape(head['cls_channels'], -1)
+            reg_out = reg_out.reshape(4, -1)
+            if head['use_sigmoid']:
+                cls_score = sigmoid(cls_out)
+                max_score = cls_score.max(0)
+            else:
+                cls_score = softmax(cls_out, 0)
+                max_score = cls_score[1:].max(0)
+            if test_cfg['pre_nms'] > 0 and test_cfg['pre_nms'] < max_score.size:
+                inds = topk_inds(max_score, test_cfg['pre_nms'])
+                cls_score, reg_out, anchor = cls_score[:, inds], reg_out[:, inds], anchor[:, inds]
+            pred_bbox = param2bbox(anchor, reg_out, head['target_means'], head['target_stds'], img_size)
+            if min_size > 0:
+                non_small = (pred_bbox[2]-pred_bbox[0] + 1 >= min_size) \
+                            & (pred_bbox[3]-pred_bbox[1] + 1 >= min_size)
+                cls_score, pred_bbox = cls_score[:, non_small], pred_bbox[:, non_small]
+            cls_scores.append(cls_score)
+            pred_bboxes.append(pred_bbox)
+        return np.concatenate(pred_bboxes, axis=1), np.concatenate(cls_scores, axis=1)
+
+    def __call__(self, cls_outs, reg_outs, img_meta):
+        bbox, score = self.decode(cls_outs, reg_outs, img_meta)
+        head, test_cfg = self.head, self.test_cfg
+        if head['use_sigmoid']:
+            nms_label_set, label_adjust = range(0, head['num_classes']-1), 1
+        else:
+            nms_label_set, label_adjust = range(1, head['num_classes']), 0
+        keep_bbox, keep_score, keep_label = multiclass_nms(
+            bbox.T, score.T, nms_label_set, test_cfg['nms_iou'], test_cfg['min_score'],
+            test_cfg['max_per_img'], mode=test_cfg.get('nms_type', 'official'))
+        return keep_bbox.T, keep_score, keep_label + label_adjust
+
+
+class RPNHeadPost(AnchorHeadPost):
+    '''
+    Proposals of RPNHead, same as RPNHead.predict_single_image, nms is done on each level.
+    '''
+    def __call__(self, cls_outs, reg_outs, img_meta):
+        head, test_cfg = self.head, self.test_cfg
+        img_size = img_meta['img_shape'][:2]
+        min_size = img_meta['scale_factor'] * test_cfg['min_bbox_size']
+        cls_scores, pred_bboxes = [], []
+        for i, (cls_out, reg_out) in enumerate(zip(cls_outs, reg_outs)):
+            anchor = self.level_anchors(i, cls_out.shape[-2:])
+            cls_out = cls_out.reshape(head['cls_channels'], -1)
+            reg_out = reg_out.reshape(4, -1)
+            cls_score = sigmoid(cls_out[0]) if head['use_sigmoid'] else softmax(cls_out, 0)[1]
+            if test_cfg['pre_nms'] > 0 and test_cfg['pre_nms'] < cls_score.size:
+                inds = topk_inds(cls_score, test_cfg['pre_nms'])
+                cls_score, reg_out, anchor = cls_score[inds], reg_out[:, inds], anchor[:, inds]
+            pred_bbox = param2bbox(anchor, reg_out, head['target_means'], head['target_stds'], img_size)
+            if min_size > 0:
+                non_small = (pred_bbox[2]-pred_bbox[0] + 1 >= min_size) \
+                            & (pred_bbox[3]-pred_bbox[1] + 1 >= min_size)
+                cls_score, pred_bbox = cls_score[non_small], pred_bbox[:, non_small]
+            keep = nms(pred_bbox.T, cls_score, test_cfg['nms_iou'])
+            if test_cfg['post_nms'] > 0:
+                keep = keep[:test_cfg['post_nms']]
+            cls_scores.append(cls_score[keep])
+            pred_bboxes.append(pred_bbox[:, keep])
+        score = np.concatenate(cls_scores)
+        bbox = np.concatenate(pred_bboxes, axis=1)
+        max_num = test_cfg['max_num']
+        if max_num > 0 and score.size > max_num:
+            inds = topk_inds(score, max_num)
+            score, bbox = score[inds], bbox[:, inds]
+        return bbox, score
+
+
+class FCOSHeadPost(object):
+    '''
+    Post-processing of FCOSHead, same as FCOSHead.predict_single_image.
+    '''
+    def __init__(self, head, test_cfg):
+        self.head = head
+        self.test_cfg = test_cfg
+
+    def level_ltrb(self, reg_out):
+        head = self.head
+        if head['use_dfl']:
+            grid_size = reg_out.shape[-2:]
+            n = head['dfl_cls_channels']
+            # from [n*4, H, W] to [4, H*W, n]
+            prob = softmax(reg_out.reshape(n, 4, -1).transpose(1, 2, 0), -1)
+            ltrb = (prob * (np.arange(n, dtype=np.float32) * np.float32(head['dfl_stride']))).sum(-1)
+            return (ltrb * head['reg_std'] + head['reg_mean']).reshape(4, *grid_size)
+        return reg_out * head['reg_std'] + head['reg_mean']
+
+    # cls_outs: [cls_channels, H, W], reg_outs: [4, H, W] or [n*4, H, W], ctr_outs: [1, H, W]
+    def __call__(self, cls_outs, reg_outs, ctr_outs, img_meta):
+        head, test_cfg = self.head, self.test_cfg
+        use_center = head['use_centerness']
+        img_size = img_meta['img_shape'][:2]
+        min_size = img_meta['scale_factor'] * test_cfg['min_bbox_size']
+        bboxes, scores, centerness = [], [], []
+        for i in range(len(cls_outs)):
+            bbox = ltrb2bbox(self.level_ltrb(reg_outs[i]), head['strides'][i]).reshape(4, -1)
+            score = sigmoid(cls_outs[i].reshape(head['cls_channels'], -1))
+            ctr_score = sigmoid(ctr_outs[i].reshape(-1)) if use_center else None
+            bbox = clamp_bbox(bbox, img_size)
+            non_small = (bbox[2]-bbox[0] + 1 > min_size) & (bbox[3]-bbox[1] + 1 > min_size)
+            bbox, score = bbox[:, non_small], score[:, non_small]
+            ctr_score = ctr_score[non_small] if use_center else None
+            if test_cfg['pre_nms'] > 0 and test_cfg['pre_nms'] < score.shape[1]:
+                max_score = (score * ctr_score).max(0) if use_center else score.max(0)
+                inds = topk_inds(max_score, test_cfg['pre_nms'])
+                bbox, score = bbox[:, inds], score[:, inds]
+                ctr_score = ctr_score[inds] if use_center else None
+            bboxes.append(bbox)
+            scores.append(score)
+            centerness.append(ctr_score)
+        bbox = np.concatenate(bboxes, axis=1)
+        score = np.concatenate(scores, axis=1)
+        ctr_score = np.concatenate(centerness) if use_center else None
+        keep_bbox, keep_score, keep_label = multiclass_nms(
+            bbox.T, score.T, range(0, head['cls_channels']), test_cfg['nms_iou'],
+            test_cfg['min_score'], test_cfg['max_per_img'], ctr_score,
+            mode=test_cfg.get('nms_type', 'official'))
+        return keep_bbox.T, keep_score, keep_label + 1
+
+
+class RCNNHeadPost(object):
+    '''
+    Final prediction of the last stage of CascadeRCNN, same as BBoxHead.predict_bboxes_single_image.
+    '''
+    def __init__(self, head, test_cfg):
+        self.head = head
+        self.test_cfg = test_cfg
+
+    # props: [4, n], cls_out: [n, num_classes], reg_out: [n, 4] or [n, 4*num_classes]
+    def __call__(self, props, cls_out, reg_out, img_meta):
+        head, test_cfg = self.head, self.test_cfg
+        score = softmax(cls_out, 1)
+        param = reg_out.T
+        if param.shape[0] > 4:
+            param = param.reshape(4, -1, param.shape[-1])
+            props = props[:, None, :]
+        preds = param2bbox(props, param, head['target_means'], head['target_stds'],
+                           img_meta['img_shape'][:2]).reshape(-1, score.shape[0])
+        keep_bbox, keep_score, keep_label = multiclass_nms(
+            preds.T, score, range(1, head['num_classes']), test_cfg['nms_iou'],
+            test_cfg['min_score'], test_cfg['max_per_img'], mode=test_cfg.get('nms_type', 'official'))
+        return keep_bbox.T, keep_score, keep_label
+
+
+class PostProcessor(object):
+    '''
+    Runs exported graphs and post-processes their outputs in NumPy, see export.py for the graphs.
+
+    Args:
+        meta: meta info written by export_onnx, a dict or a json file
+        run: callable run(graph_name, feeds) -> list of np.ndarray, feeds is a dict of input
+             name to np.ndarray, e.g. OnnxDetector uses onnxruntime sessions
+    '''
+    def __init__(self, meta, run):
+        if isinstance(meta, str):
+            with open(meta) as f:
+                meta = json.load(f)
+        self.meta = meta
+        self.run = run
+        self.detector = meta['detector']
+        self.num_levels = meta['num_levels']
+        test_cfg = meta['test_cfg']
+        if self.detector == 'RetinaNet':
+            self.head_post = AnchorHeadPost(meta['bbox_head'], test_cfg)
+        elif self.detector == 'FCOS':
+            self.head_post = FCOSHeadPost(meta['bbox_head'], test_cfg)
+        elif self.detector == 'CascadeRCNN':
+            self.rpn_post = RPNHeadPost(meta['rpn_head'], test_cfg['rpn'])
+            self.rcnn_post = RCNNHeadPost(meta['rcnn_head'], test_cfg['rcnn'])
+        else:
+            raise ValueError('Unknown detector: {}'.format(self.detector))
+
+    # outputs of a graph are grouped by levels, e.g. [cls_0, .., cls_4, reg_0, .., reg_4]
+    def split_levels(self, outs):
+        L = self.num_levels
+        return [outs[i*L:(i+1)*L] for i in range(len(outs) // L)]
+
+    # img: [N, 3, H, W], returns (bboxes, scores, labels), each is a list over images
+    def forward_test(self, img, img_metas):
+        img = np.ascontiguousarray(img, dtype=np.float32)
+        if self.detector == 'CascadeRCNN':
+            preds = [self.forward_cascade(img[i:i+1], img_meta) for i, img_meta in enumerate(img_metas)]
+        else:
+            level_outs = self.split_levels(self.run('dense', {'img': img}))
+            preds = [self.head_post(*[[x[i] for x in outs] for outs in level_outs], img_meta)
+                     for i, img_meta in enumerate(img_metas)]
+        return tuple(list(x) for x in zip(*preds))
+
+    def forward_cascade(self, img, img_meta):
+        outs = self.run('rpn', {'img': img})
+        feats = outs[:self.meta['num_feats']]
+        cls_outs, reg_outs = self.split_levels(outs[self.meta['num_feats']:])
+        props, _ = self.rpn_post([x[0] for x in cls_outs], [x[0] for x in reg_outs], img_meta)
+        feeds = {'feat_{}'.format(i): feat for i, feat in enumerate(feats)}
+        feeds['props'] = np.ascontiguousarray(props, dtype=np.float32)
+        feeds['img_size'] = np.array(img_meta['img_shape'][:2], dtype=np.float32)
+        # the rcnn graph only takes the inputs it uses
+        cls_out, reg_out, props = self.run('rcnn', {name: feeds[name] for name in self.meta['rcnn_inputs']})
+        return self.rcnn_post(props, cls_out, reg_out, img_meta)
+
+
+class OnnxDetector(PostProcessor):
+    '''
+    Inference of exported graphs with onnxruntime.
+
+    Args:
+        meta_file: json file written by export_onnx, graphs are found next to it
+        providers: onnxruntime execution providers
+    '''
+    def __init__(self, meta_file, providers=('CPUExecutionProvider', )):
+        import onnxruntime as ort
+        with open(meta_file) as f:
+            meta = json.load(f)
+        root = osp.dirname(meta_file)
+        self.sessions = {name: ort.InferenceSession(osp.join(root, filename), providers=list(providers))
+                         for name, filename in meta['graphs'].items()}
+        self.input_names = {name: [x.name for x in session.get_inputs()] for name, session in self.sessions.items()}
+        logging.info('Loaded graphs {} of {}'.format(list(meta['graphs'].values()), meta['detector']))
+        super(OnnxDetector, self).__init__(meta, self.run_session)
+
+    def run_session(self, name, feeds):
+        assert sorted(feeds) == sorted(self.input_names[name]), \
+            'inputs of graph {} are {}, but {} are fed'.format(name, self.input_names[name], sorted(feeds))
+        return self.sessions[name].run(None, feeds)
@@ -0,0 +1,207 @@
+import logging, torch
+import numpy as np
+from torch import nn
+from collections import OrderedDict
+from .backbones import FrozenBN, freeze_bns
+
+'''
+Post-training static int8 quantization of convs for CPU inference.
+
+The detector is quantized by units: conv towers(nn.Sequential of convs, BNs, ReLUs, pools and
+Bottlenecks, e.g. layers of ResNet and conv towers of heads) and single convs outside of them
+(e.g. lateral and output convs of FPN, prediction convs of heads). Each unit is quantized with
+FX graph mode, it takes and returns fp32 tensors, so code between units, e.g. upsampling in
+FPN, box decoding, losses and nms, stays in fp32 and needs no change.
+
+fc layers of rcnn heads are compressed separately by compress_fcs, with dynamic int8
+quantization and/or truncated SVD.
+'''
+
+# leaf modules a quantized conv tower may contain
+TOWER_LEAF_TYPES = (nn.Conv2d, nn.BatchNorm2d, FrozenBN, nn.ReLU, nn.MaxPool2d)
+
+
+def is_conv_tower(module):
+    leaves = [m for m in module.modules() if len(list(m.children())) == 0]
+    return isinstance(module, nn.Sequential) and \
+        all(isinstance(m, TOWER_LEAF_TYPES) for m in leaves) and \
+        any(isinstance(m, nn.Conv2d) for m in leaves)
+
+
+def find_quant_units(module, skip=(), prefix=''):
+    '''
+    Names of units to quantize, modules whose names start with any of skip stay in fp32.
+    '''
+    units = []
+    for name, m in module.named_children():
+        full_name = prefix + name
+        if any(full_name.startswith(s) for s in skip):
+            continue
+        if isinstance(m, nn.Conv2d) or is_conv_tower(m):
+            units.append(full_name)
+        else:
+            units += find_quant_units(m, skip, full_name + '.')
+    return units
+
+
+def replace_module(model, name, new_module):
+    parent_name, _, attr = name.rpartition('.')
+    setattr(model.get_submodule(parent_name), attr, new_module)
+
+
+# inputs of each unit in one forward_test
+def capture_unit_inputs(model, units, img_data, img_metas):
+    inputs, handles = {}, []
+    for name in units:
+        def hook(m, args, name=name):
+            inputs.setdefault(name, args)
+        handles.append(model.get_submodule(name).register_forward_pre_hook(hook))
+    with torch.no_grad():
+        model.forward_test(img_data, img_metas)
+    for h in handles:
+        h.remove()
+    return inputs
+
+
+def calib_batches(dataloader, num_imgs):
+    seen = 0
+    for data in dataloader:
+        if seen >= num_imgs:
+            return
+        img_metas = data['img_meta'].data[0]
+        yield data['img'].data[0], img_metas
+        seen += len(img_metas)
+
+
+def quantize_int8(model, dataloader, num_imgs=100, skip=(), backend='x86'):
+    '''
+    Quantize convs of a detector in place with calibration over num_imgs images of dataloader.
+    Parameters are frozen and BNs are folded into convs first, so the model can only be used
+    for inference on CPU afterwards.
+
+    Args:
+        skip: names of modules that stay in fp32, e.g. ['bbox_head.retina_cls']
+        backend: quantized engine, 'x86', 'fbgemm' or 'qnnpack'
+    Returns:
+        names of quantized units
+    '''
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+
+    model.to('cpu')
+    model.eval()
+    for p in model.parameters():
+        p.requires_grad_(False)
+    freeze_bns(model)
+    units = find_quant_units(model, skip)
+    batches = calib_batches(dataloader, num_imgs)
+    unit_inputs = capture_unit_inputs(model, units, *next(batches))
+
+    units = [name for name in units if name in unit_inputs]
+    for name in units:
+        unit = model.get_submodule(name)
+        # a bare conv is wrapped so that it is a call of a conv module in the traced graph
+        if isinstance(unit, nn.Conv2d):
+            unit = nn.Sequential(unit)
+        replace_module(model, name, prepare_fx(unit, qconfig_mapping, unit_inputs[name]))
+
+    num_calib = 0
+    with torch.no_grad():
+        for img_data, img_metas in calib_batches(dataloader, num_imgs):
+            model.forward_test(img_data, img_metas)
+            num_calib += len(img_metas)
+    logging.info('Calibrated {} units on {} images'.format(len(units), num_calib))
+
+    for name in units:
+        replace_module(model, name, convert_fx(model.get_submodule(name)))
+    logging.info('Quantized units: {}'.format(', '.join(units)))
+    return units
+
+
+def build_calib_dataloader(config, num_imgs, seed=0):
+    '''
+    A dataloader of num_imgs randomly chosen images of the train set, loaded with the test
+    pipeline, i.e. without augmentation.
+    '''
+    from torch.utils.data import Subset
+    from . import datasets
+    dataset = datasets.VOCDataset(
+        ann_file=config.data.train.ann_file,
+        img_prefix=config.data.train.img_prefix,
+        pipeline=config.data.test.pipeline)
+    inds = np.random.RandomState(seed).permutation(len(dataset))[:num_imgs].tolist()
+    return datasets.build_dataloader(Subset(dataset, inds), config.data.test.imgs_per_gpu,
+                                     config.data.test.loader.num_workers, 1, dist=False, shuffle=False)
+
+
+def svd_linear(fc, rank):
+    '''
+    Truncated SVD of a fc layer as in Fast R-CNN: W[out, in] ~ U[out, r] * S[r] * V[in, r]^T is
+    computed as two fc layers in->r->out, which saves compute if r*(in+out) < in*out.
+    '''
+    U, S, Vh = torch.linalg.svd(fc.weight.detach().float(), full_matrices=False)
+    U, S, V = U[:, :rank], S[:rank], Vh[:rank].t()
+    first = nn.Linear(fc.in_features, rank, bias=False)
+    second = nn.Linear(rank, fc.out_features, bias=fc.bias is not None)
+    with torch.no_grad():
+        first.weight.copy_((V * S).t())
+        second.weight.copy_(U)
+        if fc.bias is not None:
+            second.bias.copy_(fc.bias)
+    return nn.Sequential(first, second).to(fc.weight.device)
+
+
+# fc layers of rcnn heads that are compressed by compress_fcs
+RCNN_FC_LAYERS = ('shared_fcs', 'classifier', 'regressor', 'fc_layer', 'fc_classifier')
+
+
+def compress_fcs(model, svd_rank=None, dynamic_int8=False, layers=RCNN_FC_LAYERS):
+    '''
+    Inference time compression of fc layers of bbox heads(RCNNHead, DoubleHead) in place.
+
+    Args:
+        svd_rank: factorize each fc layer with truncated SVD of this rank, fc layers where it
+                  does not save compute are kept, e.g. classifier and regressor for large ranks
+        dynamic_int8: quantize fc layers dynamically to int8, i.e. weights are int8 and
+                      activations are quantized on the fly, it needs no calibration
+        layers: names of fc layers or towers of fc layers in bbox heads
+    Returns:
+        OrderedDict of compressed fc layers, name -> applied transforms, e.g. ['svd', 'int8'],
+        fc layers in towers are named by their index, e.g. rcnn_head.shared_fcs.0
+    '''
+    from .heads.bbox_head import BBoxHead
+    compressed = OrderedDict()
+    for head_name, head in list(model.named_modules()):
+        if not isinstance(head, BBoxHead):
+            continue
+        prefix = head_name + '.' if head_name else ''
+        for layer_name in layers:
+            if not hasattr(head, layer_name):
+                continue
+            layer = getattr(head, layer_name)
+            fcs = [layer] if isinstance(layer, nn.Linear) else list(layer)
+            fc_names = [prefix + layer_name + ('' if isinstance(layer, nn.Linear) else '.{}'.format(i))
+                        for i in range(len(fcs))]
+            if svd_rank is not None:
+                for i, fc in enumerate(fcs):
+                    if not isinstance(fc, nn.Linear) or \
+                       svd_rank * (fc.in_features + fc.out_features) >= fc.in_features * fc.out_features:
+                        continue
+                    fcs[i] = svd_linear(fc, svd_rank)
+                    compressed.setdefault(fc_names[i], []).append('svd')
+                layer = fcs[0] if isinstance(layer, nn.Linear) else nn.Sequential(*fcs)
+            if dynamic_int8:
+                from torch.ao.quantization import quantize_dynamic
+                layer = quantize_dynamic(nn.Sequential(layer) if isinstance(layer, nn.Linear) else layer,
+                                         {nn.Linear}, dtype=torch.qint8)
+                # factorized fc layers are quantized as well
+                for fc, fc_name in zip(fcs, fc_names):
+                    if isinstance(fc, (nn.Linear, nn.Sequential)):
+                        compressed.setdefault(fc_name, []).append('int8')
+            setattr(head, layer_name, layer)
+    logging.info('Compressed fc layers (svd_rank={}, dynamic_int8={}): {}'.format(
+        svd_rank, dynamic_int8, ', '.join('{}({})'.format(name, ' + '.join(transforms))
+                                          for name, transforms in compressed.items())))
+    return compressed
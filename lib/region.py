@@ -5,6 +5,7 @@ import numpy as np
 import time, sys, os
 import os.path as osp
 from . import utils
+from .builder import register_module
 
 # inside grid mask, using img_size, not pad_size
 def inside_grid_mask(num_anchors, img_size, grid_size, stride, device=torch.device('cpu')):
@@ -15,7 +16,95 @@ def inside_grid_mask(num_anchors, img_size, grid_size, stride, device=torch.devi
     flags[:, :in_h, :in_w] = 1
     return flags.view(-1)
 
-    
+
+def paint_regions(canvases, bboxes, levels, values, scales, priority=None, chunk_size=32):
+    '''
+    Paint many boxes into per level target maps in one pass, it gives the same maps as painting
+    them one by one with paint_value/paint_bbox of the heads, i.e. box is scaled to the level,
+    rounded and painted inclusive of both ends, later boxes paint over earlier ones.
+
+    Args:
+        canvases: list of [H, W] or [c, H, W] maps, one per level, painted in place
+        bboxes: [4, n] boxes in image coordinates
+        levels: [n] the level each box is painted to
+        values: [n] or [c, n] the value each box paints
+        scales: scale of each level, e.g. 1/stride
+        priority: [n], boxes of higher priority paint over lower ones regardless of order,
+                  within the same priority the later box wins
+        chunk_size: number of boxes compared against a level grid at a time
+    Returns:
+        canvases
+    '''
+    n = bboxes.shape[1]
+    if n == 0:
+        return canvases
+    device = canvases[0].device
+    levels = levels.to(device)
+    scales = torch.tensor(scales, dtype=torch.float, device=device)
+    bboxes = (bboxes.to(device).float() * scales[levels]).round().long()
+    # negative starts are clipped to 0, ends beyond the grid never match
+    bboxes[:2] = bboxes[:2].clamp(min=0)
+    values = values.to(device)
+
+    # rank boxes by (priority, order), the highest rank covering a place wins
+    order = torch.arange(n, device=device)
+    if priority is not None:
+        order = torch.sort(priority.to(device), stable=True)[1]
+    rank = torch.empty_like(order)
+    rank[order] = torch.arange(1, n+1, device=device)
+
+    for lvl, canvas in enumerate(canvases):
+        idx = torch.nonzero(levels == lvl).view(-1)
+        if idx.numel() == 0:
+            continue
+        h, w = canvas.shape[-2:]
+        ys = torch.arange(h, device=device)
+        xs = torch.arange(w, device=device)
+        winner = torch.zeros((h, w), dtype=torch.int, device=device)
+        for start in range(0, idx.numel(), chunk_size):
+            cur = idx[start:start+chunk_size]
+            x1, y1, x2, y2 = [b.view(-1, 1) for b in bboxes[:, cur]]
+            # rows carry the rank, so rank of a box is kept only where both its rows and columns are inside
+            rows = ((ys >= y1) & (ys <= y2)).int() * rank[cur].view(-1, 1).int()
+            cols = ((xs >= x1) & (xs <= x2)).int()
+            winner = torch.max(winner, (rows[:, :, None] * cols[:, None, :]).amax(0))
+        painted = winner > 0
+        src = order[winner[painted].long() - 1]
+        if canvas.dim() == 2:
+            canvas[painted] = values[src].to(canvas.dtype)
+        else:
+            canvas[:, painted] = values[..., src].view(-1, src.numel()).to(canvas.dtype)
+    return canvases
+
+
+def approx_max_iou(approx_anchors, gt_bbox, chunk_size=4096):
+    '''
+    Find at each location the approx anchor that overlaps gt the most, it goes over chunks of
+    locations so that ious of all approx anchors with all gt are never held at once.
+
+    Args:
+        approx_anchors: [4, k, n], k approx anchors at each of n locations
+        gt_bbox: [4, m]
+    Returns:
+        max_anchors: [4, n], the approx anchor with the largest iou with any gt
+        iou_tab: [n, m], ious of max_anchors with gt, same as calc_iou(max_anchors, gt_bbox)
+    '''
+    assert approx_anchors.shape[0] == 4 and gt_bbox.shape[0] == 4
+    _, k, n = approx_anchors.shape
+    m = gt_bbox.shape[1]
+    max_anchors = approx_anchors.new_empty((4, n))
+    iou_tab = approx_anchors.new_empty((n, m), dtype=torch.float)
+    for start in range(0, n, chunk_size):
+        cur = approx_anchors[:, :, start:start+chunk_size]
+        c = cur.shape[-1]
+        ious = utils.calc_iou(cur.reshape(4, -1), gt_bbox).view(k, c, m)
+        _, max_k = ious.max(2)[0].max(0)
+        arange = torch.arange(c, device=cur.device)
+        max_anchors[:, start:start+c] = cur[:, max_k, arange]
+        iou_tab[start:start+c] = ious[max_k, arange]
+    return max_anchors, iou_tab
+
+
 def inside_anchor_mask(anchors, img_size, allowed_border=0):
     with torch.no_grad():
         H, W = img_size
@@ -57,6 +146,7 @@ def random_sample_label(labels, pos_num, tot_num):
     return labels
 
 
+@register_module()
 class MaxIoUAssigner(object):
     '''
     It assigns gt bboxes to anchors based on some rules.
@@ -72,7 +162,7 @@ class MaxIoUAssigner(object):
         self.neg_iou = neg_iou
         self.min_pos_iou = min_pos_iou
 
-    def __call__(self, bboxes, gt_bboxes):
+    def __call__(self, bboxes, gt_bboxes, iou_tab=None):
         assert bboxes.shape[0] == 4 and gt_bboxes.shape[0] == 4
         num_gts = gt_bboxes.shape[-1]
         with torch.no_grad():
@@ -81,7 +171,10 @@ class MaxIoUAssigner(object):
             # first label everything as -1(ignore)
             labels_ = torch.full((n_bboxes,), -1, device=bboxes.device, dtype=torch.long)
             # calculate iou table, it has shape [num_anchors, num_gt_bboxes]
-            iou_tab = utils.calc_iou(bboxes, gt_bboxes)
+            # it can be given if the caller already has it, e.g. from approx_max_iou
+            if iou_tab is None:
+                iou_tab = utils.calc_iou(bboxes, gt_bboxes)
+            assert iou_tab.shape == (n_bboxes, n_gts)
             # for each gt, find the anchor with max iou overlap with it
             max_bbox_iou, max_bbox_arg = torch.max(iou_tab, dim=0)
             # for each anchor, find the gt with max iou overlap with it
@@ -109,6 +202,7 @@ class MaxIoUAssigner(object):
 
 
 
+@register_module()
 class RandomSampler(object):
     def __init__(self, max_num, pos_num):
         assert pos_num <= max_num
@@ -125,6 +219,7 @@ class RandomSampler(object):
         labels_[pos_places] = labels[pos_places]
         return labels_
 
+@register_module()
 class IoUBalancedNegSampler(object):
     def __init__(self, max_num, pos_num, num_bins=3, max_iou=0.5, floor_thr=-1, floor_fraction=0):
         # floor_thr and floor_fraction are not supported
@@ -232,14 +327,17 @@ class ScalableRoICrop(nn.Module):
         rois = torch.cat([batch_idx, bboxes], dim=1)
         return self.roi_op(feats, rois)
 
+@register_module()
 class ScalableRoIPool(ScalableRoICrop):
     ROI_OP = torchvision.ops.RoIPool
 
+@register_module()
 class ScalableRoIAlign(ScalableRoICrop):
     ROI_OP = torchvision.ops.RoIAlign
     
 
 # provide more flexible roi extractor where users can choose different roi layer for different feature levels
+@register_module()
 class BasicRoIExtractor(nn.Module):
 
     # roi_layers: a list of roi layer cfgs
@@ -306,6 +404,7 @@ class BasicRoIExtractor(nn.Module):
         return utils.multi_apply(self.forward_single_image, feats_list, rois_list)
         
 
+@register_module()
 class SingleRoIExtractor(nn.Module):
     def __init__(self, roi_layer='RoIPool', output_size=7, featmap_strides=[16], finest_scale=56):
         super(SingleRoIExtractor, self).__init__()
@@ -0,0 +1,285 @@
+import asyncio, json, logging, torch
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from . import utils
+
+'''
+A local HTTP inference server around BasicTester with dynamic batching.
+
+Endpoints:
+    POST /predict  body is an encoded image(jpg, png, ...), returns detections of it in the
+                   original image: {"bbox": [[x, y, w, h], ...], "score": [...], "category": [...]}
+    POST /reload   body is {"ckpt": "path/to/ckpt.pth"}, loads it with BasicTester.load_ckpt
+    GET  /stats    served requests and batches, pending requests and sizes of batches
+
+Images are preprocessed by the test pipeline on a thread pool and queued in buckets by their
+padded shape, so images of a batch need no extra padding. A bucket is run as a batch once it
+has max_batch images or its oldest image has waited max_wait_ms. The model runs on a single
+worker thread, batches are formed while it is busy. Reloads run on the same thread between two
+batches, requests that arrive meanwhile are queued, none is dropped.
+'''
+
+
+class ImagePreprocessor(object):
+    '''
+    Encoded image -> (img [3, H, W], img_meta), with the test pipeline where LoadImageFromFile
+    is replaced by decoding from bytes.
+    '''
+    def __init__(self, pipeline):
+        import mmcv
+        from mmdet.datasets.pipelines import Compose
+        assert pipeline[0]['type'] == 'LoadImageFromFile', \
+            'test pipeline must start with LoadImageFromFile'
+        self.imfrombytes = mmcv.imfrombytes
+        self.pipeline = Compose(pipeline[1:])
+
+    def __call__(self, body):
+        img = self.imfrombytes(body)
+        if img is None:
+            raise ValueError('Can not decode image of {} bytes'.format(len(body)))
+        data = self.pipeline(dict(filename='request', img=img, img_shape=img.shape, ori_shape=img.shape))
+        return data['img'].data, data['img_meta'].data
+
+
+class PendingImage(object):
+    def __init__(self, img, img_meta, future, arrival):
+        self.img, self.img_meta = img, img_meta
+        self.future, self.arrival = future, arrival
+
+
+class InferenceServer(object):
+    '''
+    Args:
+        tester: BasicTester with a loaded ckpt
+        preprocess: encoded image -> (img [3, H, W], img_meta), ImagePreprocessor of the test
+                    pipeline if it is None
+        max_batch: max number of images in a batch
+        max_wait_ms: max time an image waits for others of its bucket
+        preprocess_workers: number of threads that decode and preprocess images
+    '''
+    def __init__(self, tester, pipeline=None, preprocess=None, max_batch=4, max_wait_ms=20,
+                 preprocess_workers=2):
+        assert max_batch > 0 and max_wait_ms >= 0
+        self.tester = tester
+        self.preprocess = preprocess if preprocess is not None else ImagePreprocessor(pipeline)
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.model_executor = ThreadPoolExecutor(1)
+        self.preprocess_executor = ThreadPoolExecutor(preprocess_workers)
+        # pad shape -> list of PendingImage in arrival order
+        self.buckets = OrderedDict()
+        self.wakeup = None
+        self.batch_sizes = Counter()
+        self.num_served = 0
+        self.num_reloads = 0
+
+    def run_batch(self, pending):
+        img_data = torch.stack([p.img for p in pending])
+        img_metas = [p.img_meta for p in pending]
+        with torch.no_grad():
+            bboxes, scores, categories = self.tester.inference_one(img_data, img_metas)
+        results = []
+        for bbox, score, category, img_meta in zip(bboxes, scores, categories, img_metas):
+            bbox = utils.xyxy2xywh(bbox).t() / img_meta['scale_factor']
+            results.append({'bbox': [[round(x, 2) for x in b] for b in bbox.tolist()],
+                            'score': [round(s, 4) for s in score.tolist()],
+                            'category': category.tolist()})
+        return results
+
+    def next_batch(self, now):
+        '''
+        Pop a batch from the ready bucket with the oldest image, or return the time until the
+        next bucket gets ready.
+        '''
+        ready, wait = None, None
+        for key, pending in self.buckets.items():
+            waited = now - pending[0].arrival
+            if len(pending) >= self.max_batch or waited >= self.max_wait:
+                if ready is None or pending[0].arrival < self.buckets[ready][0].arrival:
+                    ready = key
+            else:
+                wait = self.max_wait - waited if wait is None else min(wait, self.max_wait - waited)
+        if ready is None:
+            return None, wait
+        pending = self.buckets[ready]
+        batch, self.buckets[ready] = pending[:self.max_batch], pending[self.max_batch:]
+        if len(self.buckets[ready]) == 0:
+            del self.buckets[ready]
+        return batch, None
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch, wait = self.next_batch(loop.time())
+            if batch is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            batch = [p for p in batch if not p.future.cancelled()]
+            if len(batch) == 0:
+                continue
+            self.batch_sizes[len(batch)] += 1
+            try:
+                results = await loop.run_in_executor(self.model_executor, self.run_batch, batch)
+            except Exception as e:
+                logging.exception('Failed to run a batch of {} images'.format(len(batch)))
+                for p in batch:
+                    if not p.future.done():
+                        p.future.set_exception(e)
+                continue
+            for p, res in zip(batch, results):
+                if not p.future.done():
+                    p.future.set_result(res)
+            self.num_served += len(batch)
+
+    async def predict(self, body):
+        loop = asyncio.get_running_loop()
+        img, img_meta = await loop.run_in_executor(self.preprocess_executor, self.preprocess, body)
+        future = loop.create_future()
+        key = tuple(img.shape)
+        self.buckets.setdefault(key, []).append(PendingImage(img, img_meta, future, loop.time()))
+        self.wakeup.set()
+        return await future
+
+    async def reload(self, ckpt):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.model_executor, self.tester.load_ckpt, ckpt)
+        self.num_reloads += 1
+        return {'ckpt': ckpt}
+
+    def stats(self):
+        return {'served': self.num_served,
+                'batches': sum(self.batch_sizes.values()),
+                'batch_sizes': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+                'pending': sum(len(p) for p in self.buckets.values()),
+                'reloads': self.num_reloads,
+                'ckpt': getattr(self.tester, 'ckpt', None)}
+
+    async def route(self, method, path, body):
+        if method == 'POST' and path == '/predict':
+            try:
+                return 200, await self.predict(body)
+            except ValueError as e:
+                return 400, {'error': str(e)}
+        if method == 'POST' and path == '/reload':
+            try:
+                ckpt = json.loads(body.decode())['ckpt']
+            except (ValueError, KeyError, TypeError):
+                return 400, {'error': 'body must be {"ckpt": <path>}'}
+            return 200, await self.reload(ckpt)
+        if method == 'GET' and path == '/stats':
+            return 200, self.stats()
+        return 404, {'error': 'no such endpoint: {} {}'.format(method, path)}
+
+    async def handle(self, reader, writer):
+        # HTTP/1.1 with keep-alive, one request at a time per connection
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            while True:
+                request = await read_http(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                try:
+                    status, payload = await self.route(method, path, body)
+                except Exception as e:
+                    logging.exception('Failed to serve {} {}'.format(method, path))
+                    status, payload = 500, {'error': repr(e)}
+                write_http(writer, 'HTTP/1.1 {} {}'.format(status, HTTP_REASONS.get(status, '')),
+                           json.dumps(payload))
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections.pop(task, None)
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8080):
+        self.tester.model.eval()
+        self.wakeup = asyncio.Event()
+        self.connections = {}
+        self.batcher_task = asyncio.ensure_future(self.batcher())
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info('Inference server listening on {}:{}'.format(host, self.port))
+        return self.server
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        # closed connections end their handlers normally
+        tasks = list(self.connections)
+        for writer in self.connections.values():
+            writer.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.batcher_task.cancel()
+        self.model_executor.shutdown()
+        self.preprocess_executor.shutdown()
+
+    def serve_forever(self, host='127.0.0.1', port=8080):
+        async def main():
+            server = await self.start(host, port)
+            async with server:
+                await server.serve_forever()
+        asyncio.run(main())
+
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+async def read_http(reader):
+    '''
+    Read a request or a response, returns (first line split in 3, headers, body), or None at EOF.
+    '''
+    line = await reader.readline()
+    if not line:
+        return None
+    first = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return first[0], first[1], headers, body
+
+
+def write_http(writer, first_line, body, content_type='application/json'):
+    if isinstance(body, str):
+        body = body.encode()
+    writer.write('{}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+        first_line, content_type, len(body)).encode('latin-1') + body)
+
+
+class Client(object):
+    '''
+    A keep-alive connection to InferenceServer, used by the load generator.
+    '''
+    def __init__(self, host='127.0.0.1', port=8080):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=b''):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        write_http(self.writer, '{} {} HTTP/1.1\r\nHost: {}'.format(method, path, self.host), body,
+                   'application/octet-stream')
+        await self.writer.drain()
+        response = await read_http(self.reader)
+        if response is None:
+            raise ConnectionError('Connection closed by server')
+        _, status, _, body = response
+        return int(status), json.loads(body.decode())
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
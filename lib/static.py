@@ -0,0 +1,55 @@
+import torch, logging
+from torch import nn
+
+
+class StaticDetector(nn.Module):
+    '''
+    Inference of a dense detector(RetinaNet, FCOS) split into two parts:
+
+        forward_dense: backbone, neck, head convs and per-level decoding for all images, shapes of
+                       its outputs only depend on shape of the input
+        forward_post:  data dependent post-processing, e.g. nms, it always runs eagerly
+
+    The dense part runs in one of the modes:
+        eager:   as it is
+        compile: with torch.compile, it recompiles for new input shapes
+        trace:   with torch.jit.trace, one traced graph is kept for each input shape
+
+    It has the same forward_test as detectors, so that BasicTester can use it in place of one.
+    '''
+    MODES = ('eager', 'compile', 'trace')
+
+    def __init__(self, detector, mode='compile'):
+        super(StaticDetector, self).__init__()
+        assert mode in self.MODES, 'Unknown static inference mode: {}'.format(mode)
+        assert hasattr(detector, 'forward_dense'), \
+            '{} does not support static inference'.format(detector.__class__.__name__)
+        self.detector = detector
+        self.mode = mode
+        self.traced = {}
+        self.compiled = torch.compile(self.forward) if mode == 'compile' else None
+        logging.info('Static inference of {} in {} mode'.format(detector.__class__.__name__, mode))
+
+    def forward(self, img_data, img_sizes, scale_factors):
+        return self.detector.forward_dense(img_data, img_sizes, scale_factors)
+
+    def forward_dense(self, img_data, img_sizes, scale_factors):
+        if self.mode == 'compile':
+            return self.compiled(img_data, img_sizes, scale_factors)
+        if self.mode == 'trace':
+            key = (tuple(img_data.shape), img_data.device, img_data.dtype)
+            if key not in self.traced:
+                logging.info('Trace dense part for input {}'.format(img_data.shape))
+                self.traced[key] = torch.jit.trace(self, (img_data, img_sizes, scale_factors),
+                                                   check_trace=False)
+            return self.traced[key](img_data, img_sizes, scale_factors)
+        return self.forward(img_data, img_sizes, scale_factors)
+
+    def forward_test(self, img_data, img_metas):
+        device = img_data.device
+        img_sizes = torch.tensor([img_meta['img_shape'][:2] for img_meta in img_metas], device=device)
+        scale_factors = torch.tensor([float(img_meta['scale_factor']) for img_meta in img_metas],
+                                     device=device)
+        with torch.no_grad():
+            dense_outs = self.forward_dense(img_data, img_sizes, scale_factors)
+        return self.detector.forward_post(dense_outs, img_metas)
@@ -0,0 +1,237 @@
+import numpy as np
+import os.path as osp
+import copy, json, logging, time, torch
+from mmcv import ProgressBar
+from . import utils
+from .ann_index import load_npz_mmap
+from .evaluator import COCOEvaluator
+from .utils import class_name
+
+'''
+Sweep of post-processing settings(test_cfg: pre_nms, min_score, nms_iou, max_per_img, nms_type)
+on candidates before nms, so that the network runs once for all settings.
+
+Candidates of all images are written into one uncompressed .npz file(m candidates in total):
+    img_ids      [n]          int64
+    img_scales   [n]          float32, scale_factor of images
+    img_offsets  [n+1]        int64, candidates of image i are [offsets[i], offsets[i+1])
+    bboxes       [m, 4] or [m, 4*num_classes] float32, decoded and clamped bboxes in the
+                              resized image, class specific ones of rcnn heads
+    scores       [m, cls_channels] float16 or float32
+    factors      [m]          same dtype as scores, centerness of FCOS, ones otherwise
+    ranks        [m]          int32, rank of the candidate among candidates of its level,
+                              a smaller pre_nms keeps candidates with rank < pre_nms
+    meta         json string: detector, nms_channels, label_offset, use_factor, pre_nms,
+                              min_score and min_bbox_size of the collection
+
+Candidates whose scores are all below the smallest min_score of the sweep are not stored.
+pre_nms of CascadeRCNN is a setting of rpn, its candidates can not be re-selected.
+'''
+
+SWEEP_KEYS = ('pre_nms', 'min_score', 'nms_iou', 'max_per_img', 'nms_type')
+
+
+def nms_setting(detector):
+    '''
+    Channels that take part in nms, offset from channel to label, and if scores are multiplied
+    by factors, same as nms_single_image of heads.
+    '''
+    name = class_name(detector)
+    if name == 'RetinaNet':
+        head = detector.bbox_head
+        if head.use_sigmoid:
+            return list(range(0, head.num_classes-1)), 1, False
+        return list(range(1, head.num_classes)), 0, False
+    if name == 'FCOS':
+        head = detector.bbox_head
+        return list(range(0, head.cls_channels)), 1, head.use_centerness
+    if name == 'CascadeRCNN':
+        return list(range(1, detector.rcnn_head[-1].num_classes)), 0, False
+    raise ValueError('{} is not supported in sweep'.format(name))
+
+
+def level_ranks(grid_sizes, pre_nms, device):
+    # predict_dense takes top pre_nms candidates of each level in descending order
+    ranks = [torch.arange(num if pre_nms <= 0 else min(pre_nms, num), device=device) for num in grid_sizes]
+    return torch.cat(ranks).int()
+
+
+def collect_batch(detector, img_data, img_metas, test_cfg):
+    '''
+    Candidates before nms of a batch, a list of (bbox, score, factor, rank) of images.
+    '''
+    name = class_name(detector)
+    device = img_data.device
+    feats = detector.extract_feat(img_data)
+    if name == 'CascadeRCNN':
+        head = detector.rcnn_head[-1]
+        props, cls_outs, reg_outs = detector.predict_rcnn_outs(feats, img_metas)
+        cands = []
+        for prop, cls_out, reg_out, img_meta in zip(props, cls_outs, reg_outs, img_metas):
+            bbox, score = head.decode_bboxes_single_image(prop, cls_out, reg_out, img_meta['img_shape'][:2])
+            cands.append((bbox.t(), score, score.new_ones(score.shape[0]),
+                          torch.zeros(score.shape[0], dtype=torch.int, device=device)))
+        return cands
+
+    head = detector.bbox_head
+    img_sizes = torch.tensor([img_meta['img_shape'][:2] for img_meta in img_metas], device=device)
+    scale_factors = torch.tensor([float(img_meta['scale_factor']) for img_meta in img_metas], device=device)
+    cands = []
+    if name == 'RetinaNet':
+        cls_outs, reg_outs = head(feats)
+        bboxes, scores = head.predict_dense(cls_outs, reg_outs, img_sizes, scale_factors, test_cfg)
+        ranks = level_ranks([cls_out[0].numel() // head.cls_channels for cls_out in cls_outs],
+                            test_cfg.pre_nms, device)
+        for bbox, score, img_meta in zip(bboxes, scores, img_metas):
+            # same as AnchorHead.predict_post
+            bbox = utils.clamp_bbox(bbox, img_meta['img_shape'][:2])
+            min_size = img_meta['scale_factor'] * test_cfg.min_bbox_size
+            keep = (bbox[2]-bbox[0] + 1 >= min_size) & (bbox[3]-bbox[1] + 1 >= min_size)
+            cands.append((bbox[:, keep].t(), score[:, keep].t(), score.new_ones(int(keep.sum())), ranks[keep]))
+    else:
+        cls_outs, reg_outs, ctr_outs = head(feats)
+        bboxes, scores, ctr_scores, valid = head.predict_dense(
+            cls_outs, reg_outs, ctr_outs, img_sizes, scale_factors, test_cfg)
+        ranks = level_ranks([cls_out[0, 0].numel() for cls_out in cls_outs], test_cfg.pre_nms, device)
+        for bbox, score, ctr_score, keep in zip(bboxes, scores, ctr_scores, valid):
+            cands.append((bbox[:, keep].t(), score[:, keep].t(), ctr_score[keep], ranks[keep]))
+    return cands
+
+
+def collect_candidates(detector, dataloader, out_file, pre_nms, min_score, device, fp16=True):
+    '''
+    Run detector on all images of dataloader once and write candidates to out_file.
+
+    Args:
+        pre_nms: largest pre_nms of the sweep, 0 or less for all
+        min_score: smallest min_score of the sweep, candidates below it are not stored
+    '''
+    test_cfg = copy.deepcopy(detector.test_cfg)
+    if class_name(detector) != 'CascadeRCNN':
+        test_cfg.pre_nms = pre_nms
+    nms_channels, label_offset, use_factor = nms_setting(detector)
+    score_dtype = np.float16 if fp16 else np.float32
+    img_ids, img_scales, counts = [], [], []
+    bboxes, scores, factors, ranks = [], [], [], []
+    detector.eval()
+    prog_bar = ProgressBar(len(dataloader.dataset))
+    with torch.no_grad():
+        for test_data in dataloader:
+            img_metas = test_data['img_meta'].data[0]
+            img_data = test_data['img'].data[0].to(device)
+            for (bbox, score, factor, rank), img_meta in zip(
+                    collect_batch(detector, img_data, img_metas, test_cfg), img_metas):
+                keep = score[:, nms_channels].max(1)[0] >= min_score
+                bboxes.append(bbox[keep].cpu().numpy().astype(np.float32))
+                scores.append(score[keep].cpu().numpy().astype(score_dtype))
+                factors.append(factor[keep].cpu().numpy().astype(score_dtype))
+                ranks.append(rank[keep].cpu().numpy())
+                img_ids.append(int(osp.basename(img_meta['filename'])[:-4]))
+                img_scales.append(float(img_meta['scale_factor']))
+                counts.append(int(keep.sum()))
+                prog_bar.update()
+    offsets = np.zeros(len(counts)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    meta = {'detector': class_name(detector), 'nms_channels': nms_channels, 'label_offset': label_offset,
+            'use_factor': use_factor, 'pre_nms': pre_nms, 'min_score': min_score,
+            'min_bbox_size': test_cfg.get('min_bbox_size', test_cfg.get('rpn', {}).get('min_bbox_size'))}
+    # np.savez does not compress, which is required for memory mapping, a file object keeps the
+    # name as it is instead of appending .npz
+    with open(out_file, 'wb') as f:
+        np.savez(f, img_ids=np.array(img_ids, dtype=np.int64), img_scales=np.array(img_scales, dtype=np.float32),
+                 img_offsets=offsets, bboxes=np.concatenate(bboxes), scores=np.concatenate(scores),
+                 factors=np.concatenate(factors), ranks=np.concatenate(ranks).astype(np.int32),
+                 meta=np.array(json.dumps(meta)))
+    logging.info('Collected {} candidates of {} images in {}'.format(offsets[-1], len(img_ids), out_file))
+    return out_file
+
+
+class Candidates(object):
+    def __init__(self, cand_file):
+        arrays = load_npz_mmap(cand_file)
+        for k in ('img_ids', 'img_scales', 'img_offsets', 'bboxes', 'scores', 'factors', 'ranks'):
+            setattr(self, k, arrays[k])
+        self.meta = json.loads(str(np.asarray(arrays['meta'])))
+
+    def __len__(self):
+        return len(self.img_ids)
+
+    def check_setting(self, setting):
+        pre_nms, min_score = setting['pre_nms'], setting['min_score']
+        if self.meta['detector'] == 'CascadeRCNN':
+            assert pre_nms is None, 'pre_nms of CascadeRCNN can not be swept'
+        else:
+            stored = self.meta['pre_nms']
+            assert stored <= 0 or 0 < pre_nms <= stored, \
+                'candidates are collected with pre_nms={}, can not sweep pre_nms={}'.format(stored, pre_nms)
+        assert min_score >= self.meta['min_score'], \
+            'candidates are collected with min_score={}, can not sweep min_score={}'.format(
+                self.meta['min_score'], min_score)
+
+    def post_process(self, i, setting):
+        '''
+        nms of candidates of the i-th image with a setting, returns bbox [4, k], score, label.
+        '''
+        start, end = self.img_offsets[i], self.img_offsets[i+1]
+        ranks = self.ranks[start:end]
+        sel = slice(None) if setting['pre_nms'] is None or setting['pre_nms'] <= 0 \
+              else np.nonzero(ranks < setting['pre_nms'])[0]
+        bbox = torch.from_numpy(np.asarray(self.bboxes[start:end][sel]))
+        score = torch.from_numpy(np.asarray(self.scores[start:end][sel], dtype=np.float32))
+        factor = torch.from_numpy(np.asarray(self.factors[start:end][sel], dtype=np.float32)) \
+                 if self.meta['use_factor'] else None
+        keep_bbox, keep_score, keep_label = utils.multiclass_nms(
+            bbox, score, self.meta['nms_channels'], setting['nms_iou'], setting['min_score'],
+            setting['max_per_img'], factor, mode=setting['nms_type'])
+        keep_label += self.meta['label_offset']
+        return keep_bbox.t(), keep_score, keep_label
+
+
+# state of a sweep worker process, set by init_worker
+_worker = {}
+
+def init_worker(cand_file, gt, img_ids, num_threads=None):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    _worker.update(cands=Candidates(cand_file), evaluator=COCOEvaluator(gt, img_ids))
+
+
+def evaluate_setting(setting):
+    '''
+    mAP, AP50 and post-processing time per image of a setting, it runs in a worker process.
+    '''
+    cands = _worker['cands']
+    cands.check_setting(setting)
+    infer_res = []
+    start = time.time()
+    for i in range(len(cands)):
+        bbox, score, label = cands.post_process(i, setting)
+        if bbox.shape[1] > 0:
+            infer_res.append({'image_id': int(cands.img_ids[i]), 'file_name': '',
+                              'bbox': utils.xyxy2xywh(bbox).t() / float(cands.img_scales[i]),
+                              'score': score, 'category': label})
+    post_time = (time.time() - start) / len(cands)
+    if len(infer_res) == 0:
+        return setting, 0.0, 0.0, post_time
+    stats = _worker['evaluator'].evaluate(infer_res)
+    return setting, stats[0], stats[1], post_time
+
+
+def sweep(cand_file, gt, settings, num_workers=4):
+    '''
+    Evaluate settings on candidates in cand_file with num_workers processes.
+
+    Args:
+        gt: COCO api of ground truth
+        settings: list of dicts with keys of SWEEP_KEYS
+    Returns:
+        list of (setting, mAP, AP50, post-processing seconds per image) in order of settings
+    '''
+    import multiprocessing as mp
+    img_ids = Candidates(cand_file).img_ids.tolist()
+    if num_workers <= 1:
+        init_worker(cand_file, gt, img_ids)
+        return [evaluate_setting(s) for s in settings]
+    # workers are forked so that ground truth is not pickled
+    with mp.get_context('fork').Pool(num_workers, init_worker, (cand_file, gt, img_ids, 1)) as pool:
+        return pool.map(evaluate_setting, settings, chunksize=1)
@@ -1,4 +1,7 @@
 from . import utils
+from .trainer.checkpoint import model_state_of
+from .static import StaticDetector
+from .tta import TTADetector
 import os.path as osp
 import copy, torch, logging
 from mmcv import ProgressBar
@@ -10,52 +13,131 @@ class BasicTester(object):
                  model,
                  train_cfg,
                  test_cfg,
-                 device):
+                 device,
+                 channels_last=False,
+                 static=None,
+                 tta=None):
         self.device=device
-        self.model=model
+        self.memory_format=utils.memory_format(channels_last)
+        self.model=model.to(device, memory_format=self.memory_format)
+        # static: None to run model.forward_test as it is, or a mode of StaticDetector
+        self.static=static
+        self.infer_model=model if static is None else StaticDetector(model, static)
+        # tta: None for no test-time augmentation, or kwargs of TTADetector
+        if tta is not None:
+            self.infer_model=TTADetector(self.infer_model, **tta)
         self.train_cfg=copy.deepcopy(train_cfg)
         self.test_cfg=copy.deepcopy(test_cfg)
 
     def load_ckpt(self, ckpt):
         self.ckpt=ckpt
         assert self.model is not None
-        self.model.load_state_dict(torch.load(ckpt, map_location=self.device))
+        self.model.load_state_dict(model_state_of(torch.load(ckpt, map_location=self.device)))
         logging.info('loaded ckpt: {}'.format(ckpt))
 
-    def inference(self, dataloader):
+    def inference(self, dataloader, feat_writer=None):
+        '''
+        feat_writer: if it is a FeatureCacheWriter, features of all images are written to it
+        '''
         self.model.eval()
-        inf_res, ith = [], 0
+        inf_res = []
         logging.info('Start to inference {} images...'.format(len(dataloader)))
         logging.info('Test config:')
         logging.info(str(self.test_cfg))
+        if feat_writer is not None:
+            assert self.infer_model is self.model, 'feature cache needs plain forward_test'
         prog_bar = ProgressBar(len(dataloader))
         with torch.no_grad():
             for test_data in dataloader:
                 img_metas = test_data['img_meta'].data[0]
-                img_data  = test_data['img'].data[0].to(self.device)
-
-                bboxes, scores, categories = self.inference_one(img_data, img_metas)
-                for i in range(len(img_metas)):
-                    bbox, score, category, img_meta = bboxes[i], scores[i], categories[i], img_metas[i]
-                    scale = img_meta['scale_factor']
-                    filename = img_meta['filename']
-                    filename = osp.basename(filename)
-                    iid = int(filename[:-4])
-                    img_w, img_h = img_meta['ori_shape'][:2]
-                    img_res = {'width':img_w, 'height':img_h, 'image_id':iid, 'file_name':filename}
-                    if len(bbox) == 0:
-                        logging.warning('0 predictions for image {}'.format(iid))
-                        continue
-                    img_res['bbox'] = utils.xyxy2xywh(bbox).t() / scale
-                    img_res['score'] = score
-                    img_res['category'] = category
-                    logging.info('{} bbox predictions for {}-th image with image id: {}'.format(
-                        bbox.shape[1], ith, iid))
-                    inf_res.append(img_res)
-                ith += 1
+                img_data  = test_data['img'].data[0]
+
+                if feat_writer is None:
+                    bboxes, scores, categories = self.inference_one(img_data, img_metas)
+                else:
+                    img_data = img_data.to(device=self.device, memory_format=self.memory_format)
+                    feats = self.model.extract_feat(img_data)
+                    feat_writer.add(feats, img_metas)
+                    bboxes, scores, categories = self.model.forward_feats(feats, img_metas)
+                self.collect_results(inf_res, bboxes, scores, categories, img_metas)
                 prog_bar.update()
         return inf_res
 
+    def inference_cached(self, feat_cache, img_ids=None):
+        '''
+        Same as inference but heads run on features read from a FeatureCache, no image is loaded
+        and the backbone does not run. Images are inferenced in the batches they were cached in.
+        If img_ids of the test dataset are given, the cache must hold exactly these images, and
+        batches are in their order.
+        '''
+        if img_ids is not None:
+            assert sorted(img_ids) == sorted(feat_cache.img_ids), \
+                'feature cache holds other images than the test dataset'
+        self.model.eval()
+        inf_res = []
+        logging.info('Start to inference {} images from feature cache...'.format(len(feat_cache)))
+        logging.info('Test config:')
+        logging.info(str(self.test_cfg))
+        prog_bar = ProgressBar(len(feat_cache))
+        with torch.no_grad():
+            for feats, img_metas in feat_cache.batches(img_ids, device=self.device):
+                bboxes, scores, categories = self.model.forward_feats(feats, img_metas)
+                self.collect_results(inf_res, bboxes, scores, categories, img_metas)
+                for _ in img_metas:
+                    prog_bar.update()
+        return inf_res
+
+    # append predictions of images with at least one bbox to inf_res
+    def collect_results(self, inf_res, bboxes, scores, categories, img_metas):
+        for i in range(len(img_metas)):
+            bbox, score, category, img_meta = bboxes[i], scores[i], categories[i], img_metas[i]
+            scale = img_meta['scale_factor']
+            filename = img_meta['filename']
+            filename = osp.basename(filename)
+            iid = int(filename[:-4])
+            img_w, img_h = img_meta['ori_shape'][:2]
+            img_res = {'width':img_w, 'height':img_h, 'image_id':iid, 'file_name':filename}
+            if len(bbox) == 0:
+                logging.warning('0 predictions for image {}'.format(iid))
+                continue
+            img_res['bbox'] = utils.xyxy2xywh(bbox).t() / scale
+            img_res['score'] = score
+            img_res['category'] = category
+            logging.info('{} bbox predictions for image with image id: {}'.format(bbox.shape[1], iid))
+            inf_res.append(img_res)
+
     def inference_one(self, img_data, img_metas):
-        img_data = img_data.to(device=self.device)
-        return self.model.forward_test(img_data, img_metas)
+        img_data = img_data.to(device=self.device, memory_format=self.memory_format)
+        return self.infer_model.forward_test(img_data, img_metas)
+
+
+# predictions of BasicTester.inference in COCO result format
+def results2json(infer_res):
+    anno_idx, out_json = 0, []
+    for pred in infer_res:
+        iid, bbox_xywh, score, category, filename \
+            = pred['image_id'], pred['bbox'], pred['score'], pred['category'], pred['file_name']
+        for i, cur_bbox in enumerate(bbox_xywh):
+            cur_pred = {
+                'id': anno_idx,
+                'image_id': iid,
+                'file_name': filename,
+                'bbox': [round(x.item(), 2) for x in cur_bbox],
+                'score': round(score[i].item(), 3),
+                'category_id': category[i].item()
+            }
+            out_json.append(cur_pred)
+            anno_idx += 1
+    return out_json
+
+# gt: COCO api of ground truth, dt_file: json file of results2json
+# img_ids: evaluate only on these images, all images of gt if None
+def coco_eval(gt, dt_file, img_ids=None):
+    dt = gt.loadRes(dt_file)
+    cocoEval = COCOeval(gt, dt, 'bbox')
+    if img_ids is not None:
+        cocoEval.params.imgIds = img_ids
+    cocoEval.evaluate()
+    cocoEval.accumulate()
+    cocoEval.summarize()
+    return cocoEval.stats
@@ -0,0 +1,184 @@
+import threading, queue, atexit, traceback, logging, random, os, torch
+import os.path as osp
+import numpy as np
+from torch.utils.data import Sampler
+
+
+# copy all tensors of a nested state to host memory, so that training can go on updating
+# the original tensors while the copy is being written
+def snapshot(state):
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        res = type(state)((k, snapshot(v)) for k, v in state.items())
+        # state_dict of nn.Module keeps versions of modules in _metadata
+        if hasattr(state, '_metadata'):
+            res._metadata = state._metadata
+        return res
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+
+# a ckpt is either a plain model state_dict(old format) or a dict saved by CkptWriter
+def model_state_of(ckpt):
+    if isinstance(ckpt, dict) and 'state_dict' in ckpt and 'meta' in ckpt:
+        return ckpt['state_dict']
+    return ckpt
+
+
+def save_atomic(state, filename):
+    tmp_file = filename + '.tmp'
+    try:
+        torch.save(state, tmp_file)
+    except:
+        if osp.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    # rename is atomic, a crash during saving never leaves a broken ckpt behind
+    os.replace(tmp_file, filename)
+
+
+class CkptWriter(object):
+    '''
+    It saves ckpts on a background thread. The caller only pays for copying the state to
+    host memory, serialization and disk writes happen on the writer thread.
+
+    Args:
+        max_keep: keep only the last max_keep ckpts written by this writer, None keeps all
+        async_write: if False, ckpts are written on the calling thread
+        max_pending: number of ckpts that wait for the one being written, save blocks beyond
+                     it, so that snapshots do not pile up in host memory when disk is slow
+    '''
+    def __init__(self, max_keep=None, async_write=True, max_pending=1):
+        assert max_keep is None or max_keep > 0
+        assert max_pending > 0
+        self.max_keep = max_keep
+        self.async_write = async_write
+        self.saved = []
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = None
+        self.lock = threading.Lock()
+        # flush pending ckpts even if training exits early
+        atexit.register(self.wait)
+
+    def save(self, state, filename):
+        self.check_error()
+        state = snapshot(state)
+        if not self.async_write:
+            self.write(state, filename)
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='CkptWriter', daemon=True)
+            self.thread.start()
+        self.queue.put((state, filename))
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            try:
+                self.write(*job)
+            except Exception as e:
+                logging.error('Failed to save ckpt {}: {}'.format(job[1], traceback.format_exc()))
+                self.error = e
+
+    def write(self, state, filename):
+        save_atomic(state, filename)
+        logging.info('Saved ckpt to {}'.format(filename))
+        with self.lock:
+            if filename in self.saved:
+                self.saved.remove(filename)
+            self.saved.append(filename)
+            while self.max_keep is not None and len(self.saved) > self.max_keep:
+                old = self.saved.pop(0)
+                if osp.exists(old):
+                    os.remove(old)
+                    logging.info('Removed old ckpt {}'.format(old))
+
+    # block until all submitted ckpts are on disk
+    def wait(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.check_error()
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Background ckpt writing failed') from error
+
+
+# states of all random number generators, numpy state is stored as tensor so that the
+# state can be saved with torch.save and loaded back in weights_only mode
+def get_rng_state():
+    np_state = np.random.get_state()
+    state = {
+        'python': random.getstate(),
+        'numpy': (np_state[0], torch.from_numpy(np_state[1].copy())) + tuple(np_state[2:]),
+        'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np_state = state['numpy']
+    np.random.set_state((np_state[0], np_state[1].numpy()) + tuple(np_state[2:]))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class ResumableSampler(Sampler):
+    '''
+    It wraps the sampler of a dataloader and records the rng state that draws the sample order
+    of each epoch. An interrupted epoch can then be continued with the same order, starting
+    after the samples that were already trained on, without loading them again.
+
+    Resuming is exact for the sample order and the rng of the main process only. Seeds of
+    dataloader workers are drawn when the dataloader iterator is created, and workers take
+    other batches after the skipped ones, so random augmentation in workers is not replayed.
+    With num_workers=0 data is loaded by the main process and a resumed run is exact.
+    '''
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.rng_state = None
+        self.resume_rng_state = None
+        self.after_rng_state = None
+        self.start = 0
+
+    # replace sampler of an existing dataloader with a ResumableSampler
+    @classmethod
+    def install(cls, dataloader):
+        batch_sampler = dataloader.batch_sampler
+        if not isinstance(batch_sampler.sampler, cls):
+            batch_sampler.sampler = cls(batch_sampler.sampler)
+        return batch_sampler.sampler
+
+    # rng_state: the state that drew the order of the interrupted epoch
+    # start: number of samples to skip
+    # after_rng_state: the state to continue with after drawing the order, it is set at the
+    #                  moment the order is drawn so that the dataloader iterator creation,
+    #                  which also consumes random numbers, does not shift it
+    def resume(self, rng_state, start, after_rng_state):
+        self.resume_rng_state = rng_state
+        self.after_rng_state = after_rng_state
+        self.start = start
+
+    def __iter__(self):
+        if self.resume_rng_state is not None:
+            set_rng_state(self.resume_rng_state)
+        self.rng_state = get_rng_state()
+        indices = list(iter(self.sampler))
+        if self.resume_rng_state is not None:
+            set_rng_state(self.after_rng_state)
+            self.resume_rng_state, self.after_rng_state = None, None
+        start, self.start = self.start, 0
+        return iter(indices[start:])
+
+    def __len__(self):
+        return len(self.sampler)
@@ -1,8 +1,10 @@
 from torch.nn.utils import clip_grad_norm_
 from collections import OrderedDict
 import os.path as osp
+import numpy as np
 import torch, logging
 from .. import utils
+from .checkpoint import CkptWriter
 
 class Hook(object):
     MAX_PRIORITY = 0
@@ -29,6 +31,12 @@ class Hook(object):
     def after_step(self):
         pass
 
+    # states that need to be restored when resuming a training
+    def state_dict(self):
+        return {}
+    def load_state_dict(self, state):
+        pass
+
 
 class Hookable(object):
     def __init__(self):
@@ -47,6 +55,15 @@ class Hookable(object):
                 if hasattr(hk, action):
                     getattr(hk, action)()
 
+    def hooks_state_dict(self):
+        return {utils.class_name(hk): hk.state_dict() for hk_prio in self.hooks for hk in hk_prio}
+
+    def load_hooks_state_dict(self, state):
+        for hk_prio in self.hooks:
+            for hk in hk_prio:
+                if utils.class_name(hk) in state:
+                    hk.load_state_dict(state[utils.class_name(hk)])
+
 class OptimizerHook(Hook):
     def __init__(self, trainer, priority=1):
         super(OptimizerHook, self).__init__(priority)
@@ -87,18 +104,48 @@ class LrHook(Hook):
             lr = [x*decay for x in lr]
             self.trainer.set_lr(lr)
 
+    def state_dict(self):
+        return {'lr': self.trainer.get_lr()}
+
+    def load_state_dict(self, state):
+        self.trainer.set_lr(state['lr'])
 
+
+# ckpt_cfg:
+#   interval: save a ckpt every interval epochs
+#   max_keep: keep only the last max_keep epoch ckpts, default keeps all
+#   async_write: write ckpts on a background thread, default True
+#   state_interval: save full trainer state every state_interval iterations for resuming,
+#                   default None which disables it, see ResumableSampler for what is replayed
+#   state_max_keep: keep only the last state_max_keep trainer states, default 1
 class CkptHook(Hook):
     def __init__(self, trainer, priority=1):
         super(CkptHook, self).__init__(priority)
         self.trainer = trainer
         self.ckpt_cfg = trainer.ckpt_cfg
+        async_write = self.ckpt_cfg.get('async_write', True)
+        self.writer = CkptWriter(max_keep=self.ckpt_cfg.get('max_keep', None),
+                                 async_write=async_write)
+        self.state_interval = self.ckpt_cfg.get('state_interval', None)
+        self.state_writer = CkptWriter(max_keep=self.ckpt_cfg.get('state_max_keep', 1),
+                                       async_write=async_write)
+
+    def after_step(self):
+        finished = self.trainer.finished_iters
+        if self.state_interval and finished % self.state_interval == 0:
+            state_file = osp.join(self.trainer.work_dir, 'state_iter_{}.pth'.format(finished))
+            self.state_writer.save(self.trainer.state_dict(), state_file)
+
     def after_epoch(self):
         epoch = self.trainer.cur_epoch
         if epoch % self.ckpt_cfg.interval == 0:
             epoch_model = osp.join(self.trainer.work_dir, 'epoch_{}.pth'.format(epoch))
-            torch.save(self.trainer.model.state_dict(), epoch_model)
-            logging.info('Finished training epoch {}, saved trained model to {}'.format(epoch, epoch_model))
+            self.writer.save(self.trainer.state_dict(full=False), epoch_model)
+            logging.info('Finished training epoch {}, saving trained model to {}'.format(epoch, epoch_model))
+
+    def after_train_all(self):
+        self.writer.wait()
+        self.state_writer.wait()
 
 # print loss, eta infomation on screen
 import datetime
@@ -159,3 +206,88 @@ class ReportHook(Hook):
             self.tic=now
             self.loss_tracker = []
 
+
+
+# eval_cfg:
+#   interval: evaluate every interval epochs, and after the last epoch
+#   num_imgs: evaluate on num_imgs images evenly spaced over the eval dataset, default all
+#   imgs_per_gpu, num_workers: of the eval dataloader, default 1 and 2
+#   flush_imgs: images that are matched together by StreamingEvaluator, default 64
+class EvalHook(Hook):
+    def __init__(self, trainer, priority=1):
+        super(EvalHook, self).__init__(priority)
+        from torch.utils.data import Subset
+        from ..evaluator import StreamingEvaluator
+        from ..tester import BasicTester
+        self.trainer = trainer
+        self.eval_cfg = trainer.eval_cfg
+        dataset = trainer.eval_dataset
+        num_imgs = min(self.eval_cfg.get('num_imgs', None) or len(dataset), len(dataset))
+        inds = np.unique(np.linspace(0, len(dataset)-1, num_imgs).round().astype(np.int64)).tolist()
+        self.dataloader = self.build_dataloader(Subset(dataset, inds))
+        self.evaluator = StreamingEvaluator(dataset.coco_api(), [dataset.img_infos[i]['id'] for i in inds],
+                                            self.eval_cfg.get('flush_imgs', 64))
+        # a tester shares the model with trainer, it runs forward_test and collects results, it does
+        # not need train_cfg, which BasicTester would deep copy along with what it holds
+        self.tester = BasicTester(trainer.model, None, trainer.model.test_cfg, trainer.device,
+                                  channels_last=trainer.memory_format == torch.channels_last)
+        self.history = []
+
+    def build_dataloader(self, dataset):
+        from mmdet.datasets import build_dataloader
+        return build_dataloader(dataset, self.eval_cfg.get('imgs_per_gpu', 1), self.eval_cfg.get('num_workers', 2),
+                                1, dist=False, shuffle=False)
+
+    def report_writer(self):
+        for hk_prio in self.trainer.hooks:
+            for hk in hk_prio:
+                if isinstance(hk, ReportHook):
+                    return hk.writer
+        return None
+
+    def evaluate(self):
+        '''
+        Returns:
+            stats: the 12 numbers of COCOeval.stats on the eval images
+        '''
+        model = self.trainer.model
+        was_training = model.training
+        model.eval()
+        try:
+            with torch.no_grad():
+                for eval_data in self.dataloader:
+                    img_metas = eval_data['img_meta'].data[0]
+                    bboxes, scores, categories = self.tester.inference_one(eval_data['img'].data[0], img_metas)
+                    batch_res = []
+                    self.tester.collect_results(batch_res, bboxes, scores, categories, img_metas)
+                    self.evaluator.add(batch_res)
+            return self.evaluator.evaluate()
+        finally:
+            self.evaluator.reset()
+            model.train(was_training)
+
+    def after_epoch(self):
+        epoch = self.trainer.cur_epoch
+        if epoch % self.eval_cfg.interval != 0 and epoch != self.trainer.total_epochs:
+            return
+        tic = datetime.datetime.now()
+        stats = self.evaluate()
+        now = datetime.datetime.now()
+        self.history.append({'epoch': epoch, 'mAP': float(stats[0]), 'AP50': float(stats[1])})
+        line = str(now)[:str(now).rfind('.')] + ': ' + ', '.join([
+            '[{}]'.format(epoch),
+            'eval on {} images'.format(len(self.evaluator.img_ids)),
+            'mAP: {:.4f}'.format(stats[0]),
+            'AP50: {:.4f}'.format(stats[1]),
+            'time: {:.1f}s'.format((now - tic).total_seconds())])
+        print(line)
+        logging.info(line)
+        writer = self.report_writer()
+        if writer is not None:
+            writer.write_line(line)
+
+    def state_dict(self):
+        return {'history': self.history}
+
+    def load_state_dict(self, state):
+        self.history = state['history']
@@ -1,4 +1,6 @@
-from .hooks import OptimizerHook, Hookable, LrHook, CkptHook, ReportHook
+from .hooks import OptimizerHook, Hookable, LrHook, CkptHook, ReportHook, EvalHook
+from .checkpoint import ResumableSampler, get_rng_state, set_rng_state
+from .. import utils
 from collections import OrderedDict
 import torch, time, copy, logging, traceback
 import os.path as osp
@@ -16,9 +18,14 @@ class BasicTrainer(Hookable):
                  ckpt_cfg,
                  report_cfg,
                  log_cfg=None,
-                 device='cpu'):
+                 device='cpu',
+                 channels_last=False,
+                 eval_cfg=None,
+                 eval_dataset=None):
         super(BasicTrainer, self).__init__()
         self.device=device
+        # run model in channels_last memory format, input batch is converted once per iteration
+        self.memory_format=utils.memory_format(channels_last)
         self.dataloader=dataloader
         self.work_dir=work_dir
         self.model=model
@@ -29,9 +36,17 @@ class BasicTrainer(Hookable):
         self.log_cfg=log_cfg
         self.ckpt_cfg=ckpt_cfg
         self.report_cfg=report_cfg
+        # eval_cfg: None to train without evaluation, or cfg of EvalHook on eval_dataset
+        self.eval_cfg=eval_cfg
+        self.eval_dataset=eval_dataset
 
         self.cur_iter=1
         self.cur_epoch=1
+        # number of finished iterations in total and in current epoch
+        self.finished_iters=0
+        self.epoch_finished_iters=0
+        self.resume_epoch_iters=0
+        self.sampler=ResumableSampler.install(dataloader)
         self.total_epochs=train_cfg.total_epochs
         self.initial_lr=optimizer_cfg.lr
         
@@ -42,6 +57,8 @@ class BasicTrainer(Hookable):
         self.add_hook(LrHook(self))
         self.add_hook(CkptHook(self))
         self.add_hook(ReportHook(self))
+        if eval_cfg is not None:
+            self.add_hook(EvalHook(self))
 
     def init_optimizer(self):
         from ..builder import build_module
@@ -72,9 +89,49 @@ class BasicTrainer(Hookable):
     def get_total_iters(self):
         return len(self.dataloader) * (self.total_epochs)
 
+    # full=False only keeps model and optimizer, which is enough to resume from the end of an epoch
+    def state_dict(self, full=True):
+        state = {
+            'meta': {'epoch': self.cur_epoch,
+                     'iter': self.finished_iters+1,
+                     'epoch_iter': self.epoch_finished_iters},
+            'state_dict': self.model.state_dict(),
+            'optimizer': self.optimizer.state_dict()}
+        if full:
+            state['hooks'] = self.hooks_state_dict()
+            state['rng'] = get_rng_state()
+            state['epoch_rng'] = self.sampler.rng_state
+        return state
+
+    # resume from a ckpt saved by CkptHook, either a trainer state or an epoch ckpt
+    def resume(self, ckpt_file):
+        ckpt = torch.load(ckpt_file, map_location='cpu')
+        assert 'meta' in ckpt and 'optimizer' in ckpt, 'Can not resume from {}'.format(ckpt_file)
+        # optimizer states are moved to device of params while loading
+        self.model.to(self.device)
+        self.model.load_state_dict(ckpt['state_dict'])
+        self.optimizer.load_state_dict(ckpt['optimizer'])
+        self.load_hooks_state_dict(ckpt.get('hooks', {}))
+        meta = ckpt['meta']
+        self.cur_epoch = meta['epoch']
+        self.cur_iter = meta['iter']
+        self.finished_iters = self.cur_iter - 1
+        epoch_iters = meta.get('epoch_iter', len(self.dataloader))
+        if epoch_iters >= len(self.dataloader) or ckpt.get('epoch_rng', None) is None:
+            # the saved epoch is finished, or its sample order is unknown
+            self.cur_epoch += 1
+            self.resume_epoch_iters = 0
+            if 'rng' in ckpt:
+                set_rng_state(ckpt['rng'])
+        else:
+            self.resume_epoch_iters = epoch_iters
+            self.sampler.resume(ckpt['epoch_rng'], epoch_iters * self.dataloader.batch_size, ckpt['rng'])
+        logging.info('Resumed from {}, epoch={}, iter={}, finished iters in epoch={}'.format(
+            ckpt_file, self.cur_epoch, self.cur_iter, self.resume_epoch_iters))
+
     def train(self):
         logging.info('Start a new training, start with epoch {}'.format(self.cur_epoch))
-        self.model.to(self.device)
+        self.model.to(self.device, memory_format=self.memory_format)
         self.model.train()
         dataset_size = len(self.dataloader)
         logging.info('Dataset size: {}'.format(dataset_size))
@@ -82,9 +139,13 @@ class BasicTrainer(Hookable):
         logging.info('Initial lr: {}'.format(self.initial_lr))
         for epoch in range(self.cur_epoch, self.total_epochs+1):
             self.cur_epoch = epoch
-            self.call_hooks('before_epoch')
+            start_iter, self.resume_epoch_iters = self.resume_epoch_iters, 0
+            self.epoch_finished_iters = start_iter
+            # before_epoch hooks already run for an epoch that is resumed in the middle
+            if start_iter == 0:
+                self.call_hooks('before_epoch')
             logging.info('Start to train epoch={}, with lr={}'.format(epoch, self.get_lr()))
-            for iter_i, train_data in enumerate(self.dataloader):
+            for iter_i, train_data in enumerate(self.dataloader, start_iter):
                 try:
                     self.train_one_iter(iter_i, epoch, train_data)
                     self.cur_iter += 1
@@ -100,7 +161,7 @@ class BasicTrainer(Hookable):
     def train_one_iter(self, iter_i, epoch, train_data):
         self.call_hooks('before_iter')
         img_metas = train_data['img_meta'].data[0]
-        img_data = train_data['img'].data[0].to(self.device)
+        img_data = train_data['img'].data[0].to(self.device, memory_format=self.memory_format)
 
         gt_bboxes = train_data['gt_bboxes'].data[0]
         gt_bboxes = [gt_bbox.to(self.device).t() for gt_bbox in gt_bboxes]
@@ -124,6 +185,8 @@ class BasicTrainer(Hookable):
         
         self.call_hooks('before_step')
         self.optimizer.step()
+        self.finished_iters += 1
+        self.epoch_finished_iters += 1
         self.call_hooks('after_step')
 
         
@@ -0,0 +1,268 @@
+import logging, torch
+import torch.nn.functional as F
+from torch import nn
+from . import utils
+from .utils import class_name
+
+'''
+Test-time augmentation(multi-scale + horizontal flip) of RetinaNet, FCOS and CascadeRCNN.
+
+Augmented images are made from the image tensor of the test pipeline: the valid region of each
+image is resized by each scale, flipped and padded to size_divisor. Augmentations whose padded
+shapes are the same, e.g. an image and its flip, or close enough(see max_pad_ratio) are padded
+into one tensor and run in one forward, so TTA of S scales with flip takes at most S forwards.
+
+Candidates before nms of all augmentations are mapped back to the input image in one
+vectorized step and merged by one nms per image, optionally followed by box voting, i.e. each
+kept bbox is replaced by the score weighted average of candidates of the same class that
+overlap it by at least vote_iou.
+'''
+
+
+# bbox: [4, ..., n] in augmented image, img_w, rx, ry and flip broadcast to [..., n]
+def unaug_bboxes(bbox, img_w, rx, ry, flip):
+    x1, y1, x2, y2 = bbox.unbind(0)
+    x1, x2 = torch.where(flip, img_w - 1 - x2, x1), torch.where(flip, img_w - 1 - x1, x2)
+    return torch.stack([x1 / rx, y1 / ry, x2 / rx, y2 / ry])
+
+
+def box_voting(keep_bbox, keep_label, bbox, score, label_offset, iou_thr):
+    '''
+    Args:
+        keep_bbox: [4, m], bboxes kept by nms, keep_label: [m]
+        bbox: [4, n] or [4, num_classes, n], candidates
+        score: [cls_channels, n], scores of candidates, channel of label l is l - label_offset
+    Returns:
+        voted bboxes [4, m]
+    '''
+    if keep_label.numel() == 0:
+        return keep_bbox
+    chan = keep_label - label_offset
+    cand = bbox[:, chan] if bbox.dim() == 3 else bbox.unsqueeze(1).expand(-1, len(chan), -1)
+    ref = keep_bbox.unsqueeze(2)
+    tl = torch.max(ref[:2], cand[:2])
+    br = torch.min(ref[2:], cand[2:])
+    area_i = (br - tl + 1).clamp(min=0).prod(0)
+    area_ref = (ref[2:] - ref[:2] + 1).prod(0)
+    area_cand = (cand[2:] - cand[:2] + 1).prod(0)
+    iou = area_i / (area_ref + area_cand - area_i)
+    weight = score[chan] * (iou >= iou_thr).to(score)
+    weight_sum = weight.sum(1)
+    voted = (cand * weight).sum(2) / weight_sum.clamp(min=1e-12)
+    return torch.where(weight_sum > 0, voted, keep_bbox)
+
+
+class TTADetector(nn.Module):
+    '''
+    It has the same forward_test as detectors, so that BasicTester can use it in place of one.
+
+    Args:
+        model: a detector, or a StaticDetector of RetinaNet/FCOS whose dense part is then run
+               compiled or traced
+        scales: scales relative to the image of the test pipeline
+        flip: add a horizontally flipped image for each scale
+        merge: 'nms' or 'vote'(nms followed by box voting)
+        vote_iou: iou threshold of box voting
+        max_pad_ratio: augmentations of a smaller scale share a forward with a larger one if it
+                       pads them by at most this ratio of the area of the larger one, 0 only
+                       batches augmentations of the same padded shape
+        size_divisor: augmented images are padded to a multiple of it
+    '''
+    DETECTORS = ('RetinaNet', 'FCOS', 'CascadeRCNN')
+
+    def __init__(self, model, scales=(1.0, ), flip=True, merge='nms', vote_iou=0.6,
+                 max_pad_ratio=0.0, size_divisor=32):
+        super(TTADetector, self).__init__()
+        self.model = model
+        self.detector = getattr(model, 'detector', model)
+        assert class_name(self.detector) in self.DETECTORS, \
+            '{} does not support TTA'.format(class_name(self.detector))
+        assert merge in ('nms', 'vote'), 'Unknown merge method: {}'.format(merge)
+        self.augs = [(scale, f) for scale in scales for f in ([False, True] if flip else [False])]
+        self.merge = merge
+        self.vote_iou = vote_iou
+        self.max_pad_ratio = max_pad_ratio
+        self.size_divisor = size_divisor
+        logging.info('TTA of {}: {}, merged by {}'.format(class_name(self.detector), self.augs, merge))
+
+    def pad_size(self, x):
+        return (x + self.size_divisor - 1) // self.size_divisor * self.size_divisor
+
+    def aug_shapes(self, img_metas):
+        '''
+        Image shapes and padded shape of each augmentation.
+        '''
+        shapes = []
+        for scale, _ in self.augs:
+            img_shapes = [(max(1, int(img_meta['img_shape'][0] * scale + 0.5)),
+                           max(1, int(img_meta['img_shape'][1] * scale + 0.5))) for img_meta in img_metas]
+            shapes.append((img_shapes, (self.pad_size(max(h for h, _ in img_shapes)),
+                                        self.pad_size(max(w for _, w in img_shapes)))))
+        return shapes
+
+    def group_augs(self, pad_shapes):
+        '''
+        Greedily group augmentations in descending order of area, each group is one forward.
+        '''
+        order = sorted(range(len(pad_shapes)), key=lambda k: -pad_shapes[k][0] * pad_shapes[k][1])
+        groups = []
+        for k in order:
+            h, w = pad_shapes[k]
+            for group in groups:
+                gh, gw = group['shape']
+                if h <= gh and w <= gw and (1 - self.max_pad_ratio) * gh * gw <= h * w:
+                    group['augs'].append(k)
+                    break
+            else:
+                groups.append({'shape': (h, w), 'augs': [k]})
+        return groups
+
+    def aug_batch(self, img_data, img_metas, aug_inds, img_shapes, pad_shape):
+        '''
+        One tensor of all images of the given augmentations, and their img_metas.
+        '''
+        num_imgs = img_data.shape[0]
+        batch = img_data.new_zeros(len(aug_inds) * num_imgs, img_data.shape[1], *pad_shape)
+        batch = batch.contiguous(memory_format=utils.memory_format(
+            img_data.is_contiguous(memory_format=torch.channels_last)))
+        metas = []
+        for j, k in enumerate(aug_inds):
+            scale, flip = self.augs[k]
+            for i, img_meta in enumerate(img_metas):
+                h, w = img_meta['img_shape'][:2]
+                ah, aw = img_shapes[k][i]
+                img = img_data[i:i+1, :, :h, :w]
+                if (ah, aw) != (h, w):
+                    img = F.interpolate(img, size=(ah, aw), mode='bilinear', align_corners=False)
+                if flip:
+                    img = img.flip(-1)
+                batch[j*num_imgs + i, :, :ah, :aw] = img[0]
+                meta = dict(img_meta)
+                meta.update(img_shape=(ah, aw, 3), pad_shape=tuple(pad_shape) + (3, ), flip=flip,
+                            scale_factor=img_meta['scale_factor'] * scale)
+                metas.append(meta)
+        return batch, metas
+
+    def dense_candidates(self, batch, metas):
+        '''
+        Candidates of RetinaNet and FCOS, all [B, ...] with B = number of augmented images.
+
+        Returns:
+            bboxes: [B, 4, K], scores: [B, cls_channels, K], factors: [B, K] or None(centerness
+            multiplied to scores in nms), valid: [B, K]
+        '''
+        device = batch.device
+        img_sizes = torch.tensor([meta['img_shape'][:2] for meta in metas], device=device)
+        scale_factors = torch.tensor([float(meta['scale_factor']) for meta in metas], device=device)
+        dense_outs = self.model.forward_dense(batch, img_sizes, scale_factors)
+        test_cfg = self.detector.test_cfg
+        if class_name(self.detector) == 'FCOS':
+            bboxes, scores, ctr_scores, valid = dense_outs
+            factors = ctr_scores if self.detector.bbox_head.use_centerness else None
+            return bboxes, scores, factors, valid
+        # same as AnchorHead.predict_post, but for all images at once
+        bboxes, scores = dense_outs
+        dtype = bboxes.dtype
+        max_x = img_sizes[:, 1].view(-1, 1).to(dtype) - 1
+        max_y = img_sizes[:, 0].view(-1, 1).to(dtype) - 1
+        x1, y1, x2, y2 = bboxes.unbind(1)
+        x1, x2 = torch.min(x1.clamp(min=0.0), max_x), torch.min(x2.clamp(min=0.0), max_x)
+        y1, y2 = torch.min(y1.clamp(min=0.0), max_y), torch.min(y2.clamp(min=0.0), max_y)
+        min_size = (scale_factors * test_cfg.min_bbox_size).view(-1, 1).to(dtype)
+        valid = (x2-x1 + 1 >= min_size) & (y2-y1 + 1 >= min_size)
+        return torch.stack([x1, y1, x2, y2], dim=1), scores, None, valid
+
+    def rcnn_candidates(self, batch, metas):
+        '''
+        Candidates of CascadeRCNN, lists over augmented images of bboxes [4, n] or
+        [4, num_classes, n], scores [num_classes, n], factors None and valid [n].
+        '''
+        detector = self.detector
+        head = detector.rcnn_head[-1]
+        feats = detector.extract_feat(batch)
+        props, cls_outs, reg_outs = detector.predict_rcnn_outs(feats, metas)
+        bboxes, scores = [], []
+        for prop, cls_out, reg_out, meta in zip(props, cls_outs, reg_outs, metas):
+            bbox, score = head.decode_bboxes_single_image(prop, cls_out, reg_out, meta['img_shape'][:2])
+            bboxes.append(bbox.view(4, -1, bbox.shape[1]).squeeze(1))
+            scores.append(score.t())
+        return bboxes, scores, [None] * len(metas), [score.new_ones(score.shape[1], dtype=torch.bool)
+                                                      for score in scores]
+
+    def merge_candidates(self, bbox, score, factor):
+        '''
+        nms(and box voting) of candidates of all augmentations of one image.
+        '''
+        detector = self.detector
+        name = class_name(detector)
+        if name == 'RetinaNet':
+            head, cfg = detector.bbox_head, detector.test_cfg
+            keep_bbox, keep_score, keep_label = head.nms_single_image(bbox, score, cfg)
+            label_offset = 1 if head.use_sigmoid else 0
+        elif name == 'FCOS':
+            head, cfg = detector.bbox_head, detector.test_cfg
+            keep_bbox, keep_score, keep_label = head.nms_single_image(bbox, score, factor, cfg)
+            label_offset = 1
+        else:
+            head, cfg = detector.rcnn_head[-1], detector.test_cfg.rcnn
+            keep_bbox, keep_score, keep_label = utils.multiclass_nms(
+                bbox.reshape(-1, bbox.shape[-1]).t(), score.t(), range(1, head.num_classes),
+                cfg.nms_iou, cfg.min_score, cfg.max_per_img, mode=cfg.get('nms_type', 'official'))
+            keep_bbox = keep_bbox.t()
+            label_offset = 0
+        if self.merge == 'vote':
+            vote_score = score if factor is None else score * factor
+            keep_bbox = box_voting(keep_bbox, keep_label, bbox, vote_score, label_offset, self.vote_iou)
+        return keep_bbox, keep_score, keep_label
+
+    def forward_test(self, img_data, img_metas):
+        num_imgs = len(img_metas)
+        shapes = self.aug_shapes(img_metas)
+        groups = self.group_augs([pad_shape for _, pad_shape in shapes])
+        dense = class_name(self.detector) != 'CascadeRCNN'
+        # candidates of augmented images, indexed by aug * num_imgs + image
+        cands = [None] * (len(self.augs) * num_imgs)
+        with torch.no_grad():
+            for group in groups:
+                logging.info('TTA forward of augmentations {} in shape {}'.format(
+                    [self.augs[k] for k in group['augs']], group['shape']))
+                batch, metas = self.aug_batch(img_data, img_metas, group['augs'],
+                                              [img_shapes for img_shapes, _ in shapes], group['shape'])
+                if dense:
+                    outs = [list(x.unbind(0)) if x is not None else [None] * len(metas)
+                            for x in self.dense_candidates(batch, metas)]
+                else:
+                    outs = self.rcnn_candidates(batch, metas)
+                for j, k in enumerate(group['augs']):
+                    for i in range(num_imgs):
+                        cands[k*num_imgs + i] = [out[j*num_imgs + i] for out in outs]
+
+            # map bboxes of all augmented images back at once
+            bboxes, scores, factors, valid = utils.unpack_multi_result(cands)
+            num_cands = [bbox.shape[-1] for bbox in bboxes]
+            img_w, rx, ry, flip = [], [], [], []
+            for k, (scale, f) in enumerate(self.augs):
+                for i, img_meta in enumerate(img_metas):
+                    h, w = img_meta['img_shape'][:2]
+                    ah, aw = shapes[k][0][i]
+                    img_w.append(aw)
+                    rx.append(aw / w)
+                    ry.append(ah / h)
+                    flip.append(f)
+            device = img_data.device
+            repeats = torch.tensor(num_cands, device=device)
+            img_w, rx, ry = [torch.tensor(x, device=device, dtype=bboxes[0].dtype).repeat_interleave(repeats)
+                             for x in (img_w, rx, ry)]
+            flip = torch.tensor(flip, device=device).repeat_interleave(repeats)
+            all_bboxes = unaug_bboxes(torch.cat(bboxes, dim=-1), img_w, rx, ry, flip)
+            bboxes = list(all_bboxes.split(num_cands, dim=-1))
+
+            preds = []
+            for i in range(num_imgs):
+                inds = [k*num_imgs + i for k in range(len(self.augs))]
+                img_valid = torch.cat([valid[j] for j in inds])
+                bbox = torch.cat([bboxes[j] for j in inds], dim=-1)[..., img_valid]
+                score = torch.cat([scores[j] for j in inds], dim=-1)[:, img_valid]
+                factor = None if factors[inds[0]] is None else torch.cat([factors[j] for j in inds])[img_valid]
+                preds.append(self.merge_candidates(bbox, score, factor))
+        return utils.unpack_multi_result(preds)
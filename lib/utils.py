@@ -2,7 +2,9 @@ from PIL import Image
 
 import torchvision as tv
 import torch
+from torch.utils.checkpoint import checkpoint as torch_checkpoint
 import numpy as np
+import concurrent.futures, threading, logging, atexit
 from . import debug
 
 IMGNET_MEAN = [0.485, 0.456, 0.406]
@@ -275,6 +277,68 @@ def one_hot_embedding(label, n_cls):
     one_hot[torch.arange(n), label] = 1
     return one_hot
 
+# run fn(*args) with activation checkpointing: activations inside fn are not kept for backward,
+# they are recomputed during backward instead, which trades extra compute for memory
+def checkpoint(fn, *args, enabled=True):
+    if enabled and torch.is_grad_enabled():
+        return torch_checkpoint(fn, *args, use_reentrant=False)
+    return fn(*args)
+
+def memory_format(channels_last=False):
+    return torch.channels_last if channels_last else torch.contiguous_format
+
+# how multi_apply runs the per-image calls, set by set_multi_apply
+MULTI_APPLY_BACKENDS = ['serial', 'thread', 'process']
+_multi_apply_cfg = {'backend': 'serial', 'num_workers': 1, 'intra_op_threads': None}
+_multi_apply_pool = None
+# calls made inside a worker run serially, a pool waiting on itself would dead lock
+_multi_apply_local = threading.local()
+
+def set_multi_apply(backend='serial', num_workers=None, intra_op_threads=None):
+    '''
+    Args:
+        backend: 'serial' runs calls one by one in the caller, 'thread' runs them in a thread pool,
+            'process' runs them in a process pool, only when grad is disabled, e.g. in inference,
+            func and args are pickled to the workers on each call.
+        num_workers: size of the pool, defaults to 4.
+        intra_op_threads: torch threads of each worker, so that workers do not oversubscribe cores.
+    Results keep the order of images with any backend. Random draws inside calls, e.g. of samplers,
+    interleave across workers, so training is reproducible only with 'serial'.
+    '''
+    global _multi_apply_pool
+    if backend not in MULTI_APPLY_BACKENDS:
+        raise ValueError('Unknown multi_apply backend: {}, choose from {}'.format(backend, MULTI_APPLY_BACKENDS))
+    if _multi_apply_pool is not None:
+        _multi_apply_pool.shutdown()
+        _multi_apply_pool = None
+    _multi_apply_cfg.update(backend=backend, num_workers=num_workers or 4, intra_op_threads=intra_op_threads)
+    logging.info('multi_apply: {}'.format(_multi_apply_cfg))
+
+def _init_multi_apply_worker(intra_op_threads):
+    _multi_apply_local.in_worker = True
+    if intra_op_threads is not None:
+        torch.set_num_threads(intra_op_threads)
+
+def _multi_apply_executor():
+    global _multi_apply_pool
+    if _multi_apply_pool is None:
+        cfg = _multi_apply_cfg
+        pool_cls = concurrent.futures.ThreadPoolExecutor if cfg['backend'] == 'thread' \
+                   else concurrent.futures.ProcessPoolExecutor
+        _multi_apply_pool = pool_cls(max_workers=cfg['num_workers'], initializer=_init_multi_apply_worker,
+                                     initargs=(cfg['intra_op_threads'], ))
+    return _multi_apply_pool
+
+@atexit.register
+def _shutdown_multi_apply():
+    if _multi_apply_pool is not None:
+        _multi_apply_pool.shutdown()
+
+# grad mode is thread local, calls in a thread pool follow the mode of the caller
+def _call_with_grad(grad_enabled, func, args):
+    with torch.set_grad_enabled(grad_enabled):
+        return func(*args)
+
 def multi_apply(func, *args):
     list_args = [arg for arg in args if isinstance(arg, list)]
     if len(list_args) == 0:
@@ -284,7 +348,7 @@ def multi_apply(func, *args):
     for arg in list_args:
         if len(arg) != mult_arg_len:
             raise ValueError('Arg: {} does not have the same length as others'.format(arg))
-    result = []
+    all_args = []
     for i in range(mult_arg_len):
         cur_args = []
         for arg in args:
@@ -292,8 +356,18 @@ def multi_apply(func, *args):
                 cur_args.append(arg[i])
             else:
                 cur_args.append(arg)
-        result.append(func(*cur_args))
-    return result
+        all_args.append(cur_args)
+
+    backend = _multi_apply_cfg['backend']
+    grad_enabled = torch.is_grad_enabled()
+    if backend == 'process' and grad_enabled:
+        # autograd graphs do not cross processes
+        backend = 'serial'
+    if backend == 'serial' or mult_arg_len < 2 or getattr(_multi_apply_local, 'in_worker', False):
+        return [func(*cur_args) for cur_args in all_args]
+    futures = [_multi_apply_executor().submit(_call_with_grad, grad_enabled, func, cur_args)
+               for cur_args in all_args]
+    return [future.result() for future in futures]
 # WARNING: assume the return of one call has multi values to avoid ambiguity 
 def unpack_multi_result(multi_res):
     assert len(multi_res) != 0
@@ -336,9 +410,9 @@ def tensor_shape(tsr):
     return '\n'.join(tensor_shape_helper(tsr))
 
 def full_index(size):
-    full_one = torch.full(size, 1)
-    all_idx = full_one.nonzero()
-    return all_idx.view(*size, len(size))
+    # same as torch.full(size, 1).nonzero(), but without data dependent shape
+    grids = torch.meshgrid(*[torch.arange(s) for s in size], indexing='ij')
+    return torch.stack(grids, dim=-1)
 
 # apply func to all elements in nested list or tuple
 def inplace_apply(nested, func):
@@ -366,6 +440,34 @@ def sort_bbox(bbox, labels=None, descending=False):
     return bbox[:, idx], labels[idx] if labels is not None else None
     
 
+# Dense head outputs of one image are in shape [n*A, H, W], where A is number of anchors per place.
+# Viewing it as [n, A, H*W] keeps the order of anchors [4, A, H, W], and unlike .view(n, -1) it
+# needs no copy for both contiguous and channels_last outputs.
+# Batched outputs [N, n*A, H, W] are viewed as [N, n, A, H*W] in the same way.
+def grid_channels_view(x, n):
+    return x.view(*x.shape[:-3], n, -1, x.shape[-2]*x.shape[-1])
+
+# take columns of the flattened [n, A*H*W] from a [n, A, H*W] view, only taken values are copied,
+# for batched views [N, n, A, H*W], inds is [N, k] and it returns [N, n, k]
+def take_grid_channels(x, inds):
+    num_places = x.shape[-1]
+    if x.dim() == 3:
+        return x[:, inds // num_places, inds % num_places]
+    batch_inds = torch.arange(x.shape[0], device=x.device).view(-1, 1)
+    return x[batch_inds, :, inds // num_places, inds % num_places].permute(0, 2, 1)
+
+# flatten outputs [n*A, H, W] of all levels to [n, A*H*W] and concatenate them, each output is
+# copied exactly once whatever its memory format
+def concate_grid_channels(level_outs, n):
+    views = [grid_channels_view(x, n) for x in level_outs]
+    sizes = [v.shape[1]*v.shape[2] for v in views]
+    out = views[0].new_empty(n, sum(sizes))
+    start = 0
+    for v, size in zip(views, sizes):
+        out.narrow(1, start, size).view_as(v).copy_(v)
+        start += size
+    return out
+
 # grid_res is a list of results in grid format, e.g tensor([136, 100, 4]) which could be a
 # coordinate data of feature map (136, 100)
 # last means the data dim is the last, otherwise it is at the first
@@ -5,6 +5,32 @@ parser.add_argument('ckpt', help='Model ckpt file ending with .pth')
 parser.add_argument('--gpu', help='GPU cardinal, only support single GPU at now.')
 parser.add_argument('--out', required=True, help='Output result in json format.')
 parser.add_argument('--log', help='Output log to this file.')
+parser.add_argument('--static', choices=['eager', 'compile', 'trace'],
+                    help='Run dense part of RetinaNet/FCOS as a static graph, '
+                    'with torch.compile(compile) or torch.jit.trace(trace).')
+parser.add_argument('--int8', type=int, metavar='N',
+                    help='Quantize convs to int8 with calibration over N train images, CPU only.')
+parser.add_argument('--int8-skip', nargs='+', default=[],
+                    help='Modules that stay in fp32 when quantizing, e.g. bbox_head.retina_cls')
+parser.add_argument('--fc-int8', action='store_true',
+                    help='Quantize fc layers of rcnn heads dynamically to int8, CPU only.')
+parser.add_argument('--fc-svd', type=int, metavar='RANK',
+                    help='Factorize fc layers of rcnn heads with truncated SVD of this rank.')
+parser.add_argument('--tta-scales', type=float, nargs='+',
+                    help='Test-time augmentation with these scales of test images, e.g. 0.8 1.0 1.2')
+parser.add_argument('--tta-flip', action='store_true', help='Test-time augmentation with horizontal flip.')
+parser.add_argument('--tta-merge', choices=['nms', 'vote'], default='nms',
+                    help='Merge predictions of augmentations by nms, or nms followed by box voting.')
+parser.add_argument('--tta-pad', type=float, default=0.0,
+                    help='Scales that need at most this ratio of padding run in one forward.')
+parser.add_argument('--feat-cache', metavar='DIR',
+                    help='Cache backbone/neck features of the ckpt under DIR, later runs with the same ckpt '
+                    'run only heads on cached features.')
+parser.add_argument('--feat-cache-fp32', action='store_true', help='Cache features in fp32 instead of fp16.')
+parser.add_argument('--cocoeval', action='store_true',
+                    help='Evaluate the json of --out with COCOeval of pycocotools instead of in process.')
+parser.add_argument('--eval-workers', type=int, default=0,
+                    help='Processes of the in-process evaluator, categories are evaluated in parallel.')
 
 args = parser.parse_args()
 
@@ -12,12 +38,10 @@ import os, sys, glob, random, logging, json
 import os.path as osp
 import mmcv, torch
 from lib import datasets
-from lib.tester import BasicTester
+from lib.tester import BasicTester, results2json, coco_eval
+from lib.utils import set_multi_apply
 import torch, time
 
-from pycocotools.coco import COCO
-from pycocotools.cocoeval import COCOeval
-
 def check_args():
     args.config_file = osp.realpath(args.config)
     args.config = mmcv.Config.fromfile(args.config)
@@ -32,6 +56,28 @@ def set_seed(seed):
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
 
+def tta_args():
+    if args.tta_scales is None and not args.tta_flip:
+        return None
+    return dict(scales=args.tta_scales or [1.0], flip=args.tta_flip, merge=args.tta_merge,
+                max_pad_ratio=args.tta_pad, size_divisor=32)
+
+def inference_with_cache(tester, dataloader):
+    from lib.feat_cache import FeatureCache, FeatureCacheWriter, cache_dir, config_fingerprint, dataset_img_ids
+    assert args.int8 is None and args.static is None and tta_args() is None, \
+        '--feat-cache can not be used with --int8, --static or TTA'
+    cur_dir = cache_dir(args.feat_cache, args.ckpt)
+    img_ids = dataset_img_ids(dataloader.dataset)
+    fingerprint = config_fingerprint(args.config, img_ids)
+    if FeatureCache.exists(cur_dir, fingerprint):
+        print('use cached features in {}'.format(cur_dir))
+        return tester.inference_cached(FeatureCache(cur_dir), img_ids)
+    print('cache features in {}'.format(cur_dir))
+    writer = FeatureCacheWriter(cur_dir, fingerprint, fp16=not args.feat_cache_fp32)
+    infer_res = tester.inference(dataloader, writer)
+    writer.close()
+    return infer_res
+
 
 def main():
     check_args()
@@ -56,6 +102,7 @@ def main():
     if args.gpu is not None:
         device = torch.device('cuda:{}'.format(args.gpu))
     print('device:', device)
+    set_multi_apply(**config.get('multi_apply', {}))
     from lib.builder import build_module
     model = build_module(config.model, train_cfg=config.train_cfg, test_cfg=config.test_cfg)
     model.to(device)
@@ -66,35 +113,35 @@ def main():
         model,
         config.train_cfg,
         config.test_cfg,
-        device)
+        device,
+        channels_last=config.get('channels_last', False),
+        static=args.static,
+        tta=tta_args())
 
     tester.load_ckpt(args.ckpt)
+    if args.int8 is not None:
+        from lib.quantize import quantize_int8, build_calib_dataloader
+        assert device.type == 'cpu', 'int8 inference only runs on CPU'
+        quantize_int8(tester.model, build_calib_dataloader(config, args.int8), args.int8, args.int8_skip)
+    if args.fc_int8 or args.fc_svd is not None:
+        from lib.quantize import compress_fcs
+        assert not args.fc_int8 or device.type == 'cpu', 'int8 inference only runs on CPU'
+        compress_fcs(tester.model, args.fc_svd, args.fc_int8)
     start = time.time()
-    infer_res = tester.inference(dataloader)
+    if args.feat_cache is not None:
+        infer_res = inference_with_cache(tester, dataloader)
+    else:
+        infer_res = tester.inference(dataloader)
+    infer_time = time.time() - start
 
-    anno_idx, out_json = 0, []
-    for pred in infer_res:
-        iid, bbox_xywh, score, category, filename \
-            = pred['image_id'], pred['bbox'], pred['score'], pred['category'], pred['file_name']
-        for i, cur_bbox in enumerate(bbox_xywh):
-            cur_pred = {
-                'id': anno_idx,
-                'image_id': iid,
-                'file_name': filename,
-                'bbox': [round(x.item(), 2) for x in cur_bbox],
-                'score': round(score[i].item(), 3),
-                'category_id': category[i].item()
-            }
-            out_json.append(cur_pred)
-            anno_idx += 1
-    json.dump(out_json, open(args.out, 'w'))
-    gt = COCO(config.data.test.ann_file)
-    dt = gt.loadRes(args.out)
-    img_ids = gt.getImgIds()
-    cocoEval = COCOeval(gt, dt, 'bbox')
-    cocoEval.evaluate()
-    cocoEval.accumulate()
-    cocoEval.summarize()
+    json.dump(results2json(infer_res), open(args.out, 'w'))
+    # reuse annotations already loaded by dataset instead of parsing ann_file again
+    if args.cocoeval:
+        coco_eval(dataset.coco_api(), args.out)
+    else:
+        from lib.evaluator import COCOEvaluator, print_stats
+        print_stats(COCOEvaluator(dataset.coco_api(), num_workers=args.eval_workers).evaluate(infer_res))
+    print('inference time: {:.1f} ms/img'.format(infer_time * 1000 / len(dataset)))
     
 if __name__ == '__main__':
     main()
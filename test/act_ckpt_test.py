@@ -0,0 +1,74 @@
+import sys, copy
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+from lib.builder import build_module
+import mmcv, torch
+
+torch.manual_seed(2020)
+
+
+def module_cfg(config_file, name):
+    config = mmcv.Config.fromfile(osp.join(cur_dir, '../configs', config_file))
+    cfg = copy.deepcopy(config.model[name])
+    if name == 'backbone':
+        cfg.pretrained = False
+    return cfg
+
+
+# heads are initialized with small weights, errors are relative to the norm
+def rel_error(x, ref):
+    return ((x - ref).norm() / ref.norm().clamp(min=1e-20)).item()
+
+def flat(outs):
+    if isinstance(outs, torch.Tensor):
+        return [outs]
+    return [x for out in outs for x in flat(out)]
+
+
+# outputs and parameter gradients of a module with with_cp=True and with_cp=False
+def check_cp(cfg, inputs):
+    results = []
+    for with_cp in (False, True):
+        cfg['with_cp'] = with_cp
+        module = build_module(copy.deepcopy(cfg))
+        if with_cp:
+            module.load_state_dict(state)
+        else:
+            module.init_weights()
+            state = module.state_dict()
+        module.train()
+        xs = [x.clone().requires_grad_() for x in inputs]
+        outs = flat(module(xs[0] if len(xs) == 1 else xs))
+        sum((out.float()**2).mean() for out in outs).backward()
+        grads = {name: p.grad for name, p in module.named_parameters() if p.grad is not None}
+        results.append((outs, grads, [x.grad for x in xs]))
+    (outs, grads, in_grads), (cp_outs, cp_grads, cp_in_grads) = results
+    assert len(outs) == len(cp_outs) and len(grads) > 0 and grads.keys() == cp_grads.keys()
+    for out, cp_out in zip(outs, cp_outs):
+        assert rel_error(cp_out, out) < 1e-5
+    for name in grads:
+        assert rel_error(cp_grads[name], grads[name]) < 1e-4, name
+    # inputs that are not used have no gradients
+    for grad, cp_grad in zip(in_grads, cp_in_grads):
+        assert (grad is None) == (cp_grad is None)
+        assert grad is None or rel_error(cp_grad, grad) < 1e-4
+    return len(grads)
+
+
+def test_with_cp():
+    img = torch.randn(2, 3, 96, 128)
+    num = check_cp(module_cfg('retinanet_r50_fpn.py', 'backbone'), [img])
+    print('ResNet: with_cp test passed, {} grads'.format(num))
+    feats = [torch.randn(2, c, 24 // 2**i, 32 // 2**i) for i, c in enumerate([256, 512, 1024, 2048])]
+    num = check_cp(module_cfg('retinanet_r50_fpn.py', 'neck'), feats)
+    print('FPN: with_cp test passed, {} grads'.format(num))
+    fpn_feats = [torch.randn(2, 256, 24 // 2**i, 32 // 2**i) for i in range(5)]
+    for config_file in ['retinanet_r50_fpn.py', 'fcos_r50_fpn.py']:
+        cfg = module_cfg(config_file, 'bbox_head')
+        num = check_cp(cfg, fpn_feats)
+        print('{}: with_cp test passed, {} grads'.format(cfg.type, num))
+
+
+if __name__ == '__main__':
+    test_with_cp()
@@ -0,0 +1,85 @@
+import sys, os, time
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+from lib.ann_index import build_ann_index, AnnIndex
+from pycocotools.coco import COCO
+import numpy as np
+import tempfile, json
+
+ANN_FILE = osp.join(cur_dir, '..', 'data', 'voc2007_test_no_difficult.json')
+
+def test_ann_index():
+    out = osp.join(tempfile.mkdtemp(), 'ann_index.npz')
+    build_ann_index(ANN_FILE, out)
+
+    start = time.time()
+    index = AnnIndex(out)
+    print('load index used {} secs'.format(time.time() - start))
+    start = time.time()
+    coco = COCO(ANN_FILE)
+    print('load json used {} secs'.format(time.time() - start))
+
+    assert index.img_ids.tolist() == coco.getImgIds()
+    for iid in coco.getImgIds():
+        annos = coco.loadAnns(coco.getAnnIds(imgIds=[iid]))
+        index_annos = index.anns_of(iid)
+        assert np.allclose(index_annos['bboxes'], np.array([x['bbox'] for x in annos]).reshape(-1, 4))
+        assert index_annos['cat_ids'].tolist() == [x['category_id'] for x in annos]
+    coco_from_index = index.to_coco()
+    assert len(coco_from_index.anns) == len(coco.anns)
+    print('annotation index is consistent with json')
+
+
+# a copy of ANN_FILE with the cases filtered by VOCDataset: crowd and ignored bboxes, a tiny bbox,
+# images without annotations and small images
+def edited_ann_file(out_dir):
+    with open(ANN_FILE) as f:
+        data = json.load(f)
+    empty_ids = {img['id'] for img in data['images'][10:15]}
+    data['annotations'] = [ann for ann in data['annotations'] if ann['image_id'] not in empty_ids]
+    for ann in data['annotations'][0:30:3]:
+        ann['iscrowd'] = 1
+    for ann in data['annotations'][1:30:3]:
+        ann['ignore'] = 1
+    data['annotations'][2]['bbox'][2] = 0.5
+    for img in data['images'][20:25]:
+        img['width'] = 20
+    ann_file = osp.join(out_dir, 'edited.json')
+    with open(ann_file, 'w') as f:
+        json.dump(data, f)
+    return ann_file
+
+
+def test_dataset_parity():
+    try:
+        from lib.datasets import VOCDataset
+    except ImportError:
+        print('mmdet is not installed, skip the dataset parity test')
+        return
+    out_dir = tempfile.mkdtemp()
+    ann_file = edited_ann_file(out_dir)
+    index_file = osp.join(out_dir, 'edited.npz')
+    build_ann_index(ann_file, index_file)
+    # test_mode keeps all images, so that _filter_imgs can be called on both
+    json_set = VOCDataset(ann_file, [], img_prefix='imgs/', test_mode=True)
+    npz_set = VOCDataset(index_file, [], img_prefix='imgs/', test_mode=True)
+    assert npz_set.img_infos == json_set.img_infos
+    for min_size in (32, 300):
+        assert npz_set._filter_imgs(min_size) == json_set._filter_imgs(min_size)
+    for idx in range(len(json_set)):
+        ann, npz_ann = json_set.get_ann_info(idx), npz_set.get_ann_info(idx)
+        for key in ('bboxes', 'bboxes_ignore'):
+            assert npz_ann[key].dtype == ann[key].dtype and np.allclose(npz_ann[key], ann[key])
+        assert npz_ann['labels'].dtype == ann['labels'].dtype and (npz_ann['labels'] == ann['labels']).all()
+        assert npz_ann['seg_map'] == ann['seg_map']
+    # images are filtered when building training sets
+    json_set = VOCDataset(ann_file, [], img_prefix='imgs/')
+    npz_set = VOCDataset(index_file, [], img_prefix='imgs/')
+    assert npz_set.img_infos == json_set.img_infos and (npz_set.flag == json_set.flag).all()
+    print('VOCDataset gives the same annotations from json and annotation index')
+
+
+if __name__ == '__main__':
+    test_ann_index()
+    test_dataset_parity()
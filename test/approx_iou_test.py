@@ -0,0 +1,50 @@
+import sys, time
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+sys.path.append(cur_dir)
+from lib.region import approx_max_iou, MaxIoUAssigner
+from lib import utils
+from helpers import random_bboxes
+import torch
+
+torch.manual_seed(2020)
+
+
+# the loop over approx anchors GuidedAnchor used to do
+def ref_max_anchors(anchors, gt_bbox):
+    max_ious = []
+    for i in range(anchors.shape[1]):
+        iou_tab = utils.calc_iou(gt_bbox, anchors[:, i, :])
+        max_ious.append(iou_tab.max(dim=0)[0])
+    max_ious = torch.stack(max_ious)
+    _, max_anchor_with_gt = max_ious.max(0)
+    return anchors[:, max_anchor_with_gt, torch.arange(anchors.shape[-1])]
+
+
+def fake_approx_anchors(n, k=9):
+    ctr = torch.rand(2, 1, n) * 800
+    wh = torch.rand(2, k, 1) * 200 + 16
+    return torch.cat([ctr - wh / 2, ctr + wh / 2])
+
+
+def test_parity(n, m, chunk_size):
+    anchors, gt_bbox = fake_approx_anchors(n), random_bboxes(m, 600, 600, 10, 310)
+    start = time.time()
+    ref = ref_max_anchors(anchors, gt_bbox)
+    ref_labels, ref_ious = MaxIoUAssigner(0.5, 0.4, 0.0)(ref, gt_bbox)
+    ref_time = time.time() - start
+    start = time.time()
+    max_anchors, iou_tab = approx_max_iou(anchors, gt_bbox, chunk_size)
+    labels, ious = MaxIoUAssigner(0.5, 0.4, 0.0)(max_anchors, gt_bbox, iou_tab)
+    cur_time = time.time() - start
+    assert torch.equal(max_anchors, ref) and torch.equal(iou_tab, utils.calc_iou(ref, gt_bbox))
+    assert torch.equal(labels, ref_labels) and torch.equal(ious, ref_ious)
+    print('parity test passed on {} locations and {} gt, loop {:.4f}s, chunked {:.4f}s'.format(
+        n, m, ref_time, cur_time))
+
+
+if __name__ == '__main__':
+    test_parity(1000, 3, 64)
+    test_parity(20000, 10, 4096)
+    test_parity(80000, 30, 4096)
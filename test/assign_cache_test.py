@@ -0,0 +1,114 @@
+import sys, copy, tempfile, time
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+sys.path.append(cur_dir)
+from lib.assign_cache import AssignCache, assign_key
+from lib.anchor import anchor_target
+from lib.region import MaxIoUAssigner, RandomSampler
+from lib.builder import build_module
+from helpers import random_bboxes
+import mmcv, torch
+import numpy as np
+
+torch.manual_seed(2020)
+
+
+def fake_image(num_gt, img_w=600, img_h=400):
+    gt_bbox = random_bboxes(num_gt, img_w - 50, img_h - 50, 20, 220)
+    gt_label = torch.randint(1, 21, (num_gt, ))
+    img_meta = {'filename': 'fake_{}.jpg'.format(num_gt), 'flip': False, 'scale_factor': 1.0,
+                'img_shape': (img_h, img_w, 3), 'pad_shape': (img_h, img_w, 3)}
+    return gt_bbox, gt_label, img_meta
+
+
+def sampled_targets(anchors, gt_bbox, cache, key, seed):
+    n = anchors.shape[1]
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    return anchor_target(torch.randn(1, n), torch.randn(4, n), 1, anchors, torch.ones(n, dtype=torch.bool),
+                         gt_bbox, None, MaxIoUAssigner(0.7, 0.3, 0.3), RandomSampler(256, 128),
+                         assign_cache=cache, cache_key=key)
+
+
+def test_anchor_target():
+    ctr = torch.rand(2, 20000) * 600
+    wh = torch.rand(2, 20000) * 200 + 16
+    anchors = torch.cat([ctr - wh / 2, ctr + wh / 2])
+    gt_bbox, _, img_meta = fake_image(10)
+    key = assign_key(img_meta, [(100, 150)], {'assigner': 'MaxIoUAssigner'})
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = AssignCache(cache_dir)
+        for seed in range(3):
+            ref = sampled_targets(anchors, gt_bbox, None, None, seed)
+            cur = sampled_targets(anchors, gt_bbox, cache, key, seed)
+            assert all(torch.equal(r, c) for r, c in zip(ref, cur))
+        assert cache.hits == 2 and cache.misses == 1
+        # another process reads what is on disk
+        other = AssignCache(cache_dir)
+        assert torch.equal(sampled_targets(anchors, gt_bbox, other, key, 2)[2], ref[2]) and other.hits == 1
+        # other gt bboxes under the same key, e.g. random crops, are assigned again
+        moved = gt_bbox + 5
+        assert torch.equal(sampled_targets(anchors, moved, cache, key, 0)[4],
+                           sampled_targets(anchors, moved, None, None, 0)[4])
+        assert cache.misses == 2 and cache.hits == 2
+    # keys tell apart flips and grids
+    assert key != assign_key(dict(img_meta, flip=True), [(100, 150)], {'assigner': 'MaxIoUAssigner'})
+    assert key != assign_key(img_meta, [(100, 152)], {'assigner': 'MaxIoUAssigner'})
+    print('anchor target with cache test passed')
+
+
+def test_bound():
+    gt_bbox = fake_image(5)[0]
+    labels = torch.zeros(200000, dtype=torch.long)
+    labels[torch.randint(0, 200000, (4000, ))] = -1
+    labels[torch.randint(0, 200000, (200, ))] = torch.randint(1, 6, (200, ))
+    cache = AssignCache(max_bytes=100000)
+    for i in range(10):
+        cache.put(str(i), gt_bbox, labels)
+        assert cache.nbytes <= cache.max_bytes
+    # entries are sparse, far below 400KB of dense int16 labels each
+    assert 2 < len(cache) < 10 and cache.nbytes < 30000 * len(cache)
+    # the least recently used ones are dropped
+    assert cache.get('0', gt_bbox) is None and torch.equal(cache.get('9', gt_bbox), labels)
+    first = next(iter(cache.entries))
+    cache.get(first, gt_bbox)
+    cache.put('10', gt_bbox, labels)
+    assert first in cache.entries
+    # with cache_dir nothing is kept in memory
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = AssignCache(cache_dir)
+        cache.put('0', gt_bbox, labels)
+        assert len(cache) == 0 and cache.nbytes == 0 and torch.equal(cache.get('0', gt_bbox), labels)
+    print('bound test passed')
+
+
+def test_retina_head(num_epochs=3):
+    config = mmcv.Config.fromfile(osp.join(cur_dir, '../configs/retinanet_r50_fpn.py'))
+    head = build_module(copy.deepcopy(config.model.bbox_head))
+    train_cfg = copy.deepcopy(config.train_cfg)
+    cached_cfg = copy.deepcopy(config.train_cfg)
+    cached_cfg.assign_cache = dict()
+    images = [fake_image(n) for n in (3, 8, 15)]
+    grids = [(50, 75), (25, 38), (13, 19), (7, 10), (4, 5)]
+    ref_time, cur_time = 0, 0
+    for epoch in range(num_epochs):
+        for gt_bbox, gt_label, img_meta in images:
+            cls_outs = [torch.randn(1, 9 * 20, h, w) for h, w in grids]
+            reg_outs = [torch.randn(1, 9 * 4, h, w) for h, w in grids]
+            start = time.time()
+            ref = head.loss(cls_outs, reg_outs, [gt_bbox], [gt_label], [img_meta], train_cfg)
+            ref_time += time.time() - start
+            start = time.time()
+            cur = head.loss(cls_outs, reg_outs, [gt_bbox], [gt_label], [img_meta], cached_cfg)
+            cur_time += time.time() - start
+            assert all(torch.equal(r, c) for r, c in zip(ref, cur))
+    assert head.assign_cache.misses == len(images) and len(head.assign_cache) == len(images)
+    print('retina head test passed, {} epochs, without cache {:.3f}s, with cache {:.3f}s'.format(
+        num_epochs, ref_time, cur_time))
+
+
+if __name__ == '__main__':
+    test_anchor_target()
+    test_bound()
+    test_retina_head()
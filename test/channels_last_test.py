@@ -0,0 +1,94 @@
+import sys, copy
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+sys.path.append(cur_dir)
+from lib import utils
+from helpers import build_model, spread_scores, assert_same_preds, fake_img_meta, random_bboxes
+import torch
+import numpy as np
+
+torch.manual_seed(2020)
+
+CONFIGS = ['retinanet_r50_fpn.py', 'fcos_r50_fpn.py', 'faster_rcnn_r50_fpn.py']
+PAD_SHAPE = (192, 256)
+
+
+def rel_error(out, ref):
+    return ((out - ref).norm() / ref.norm().clamp(min=1e-12)).item()
+
+
+def test_grid_channels(n=3, A=2):
+    level_outs = [torch.randn(2, n*A, h, w) for h, w in [(6, 8), (3, 4)]]
+    # [N, n, A*H*W] of each level, from the plain NCHW layout
+    refs = [x.view(2, n, -1) for x in level_outs]
+    for x, ref in zip(level_outs, refs):
+        x = x.contiguous(memory_format=torch.channels_last)
+        view = utils.grid_channels_view(x, n)
+        assert torch.equal(view.reshape(2, n, -1), ref)
+        inds = torch.randint(0, ref.shape[-1], (2, 5))
+        assert torch.equal(utils.take_grid_channels(view, inds), ref.gather(2, inds.view(2, 1, 5).expand(-1, n, -1)))
+        assert torch.equal(utils.take_grid_channels(view[1], inds[1]), ref[1][:, inds[1]])
+    last_outs = [x.contiguous(memory_format=torch.channels_last)[0] for x in level_outs]
+    assert torch.equal(utils.concate_grid_channels(last_outs, n), torch.cat([ref[0] for ref in refs], 1))
+    print('grid channels test passed')
+
+
+# the same model and input in contiguous and channels_last format, as BasicTrainer and
+# BasicTester convert them
+def both_formats(model, img):
+    last_model = copy.deepcopy(model).to(memory_format=torch.channels_last)
+    return [(model, img.contiguous()), (last_model, img.contiguous(memory_format=torch.channels_last))]
+
+
+# losses of the dense head, for two stage detectors the rpn losses only, proposals of random rpn
+# heads have almost equal scores and tiny differences change which of them are sampled as rois
+def head_losses(model, img, gt_bboxes, gt_labels, img_metas):
+    if not hasattr(model, 'rpn_head'):
+        return model.forward_train(img, gt_bboxes, gt_labels, img_metas)
+    cls_outs, reg_outs = model.rpn_head(model.extract_feat(img))
+    rpn_gt_labels = [torch.full_like(gt_label, 1) for gt_label in gt_labels]
+    cls_loss, reg_loss = model.rpn_head.loss(cls_outs, reg_outs, gt_bboxes, rpn_gt_labels, img_metas,
+                                             model.train_cfg.rpn)
+    return {'rpn_cls_loss': cls_loss, 'rpn_reg_loss': reg_loss}
+
+
+def test_channels_last(config_file):
+    model = build_model(config_file, min_score=None)
+    img_shapes = [(192, 256), (160, 200)]
+    img = torch.zeros(len(img_shapes), 3, *PAD_SHAPE)
+    for i, (h, w) in enumerate(img_shapes):
+        img[i, :, :h, :w] = torch.randn(3, h, w)
+    img_metas = [fake_img_meta(i, h, w, PAD_SHAPE) for i, (h, w) in enumerate(img_shapes)]
+    spread_scores(model, img, img_metas)
+
+    preds = []
+    for m, x in both_formats(model, img):
+        with torch.no_grad():
+            preds.append(m.forward_test(x, img_metas))
+    assert_same_preds(preds[1], preds[0])
+
+    gt_bboxes = [random_bboxes(5, w - 64, h - 64, 16, 64) for h, w in img_shapes]
+    gt_labels = [torch.randint(1, 21, (5, )) for _ in img_shapes]
+    losses, grads = [], []
+    model.train()
+    for m, x in both_formats(model, img):
+        # sampling of anchors and rois draws random numbers
+        torch.manual_seed(0)
+        np.random.seed(0)
+        loss = head_losses(m, x, gt_bboxes, gt_labels, img_metas)
+        sum(loss.values()).backward()
+        losses.append(loss)
+        grads.append({name: p.grad for name, p in m.named_parameters() if p.grad is not None})
+    assert losses[0].keys() == losses[1].keys() and grads[0].keys() == grads[1].keys()
+    for name in losses[0]:
+        assert rel_error(losses[1][name].detach(), losses[0][name].detach()) < 1e-4, name
+    for name in grads[0]:
+        assert rel_error(grads[1][name], grads[0][name]) < 1e-3, name
+    print('{}: channels_last test passed, {} losses, {} grads'.format(config_file, len(losses[0]), len(grads[0])))
+
+
+if __name__ == '__main__':
+    test_grid_channels()
+    for config_file in CONFIGS:
+        test_channels_last(config_file)
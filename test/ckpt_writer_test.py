@@ -0,0 +1,101 @@
+import sys, os, tempfile, threading, time
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+from lib.trainer.checkpoint import CkptWriter, save_atomic
+import torch
+
+
+def test_async_write():
+    work_dir = tempfile.mkdtemp()
+    writer = CkptWriter()
+    weight = torch.zeros(3)
+    writer.save({'weight': weight}, osp.join(work_dir, 'a.pth'))
+    # the ckpt is a snapshot, later updates are not written
+    weight += 1
+    writer.save({'weight': weight}, osp.join(work_dir, 'b.pth'))
+    writer.wait()
+    assert torch.equal(torch.load(osp.join(work_dir, 'a.pth'))['weight'], torch.zeros(3))
+    assert torch.equal(torch.load(osp.join(work_dir, 'b.pth'))['weight'], torch.ones(3))
+    assert sorted(os.listdir(work_dir)) == ['a.pth', 'b.pth']
+    print('async write test passed')
+
+
+def test_save_atomic():
+    filename = osp.join(tempfile.mkdtemp(), 'a.pth')
+    save_atomic({'x': 1}, filename)
+    # a failed save leaves the old ckpt and no temporary file
+    try:
+        save_atomic({'x': lambda: 2}, filename)
+    except Exception:
+        pass
+    else:
+        raise AssertionError('a lambda is saved')
+    assert torch.load(filename) == {'x': 1}
+    assert os.listdir(osp.dirname(filename)) == ['a.pth']
+    print('save_atomic test passed')
+
+
+def test_max_keep():
+    for async_write in (True, False):
+        work_dir = tempfile.mkdtemp()
+        writer = CkptWriter(max_keep=2, async_write=async_write)
+        for name in ['a', 'b', 'c', 'b', 'd']:
+            writer.save({'name': name}, osp.join(work_dir, name + '.pth'))
+        writer.wait()
+        # c is older than the b written again
+        assert sorted(os.listdir(work_dir)) == ['b.pth', 'd.pth']
+        assert writer.saved == [osp.join(work_dir, 'b.pth'), osp.join(work_dir, 'd.pth')]
+    print('max_keep test passed')
+
+
+def test_error():
+    work_dir = tempfile.mkdtemp()
+    writer = CkptWriter()
+    writer.save({'x': 1}, osp.join(work_dir, 'missing', 'a.pth'))
+    try:
+        writer.wait()
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('the failed write is not reported')
+    # the error is reported once, the writer keeps working
+    writer.save({'x': 1}, osp.join(work_dir, 'a.pth'))
+    writer.wait()
+    assert os.listdir(work_dir) == ['a.pth']
+    print('error test passed')
+
+
+class SlowWriter(CkptWriter):
+    def __init__(self, **kwargs):
+        super(SlowWriter, self).__init__(**kwargs)
+        self.go = threading.Event()
+
+    def write(self, state, filename):
+        self.go.wait()
+        super(SlowWriter, self).write(state, filename)
+
+
+def test_bounded():
+    work_dir = tempfile.mkdtemp()
+    writer = SlowWriter(max_pending=1)
+    # one ckpt is being written and one waits
+    for name in ['a', 'b']:
+        writer.save({'name': name}, osp.join(work_dir, name + '.pth'))
+    saver = threading.Thread(target=writer.save, args=({'name': 'c'}, osp.join(work_dir, 'c.pth')))
+    saver.start()
+    time.sleep(0.5)
+    assert saver.is_alive(), 'save does not block'
+    writer.go.set()
+    saver.join()
+    writer.wait()
+    assert sorted(os.listdir(work_dir)) == ['a.pth', 'b.pth', 'c.pth']
+    print('bounded queue test passed')
+
+
+if __name__ == '__main__':
+    test_async_write()
+    test_save_atomic()
+    test_max_keep()
+    test_error()
+    test_bounded()
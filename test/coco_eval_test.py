@@ -0,0 +1,113 @@
+import sys, copy, contextlib, io, json, tempfile, time
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+from lib.evaluator import COCOEvaluator, StreamingEvaluator
+from lib.tester import results2json, coco_eval
+from pycocotools.coco import COCO
+import numpy as np
+import torch
+
+np.random.seed(2020)
+
+GT_FILE = osp.join(cur_dir, '../data/voc2007_test_no_difficult.json')
+
+
+def load_gt(num_imgs, num_crowd):
+    dataset = json.load(open(GT_FILE))
+    img_ids = set(img['id'] for img in dataset['images'][:num_imgs])
+    dataset['images'] = [img for img in dataset['images'] if img['id'] in img_ids]
+    dataset['annotations'] = [ann for ann in dataset['annotations'] if ann['image_id'] in img_ids]
+    # crowd annotations take the other branches of matching
+    for i in np.random.choice(len(dataset['annotations']), num_crowd, replace=False):
+        dataset['annotations'][i]['iscrowd'] = 1
+    gt = COCO()
+    gt.dataset = dataset
+    with contextlib.redirect_stdout(io.StringIO()):
+        gt.createIndex()
+    return gt
+
+
+def fake_results(gt):
+    '''
+    infer_res of BasicTester: jittered ground truths with wrong categories and duplicates, and
+    random bboxes, scores are coarse so that many of them tie.
+    '''
+    infer_res = []
+    cat_ids = gt.getCatIds()
+    for iid in gt.getImgIds():
+        img = gt.imgs[iid]
+        anns = gt.imgToAnns[iid]
+        bboxes, cats = [], []
+        for ann in anns:
+            for _ in range(np.random.randint(0, 4)):
+                x, y, w, h = ann['bbox']
+                jitter = np.random.randn(4) * 0.1 * np.array([w, h, w, h])
+                bboxes.append([x + jitter[0], y + jitter[1], max(1, w + jitter[2]), max(1, h + jitter[3])])
+                cats.append(ann['category_id'] if np.random.rand() < 0.8 else np.random.choice(cat_ids))
+        for _ in range(np.random.randint(0, 30)):
+            w, h = np.random.rand(2) * [img['width'], img['height']] / 2 + 1
+            bboxes.append([np.random.rand() * (img['width'] - w), np.random.rand() * (img['height'] - h), w, h])
+            cats.append(np.random.choice(cat_ids))
+        if len(bboxes) == 0:
+            continue
+        infer_res.append({'image_id': iid, 'file_name': img['file_name'],
+                          'bbox': torch.tensor(bboxes, dtype=torch.float32),
+                          'score': torch.tensor(np.random.randint(1, 40, len(bboxes)) / 40, dtype=torch.float32),
+                          'category': torch.tensor(cats)})
+    return infer_res
+
+
+def ref_eval(gt, infer_res, img_ids=None):
+    with tempfile.NamedTemporaryFile('w', suffix='.json') as f, contextlib.redirect_stdout(io.StringIO()):
+        json.dump(results2json(infer_res), f)
+        f.flush()
+        return coco_eval(gt, f.name, img_ids)
+
+
+def test_parity(num_imgs, num_crowd, img_ids=None, num_workers=0):
+    gt = load_gt(num_imgs, num_crowd)
+    infer_res = fake_results(gt)
+    start = time.time()
+    ref = ref_eval(gt, infer_res, img_ids)
+    ref_time = time.time() - start
+    start = time.time()
+    stats = COCOEvaluator(gt, img_ids, num_workers).evaluate(infer_res)
+    cur_time = time.time() - start
+    assert np.allclose(stats, ref, rtol=0, atol=1e-9), (stats, ref)
+    print('parity test passed on {} images, mAP {:.4f}, AP50 {:.4f}, COCOeval {:.2f}s, evaluator {:.2f}s'.format(
+        num_imgs, stats[0], stats[1], ref_time, cur_time))
+
+
+def test_streaming(num_imgs, num_crowd, flush_imgs):
+    gt = load_gt(num_imgs, num_crowd)
+    infer_res = fake_results(gt)
+    ref = ref_eval(gt, infer_res)
+    evaluator = StreamingEvaluator(gt, flush_imgs=flush_imgs)
+    # images come in any order, in batches of different sizes
+    order = np.random.permutation(len(infer_res))
+    splits = np.sort(np.random.choice(len(order), 20, replace=False))
+    for batch in np.split(order, splits):
+        evaluator.add([infer_res[i] for i in batch])
+    stats = evaluator.evaluate()
+    assert np.allclose(stats, ref, rtol=0, atol=1e-9), (stats, ref)
+    assert len(evaluator.matches) == 0 and len(evaluator.pending) == 0
+    print('streaming test passed on {} images, flush_imgs={}'.format(num_imgs, flush_imgs))
+
+
+def test_empty():
+    gt = load_gt(20, 0)
+    stats = COCOEvaluator(gt).evaluate([])
+    # -1 where no ground truth falls in the area range, same as COCOeval
+    assert ((stats == 0) | (stats == -1)).all() and stats[0] == 0, stats
+    assert (StreamingEvaluator(gt).evaluate() == stats).all()
+
+
+if __name__ == '__main__':
+    test_empty()
+    test_parity(50, 0)
+    test_parity(300, 30)
+    test_parity(300, 10, img_ids=list(range(1, 200, 2)), num_workers=2)
+    test_parity(1000, 50, num_workers=2)
+    test_streaming(300, 20, 1)
+    test_streaming(500, 20, 64)
@@ -0,0 +1,74 @@
+import sys, copy, pickle, types
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+sys.path.append(cur_dir)
+from lib import dense_targets
+from lib.builder import build_module
+from helpers import FakeContainer, fake_img_meta, random_bboxes
+import mmcv, torch
+import numpy as np
+
+torch.manual_seed(2020)
+
+CONFIGS = ['retinanet_r50_fpn.py', 'fcos_r50_fpn.py']
+PAD_SHAPE = (320, 416)
+
+
+def fake_batch(img_shapes, num_gts=(3, 7)):
+    img = torch.zeros(len(img_shapes), 3, *PAD_SHAPE)
+    img_metas, gt_bboxes, gt_labels = [], [], []
+    for i, ((h, w), n) in enumerate(zip(img_shapes, num_gts)):
+        gt_bboxes.append(random_bboxes(n, w - 60, h - 60, 30, 180).t().clamp(max=min(h, w) - 1))
+        gt_labels.append(torch.randint(1, 21, (n, )))
+        img_metas.append(fake_img_meta(i, h, w, PAD_SHAPE))
+    return {'img': FakeContainer(img), 'img_meta': FakeContainer(img_metas),
+            'gt_bboxes': FakeContainer(gt_bboxes), 'gt_labels': FakeContainer(gt_labels)}
+
+
+def fake_collate(batch):
+    return batch
+
+
+def head_loss(head, feats, batch, train_cfg):
+    # heads take gt bboxes as [4, n]
+    gt_bboxes = [gt_bbox.t() for gt_bbox in batch['gt_bboxes'].data[0]]
+    np.random.seed(0)
+    torch.manual_seed(0)
+    loss = head.forward_train(feats, gt_bboxes, batch['gt_labels'].data[0], batch['img_meta'].data[0],
+                              train_cfg)
+    return list(loss.values()) if isinstance(loss, dict) else list(loss)
+
+
+def test_dense_targets(config_file):
+    config = mmcv.Config.fromfile(osp.join(cur_dir, '../configs', config_file))
+    head = build_module(copy.deepcopy(config.model.bbox_head))
+    train_cfg = copy.deepcopy(config.train_cfg)
+    model = types.SimpleNamespace(bbox_head=head)
+    dataloader = types.SimpleNamespace(collate_fn=fake_collate, num_workers=0)
+    dense_targets.install(dataloader, model, train_cfg)
+    assert head.dense_target_key == 'bbox_head'
+    # workers receive the collate_fn pickled when they are spawned
+    collate = pickle.loads(pickle.dumps(dataloader.collate_fn))
+
+    grids = dense_targets.grid_sizes_of(PAD_SHAPE, head.target_strides())
+    feats = [torch.randn(2, 256, h, w) for h, w in grids]
+    ref_batch = fake_batch([(300, 400), (320, 256)])
+    batch = collate(copy.deepcopy(ref_batch))
+    for img_meta in batch['img_meta'].data[0]:
+        assert img_meta['dense_targets']['bbox_head'].grid_sizes == grids
+    with torch.no_grad():
+        ref = head_loss(head, feats, ref_batch, train_cfg)
+        cur = head_loss(head, feats, batch, train_cfg)
+        assert all(torch.allclose(r, c) for r, c in zip(ref, cur))
+        # targets of other grid sizes are computed again
+        for img_meta in batch['img_meta'].data[0]:
+            img_meta['dense_targets']['bbox_head'].grid_sizes[0] = (1, 1)
+        cur = head_loss(head, feats, batch, train_cfg)
+        assert all(torch.allclose(r, c) for r, c in zip(ref, cur))
+    print('{}: dense targets test passed'.format(config_file))
+
+
+if __name__ == '__main__':
+    for config_file in CONFIGS:
+        test_dense_targets(config_file)
@@ -0,0 +1,61 @@
+import sys, tempfile
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+sys.path.append(cur_dir)
+from lib.trainer.hooks import EvalHook
+from helpers import ToyDataset, collate_toy, coco_gt_of, toy_trainer
+import mmcv, torch
+
+torch.manual_seed(2020)
+
+
+class ToyEvalDataset(ToyDataset):
+    def __init__(self, num_imgs=12):
+        super(ToyEvalDataset, self).__init__(num_imgs)
+        self.img_infos = [{'id': i + 1} for i in range(num_imgs)]
+
+    def coco_api(self):
+        bbox = torch.tensor([[0.0], [0.0], [3.0], [3.0]])
+        return coco_gt_of([(bbox, None, torch.tensor([1]))] * self.num_imgs, list(range(1, self.num_imgs + 1)), (8, 8))
+
+
+# the mmdet dataloader is replaced by a torch one that gives the same batch layout
+class ToyEvalHook(EvalHook):
+    def build_dataloader(self, dataset):
+        return torch.utils.data.DataLoader(dataset, self.eval_cfg.get('imgs_per_gpu', 1), collate_fn=collate_toy)
+
+
+def add_eval_hook(trainer):
+    trainer.eval_cfg = mmcv.ConfigDict(interval=2, num_imgs=5, imgs_per_gpu=2)
+    trainer.eval_dataset = ToyEvalDataset()
+    hook = ToyEvalHook(trainer)
+    trainer.add_hook(hook)
+    return hook
+
+
+def test_eval_hook():
+    work_dir = tempfile.mkdtemp()
+    trainer = toy_trainer(work_dir, total_epochs=3, state_interval=1, state_max_keep=100)
+    hook = add_eval_hook(trainer)
+    trainer.train()
+    # every 2 epochs and after the last one, in eval mode, training mode is restored afterwards
+    assert [h['epoch'] for h in hook.history] == [2, 3]
+    assert len(trainer.model.test_modes) == 2 * 3 and not any(trainer.model.test_modes)
+    assert trainer.model.training
+    with open(osp.join(work_dir, 'report.log')) as f:
+        lines = [line for line in f if 'eval on' in line]
+    assert len(lines) == 2 and '[2], eval on 5 images, mAP: ' in lines[0] and '[3], eval on 5 images' in lines[1]
+
+    # history is restored on resume, state_iter_13 is saved after evaluation of epoch 2
+    resumed = toy_trainer(tempfile.mkdtemp(), total_epochs=3)
+    resumed_hook = add_eval_hook(resumed)
+    resumed.resume(osp.join(work_dir, 'state_iter_13.pth'))
+    assert resumed_hook.history == hook.history[:1]
+    resumed_hook.load_state_dict(hook.state_dict())
+    assert resumed_hook.history == hook.history
+    print('eval hook test passed, history: {}'.format(hook.history))
+
+
+if __name__ == '__main__':
+    test_eval_hook()
@@ -0,0 +1,70 @@
+import sys, tempfile
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+sys.path.append(cur_dir)
+from lib.feat_cache import FeatureCache, FeatureCacheWriter, config_fingerprint
+from lib.tester import BasicTester
+from helpers import build_model, fake_dataloader
+import copy, mmcv, torch
+
+torch.manual_seed(2020)
+
+CONFIGS = ['retinanet_r50_fpn.py', 'cascade_rcnn_r50_fpn.py']
+
+
+# with imgs_per_gpu > 1, smaller images are padded to the largest image of the batch
+def test_feat_cache(config_file, fp16, imgs_per_gpu):
+    model = build_model(config_file)
+    tester = BasicTester(model, model.train_cfg, model.test_cfg, torch.device('cpu'))
+    dataloader = fake_dataloader([(192, 256), (150, 200), (192, 192)], imgs_per_gpu=imgs_per_gpu)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        writer = FeatureCacheWriter(cache_dir, 'test', fp16=fp16)
+        ref_res = tester.inference(dataloader, writer)
+        assert not FeatureCache.exists(cache_dir)
+        writer.close()
+        assert FeatureCache.exists(cache_dir, 'test') and not FeatureCache.exists(cache_dir, 'other')
+        cache = FeatureCache(cache_dir)
+        assert cache.img_ids == [1, 2, 3]
+        res = tester.inference_cached(cache)
+        # the ids of the test dataset decide which images and in which order
+        assert [r['image_id'] for r in tester.inference_cached(cache, img_ids=[3, 1, 2])] == [3, 1, 2]
+        try:
+            tester.inference_cached(cache, img_ids=[1, 2, 4])
+            assert False
+        except AssertionError as e:
+            assert 'other images' in str(e)
+    assert [r['image_id'] for r in res] == [r['image_id'] for r in ref_res]
+    for r, ref in zip(res, ref_res):
+        if fp16:
+            # rounding of features changes scores slightly, compare the top bboxes only
+            n = min(10, len(ref['score']))
+            assert torch.allclose(r['score'][:n], ref['score'][:n], atol=5e-3)
+        else:
+            assert torch.allclose(r['bbox'], ref['bbox'], atol=1e-3)
+            assert torch.allclose(r['score'], ref['score'], atol=1e-5)
+            assert (r['category'] == ref['category']).all()
+    print('{}: feature cache test passed, fp16={}, imgs_per_gpu={}'.format(config_file, fp16, imgs_per_gpu))
+
+
+def test_fingerprint():
+    config = mmcv.Config.fromfile(osp.join(cur_dir, '../configs/retinanet_r50_fpn.py'))
+    fingerprint = config_fingerprint(config, [1, 2, 3])
+    assert fingerprint == config_fingerprint(copy.deepcopy(config), [1, 2, 3])
+    assert fingerprint != config_fingerprint(config, [1, 2])
+    other = copy.deepcopy(config)
+    other.data.test.imgs_per_gpu = config.data.test.imgs_per_gpu + 1
+    assert fingerprint != config_fingerprint(other, [1, 2, 3])
+    for key in ('ann_file', 'img_prefix'):
+        other = copy.deepcopy(config)
+        other.data.test[key] = other.data.test[key] + '_other'
+        assert fingerprint != config_fingerprint(other, [1, 2, 3])
+    print('fingerprint test passed')
+
+
+if __name__ == '__main__':
+    test_fingerprint()
+    for config_file in CONFIGS:
+        test_feat_cache(config_file, fp16=False, imgs_per_gpu=2)
+        test_feat_cache(config_file, fp16=True, imgs_per_gpu=2)
+        test_feat_cache(config_file, fp16=False, imgs_per_gpu=1)
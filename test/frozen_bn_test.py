@@ -0,0 +1,49 @@
+import sys, os, time
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+from lib.backbones import ResNet, FrozenBN, FoldedBN
+import torch, torch.nn as nn
+
+torch.manual_seed(2019)
+
+def random_bn_stats(model):
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.normal_()
+            m.running_var.uniform_(0.5, 2.0)
+            m.weight.data.normal_()
+            m.bias.data.normal_()
+
+def test_frozen_bn():
+    model = ResNet(pretrained=False, frozen_stages=1)
+    random_bn_stats(model)
+    state = model.state_dict()
+    fused = ResNet(pretrained=False, frozen_stages=1, freeze_bn=True)
+    fused.load_state_dict(state)
+    assert isinstance(fused.bn1, FoldedBN) and isinstance(fused.layer1[0].bn1, FoldedBN)
+    assert type(fused.layer2[0].bn1) is FrozenBN
+
+    model.train()
+    fused.train()
+    x = torch.randn(2, 3, 128, 128)
+    outs, fused_outs = model(x), fused(x)
+    for out, fused_out in zip(outs, fused_outs):
+        assert torch.allclose(out, fused_out, rtol=1e-4, atol=1e-4)
+    sum([out.sum() for out in outs]).backward()
+    sum([out.sum() for out in fused_outs]).backward()
+    fused_params = dict(fused.named_parameters())
+    for name, param in model.named_parameters():
+        if param.grad is not None:
+            assert torch.allclose(param.grad, fused_params[name].grad, rtol=1e-3, atol=1e-3), name
+
+    # state_dict of fused model is in unfused layout
+    fused_state = fused.state_dict()
+    assert sorted(fused_state.keys()) == sorted(state.keys())
+    for k in state:
+        assert torch.allclose(state[k].float(), fused_state[k].float(), rtol=1e-4, atol=1e-5), k
+    ResNet(pretrained=False).load_state_dict(fused_state)
+    print('frozen bn test passed')
+
+if __name__ == '__main__':
+    test_frozen_bn()
@@ -0,0 +1,168 @@
+import sys
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+sys.path.append(cur_dir)
+from lib.losses import sigmoid_focal_loss, sigmoid_focal_loss_fused, FocalLoss, CrossEntropyLoss
+from lib.losses import quality_focal_loss_fused, QualityFocalLoss, DistributionFocalLoss
+from lib.losses import DistributionFocalLossFunction, length2bins, length2class, class2length
+from lib.utils import elem_iou
+from lib.losses import iou_family_loss, iou_loss, giou_loss, GIoULoss, BoundedIoULoss
+from helpers import random_bboxes
+from torch.autograd import gradcheck
+import torch, math
+
+torch.manual_seed(2020)
+
+
+def fake_cls(n, n_cls, dtype=torch.double):
+    pred = torch.randn(n, n_cls, dtype=dtype) * 4
+    target = torch.randint(0, n_cls + 1, (n, ))
+    return pred, target
+
+
+def loss_and_grad(fn, pred, target):
+    x = pred.clone().requires_grad_()
+    loss = fn(x, target)
+    loss.backward()
+    return loss.detach(), x.grad
+
+
+def test_focal_loss():
+    pred, target = fake_cls(500, 20)
+    for alpha, gamma, fix_alpha in [(0.25, 2.0, False), (0.5, 1.5, True), (1.0, 0.0, True)]:
+        ref_loss, ref_grad = loss_and_grad(lambda x, t: sigmoid_focal_loss(x, t, alpha, gamma, fix_alpha), pred, target)
+        for chunk_size in [1, 37, 1000]:
+            loss, grad = loss_and_grad(
+                lambda x, t: sigmoid_focal_loss_fused(x, t, alpha, gamma, fix_alpha, chunk_size), pred, target)
+            assert torch.allclose(loss, ref_loss, rtol=1e-10) and torch.allclose(grad, ref_grad, atol=1e-12)
+        assert gradcheck(lambda x: sigmoid_focal_loss_fused(x, target[:40], alpha, gamma, fix_alpha, 16),
+                         (pred[:40].clone().requires_grad_(), ))
+    # all background and empty inputs
+    loss, grad = loss_and_grad(sigmoid_focal_loss_fused, pred, torch.zeros_like(target))
+    assert torch.allclose(loss, sigmoid_focal_loss(pred, torch.zeros_like(target)))
+    loss, grad = loss_and_grad(sigmoid_focal_loss_fused, pred[:0], target[:0])
+    assert loss == 0 and grad.shape == (0, 20)
+    print('fused focal loss test passed')
+
+
+def test_loss_modules():
+    pred, target = fake_cls(300, 20, torch.float)
+    for ref, fused in [(FocalLoss(fused=False), FocalLoss()),
+                       (CrossEntropyLoss(use_sigmoid=True, fused=False), CrossEntropyLoss(use_sigmoid=True))]:
+        ref_loss, ref_grad = loss_and_grad(ref, pred, target)
+        loss, grad = loss_and_grad(fused, pred, target)
+        assert torch.allclose(loss, ref_loss, rtol=1e-5) and torch.allclose(grad, ref_grad, atol=1e-6)
+    # half logits get half gradients
+    loss, grad = loss_and_grad(FocalLoss(), pred.half(), target)
+    assert loss.dtype == torch.half and grad.dtype == torch.half
+    print('fused loss modules test passed')
+
+
+def test_quality_focal_loss():
+    pred, label = fake_cls(400, 20)
+    quality = torch.rand(400, dtype=torch.double)
+    quality[:10] = 0.0
+    ref, fused = QualityFocalLoss(fused=False), QualityFocalLoss(chunk_size=64)
+    ref_loss, ref_grad = loss_and_grad(lambda x, t: ref(x, quality, t, avg_factor=3.0), pred, label)
+    loss, grad = loss_and_grad(lambda x, t: fused(x, quality, t, avg_factor=3.0), pred, label)
+    assert torch.allclose(loss, ref_loss, rtol=1e-10) and torch.allclose(grad, ref_grad, atol=1e-12)
+    for beta in [2.0, 1.0, 0.5]:
+        assert gradcheck(lambda x: quality_focal_loss_fused(x, quality[:40], label[:40], beta, 16),
+                         (pred[:40].clone().requires_grad_(), ))
+    print('fused quality focal loss test passed')
+
+
+def test_distribution_focal_loss():
+    cls_channels, stride = 16, 0.08
+    pred = torch.randn(300, cls_channels, dtype=torch.double) * 3
+    y = torch.rand(300, dtype=torch.double) * (cls_channels - 1) * stride
+    left_idx, left_prob, right_prob = length2bins(y, cls_channels, stride)
+    for norm_prob in [True, False]:
+        ref = DistributionFocalLoss(cls_channels, stride, norm_prob, fused=False)
+        fused = DistributionFocalLoss(cls_channels, stride, norm_prob)
+        ref_loss, ref_grad = loss_and_grad(lambda x, t: ref(x, t, left_idx, avg_factor=4.0), pred, y)
+        loss, grad = loss_and_grad(lambda x, t: fused(x, t, avg_factor=4.0), pred, y)
+        assert torch.allclose(loss, ref_loss, rtol=1e-10) and torch.allclose(grad, ref_grad, atol=1e-12)
+    weight = torch.stack([left_prob, right_prob], dim=1)[:30]
+    assert gradcheck(lambda x: DistributionFocalLossFunction.apply(x, weight, left_idx[:30]),
+                     (pred[:30].clone().requires_grad_(), ))
+
+    # the dense distribution of lengths and its expectation
+    lens = torch.tensor([0.0, 0.05, 0.08, 0.5, 1.2, 2.0])
+    distr, left = length2class(lens, cls_channels, stride)
+    assert torch.allclose(distr.sum(-1), torch.ones(6)) and left.tolist() == [0, 0, 1, 6, 14, 14]
+    assert torch.allclose(class2length(distr, stride), lens.clamp(max=1.2), atol=1e-6)
+    logits = torch.randn(4, 5, cls_channels)
+    assert torch.allclose(class2length(logits, stride, logits=True), class2length(logits.softmax(-1), stride))
+    print('fused distribution focal loss test passed')
+
+
+def fake_boxes(n, dtype=torch.double):
+    '''
+    pred and target [n, 4], most of them overlap, some are disjoint
+    '''
+    target = random_bboxes(n, 50, 50, 5, 45, dtype).t()
+    wh = target[:, 2:] - target[:, :2]
+    pred = target + (torch.randn(n, 4, dtype=dtype) * 0.1).clamp(-0.3, 0.3) * wh.repeat(1, 2)
+    pred[:n // 10] += 100
+    pred[:, 2:] = torch.max(pred[:, 2:], pred[:, :2] + 1)
+    return pred, target
+
+
+# autograd references of DIoU and CIoU on [n, 4]
+def ref_diou_loss(a, b, ciou=False, eps=1e-7):
+    iou = elem_iou(a.t(), b.t())
+    c = torch.max(a[:, 2:], b[:, 2:]) - torch.min(a[:, :2], b[:, :2])
+    d = (a[:, :2] + a[:, 2:] - b[:, :2] - b[:, 2:]) / 2
+    loss = 1 - iou + (d * d).sum(1) / ((c * c).sum(1) + eps)
+    if ciou:
+        wa, wb = a[:, 2:] - a[:, :2], b[:, 2:] - b[:, :2]
+        v = 4 / math.pi ** 2 * (torch.atan(wb[:, 0] / wb[:, 1]) - torch.atan(wa[:, 0] / wa[:, 1])) ** 2
+        alpha = (v / (1 - iou + v + eps)).detach()
+        loss = loss + alpha * v
+    return loss
+
+
+def test_iou_losses():
+    pred, target = fake_boxes(500)
+    weight = torch.rand(500, dtype=torch.double)
+    refs = {'iou': lambda x, t: iou_loss(x.t(), t.t()),
+            'giou': lambda x, t: giou_loss(x.t(), t.t()),
+            'diou': ref_diou_loss,
+            'ciou': lambda x, t: ref_diou_loss(x, t, True)}
+    for mode, ref in refs.items():
+        # iou loss is infinite on disjoint boxes
+        start = 50 if mode == 'iou' else 0
+        x, t, w = pred[start:], target[start:], weight[start:]
+        ref_loss, ref_grad = loss_and_grad(lambda x, t: (ref(x, t) * w).sum(), x, t)
+        loss, grad = loss_and_grad(lambda x, t: (iou_family_loss(x, t, mode) * w).sum(), x, t)
+        assert torch.allclose(loss, ref_loss, rtol=1e-10) and torch.allclose(grad, ref_grad, atol=1e-10), mode
+        # [4, n] boxes as the heads keep them
+        loss, grad = loss_and_grad(lambda x, t: (iou_family_loss(x, t, mode, box_dim=0) * w).sum(), x.t(), t.t())
+        assert torch.allclose(loss, ref_loss, rtol=1e-10) and torch.allclose(grad.t(), ref_grad, atol=1e-10), mode
+        # alpha of ciou is a constant in backward, so only the reference checks its gradient
+        if mode != 'ciou':
+            assert gradcheck(lambda x: iou_family_loss(x, t[:40], mode), (x[:40].clone().requires_grad_(), ))
+
+    # modules keep weight, avg_factor and loss_weight
+    ref_loss, ref_grad = loss_and_grad(lambda x, t: (giou_loss(x, t) * weight).sum() * 2.0 / 7.0, pred.t(), target.t())
+    loss, grad = loss_and_grad(lambda x, t: GIoULoss(loss_weight=2.0)(x, t, weight, 7.0), pred.t(), target.t())
+    assert torch.allclose(loss, ref_loss) and torch.allclose(grad, ref_grad)
+
+    # bounded iou loss on the width and height of guided anchors
+    x, y = torch.rand(2, 300, dtype=torch.double) * 10
+    bounded = BoundedIoULoss(beta=0.2)
+    ref_loss, ref_grad = loss_and_grad(bounded, x, y.clone().requires_grad_())
+    loss, grad = loss_and_grad(bounded, x, y)
+    assert torch.allclose(loss, ref_loss, rtol=1e-10) and torch.allclose(grad, ref_grad, atol=1e-12)
+    assert gradcheck(lambda x: bounded(x, y[:40]), (x[:40].clone().requires_grad_(), ))
+    print('fused iou losses test passed')
+
+
+if __name__ == '__main__':
+    test_focal_loss()
+    test_loss_modules()
+    test_quality_focal_loss()
+    test_distribution_focal_loss()
+    test_iou_losses()
@@ -0,0 +1,191 @@
+import os.path as osp
+import sys
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+from lib.builder import build_module
+from lib import utils
+import copy, mmcv, torch
+import numpy as np
+from pycocotools.coco import COCO
+
+'''
+Models and data shared by tests, test scripts import it with test/ in sys.path.
+'''
+
+
+def build_model(config_file, min_score=0.0):
+    '''
+    A randomly initialized detector of configs/config_file in eval mode, min_score of test_cfg
+    is replaced unless it is None.
+    '''
+    config = mmcv.Config.fromfile(osp.join(cur_dir, '../configs', config_file))
+    model_cfg = copy.deepcopy(config.model)
+    model_cfg.backbone.pretrained = False
+    test_cfg = copy.deepcopy(config.test_cfg)
+    # randomly initialized models have low scores, keep enough of them for nms
+    if min_score is not None and 'rcnn' in test_cfg:
+        test_cfg.rcnn.min_score = min_score
+    elif min_score is not None:
+        test_cfg.min_score = min_score
+    model = build_module(model_cfg, train_cfg=config.train_cfg, test_cfg=test_cfg)
+    model.init_weights()
+    model.eval()
+    return model
+
+
+# classifiers of randomly initialized heads give almost equal scores everywhere, so that tiny
+# numeric differences between runtimes flip nms ties, rescale them to spread logits with std
+def spread_scores(model, img, img_metas, std=2.0, mean=-6.0):
+    classifiers = [m for name, m in model.named_modules() if isinstance(m, (torch.nn.Conv2d, torch.nn.Linear))
+                   and name.split('.')[-1] in ('retina_cls', 'fcos_cls', 'classifier', 'fc_classifier')]
+    inputs = {}
+    def keep_input(m, x, y):
+        inputs.setdefault(m, x[0])
+    hooks = [m.register_forward_hook(keep_input) for m in classifiers]
+    with torch.no_grad():
+        model.forward_test(img, img_metas)
+        for hook in hooks:
+            hook.remove()
+        gen = torch.Generator().manual_seed(0)
+        for m, x in inputs.items():
+            m.weight.copy_(torch.randn(m.weight.shape, generator=gen))
+            m.bias.zero_()
+            y = m(x)
+            m.weight.mul_(std / y.std())
+            m.bias.fill_(mean - y.mean().item() * std / y.std().item())
+    return model
+
+
+# order of bboxes with (almost) equal scores is not defined, compare in a canonical order
+def canonical_order(bbox, score, label):
+    order = np.lexsort(tuple(np.round(bbox, 1)) + (label, -np.round(score, 6)))
+    return bbox[:, order], score[order], label[order]
+
+
+# a tie in nms may be broken the other way by a tiny numeric difference, so instead of requiring
+# the same bboxes in the same order, nearly all bboxes of each side must have a match on the other
+def assert_same_preds(preds, ref_preds, min_match=0.95):
+    for bbox, score, label, ref_bbox, ref_score, ref_label in zip(*preds, *ref_preds):
+        bbox, score, label = [torch.as_tensor(np.asarray(x)) for x in (bbox, score, label)]
+        assert len(score) > 0 and len(ref_score) > 0
+        same = (utils.calc_iou(ref_bbox, bbox) > 0.99) & (ref_label.view(-1, 1) == label.view(1, -1)) \
+               & ((ref_score.view(-1, 1) - score.view(1, -1)).abs() < 1e-4)
+        assert same.any(1).float().mean() >= min_match and same.any(0).float().mean() >= min_match, \
+            (len(score), len(ref_score), same.any(1).float().mean().item(), same.any(0).float().mean().item())
+
+
+# ground truth of a fake COCO dataset, taken from predictions so that AP of them is 1
+def coco_gt_of(preds, img_ids, size):
+    images = [{'id': iid, 'width': size[1], 'height': size[0], 'file_name': ''} for iid in img_ids]
+    annos = []
+    for iid, (bbox, score, label) in zip(img_ids, preds):
+        for b, l in zip(utils.xyxy2xywh(bbox).t().tolist(), label.tolist()):
+            annos.append({'id': len(annos) + 1, 'image_id': iid, 'bbox': b, 'area': b[2] * b[3],
+                          'category_id': l, 'iscrowd': 0})
+    gt = COCO()
+    gt.dataset = {'images': images, 'annotations': annos,
+                  'categories': [{'id': i, 'name': str(i)} for i in range(1, 21)]}
+    gt.createIndex()
+    return gt
+
+
+def random_bboxes(n, img_w, img_h, min_wh, max_wh, dtype=torch.float):
+    '''
+    [4, n] bboxes whose top left corners are uniform in [0, img_w) x [0, img_h)
+    '''
+    xy = torch.rand(2, n, dtype=dtype) * torch.tensor([[img_w], [img_h]], dtype=dtype)
+    return torch.cat([xy, xy + torch.rand(2, n, dtype=dtype) * (max_wh - min_wh) + min_wh])
+
+
+# stands for DataContainer of a collated batch
+class FakeContainer(object):
+    def __init__(self, data):
+        self.data = [data]
+
+
+def fake_img_meta(i, h, w, pad_shape):
+    return {'img_shape': (h, w, 3), 'pad_shape': tuple(pad_shape) + (3, ), 'ori_shape': (h, w, 3),
+            'scale_factor': 1.0, 'flip': False, 'filename': 'imgs/{:06d}.jpg'.format(i + 1)}
+
+
+def fake_dataloader(img_shapes, pad_shape=None, imgs_per_gpu=1):
+    '''
+    Batches of imgs_per_gpu random images of the given shapes. Images are padded to pad_shape,
+    or if it is None, as in mmdet: each image to a multiple of 32 and a batch to its largest.
+    '''
+    batches = []
+    for start in range(0, len(img_shapes), imgs_per_gpu):
+        shapes = img_shapes[start:start+imgs_per_gpu]
+        pad_shapes = [pad_shape or (-(-h // 32) * 32, -(-w // 32) * 32) for h, w in shapes]
+        img_metas = [fake_img_meta(start + i, h, w, pad_shapes[i]) for i, (h, w) in enumerate(shapes)]
+        img = torch.zeros(len(shapes), 3, max(h for h, _ in pad_shapes), max(w for _, w in pad_shapes))
+        for i, (h, w) in enumerate(shapes):
+            img[i, :, :h, :w] = torch.randn(3, h, w)
+        batches.append({'img': FakeContainer(img), 'img_meta': FakeContainer(img_metas)})
+    return batches
+
+
+class ToyDataset(torch.utils.data.Dataset):
+    '''
+    Random images, drawn in __getitem__ as random augmentation would, img_meta keeps the index.
+    '''
+    def __init__(self, num_imgs=12):
+        self.num_imgs = num_imgs
+
+    def __len__(self):
+        return self.num_imgs
+
+    def __getitem__(self, i):
+        return torch.rand(3, 8, 8) + i / self.num_imgs, dict(fake_img_meta(i, 8, 8, (8, 8)), idx=i)
+
+
+# the batch layout of the mmdet dataloader
+def collate_toy(samples):
+    return {'img': FakeContainer(torch.stack([img for img, _ in samples])),
+            'img_meta': FakeContainer([meta for _, meta in samples]),
+            'gt_bboxes': FakeContainer([torch.tensor([[0.0, 0.0, 3.0, 3.0]]) for _ in samples]),
+            'gt_labels': FakeContainer([torch.tensor([1]) for _ in samples])}
+
+
+class ToyDetector(torch.nn.Module):
+    '''
+    A linear model on images with dropout, so that training draws random numbers, it records
+    indices of the images it is trained on, and whether it is in training mode in forward_test.
+    '''
+    def __init__(self):
+        super(ToyDetector, self).__init__()
+        self.fc = torch.nn.Linear(3 * 8 * 8, 4)
+        self.test_cfg = mmcv.ConfigDict()
+        self.seen = []
+        self.test_modes = []
+
+    def init_weights(self):
+        pass
+
+    def forward_train(self, img, gt_bboxes, gt_labels, img_metas):
+        self.seen.extend(meta['idx'] for meta in img_metas)
+        x = torch.nn.functional.dropout(img.flatten(1), 0.5, self.training)
+        return {'loss_toy': (self.fc(x) - torch.cat(gt_bboxes, 1).t()).pow(2).mean()}
+
+    def forward_test(self, img, img_metas):
+        self.test_modes.append(self.training)
+        out = self.fc(img.flatten(1))
+        bboxes = [torch.stack([o[:2], o[:2] + o[2:].abs()]).view(4, 1) for o in out]
+        return bboxes, [torch.ones(1) for _ in out], [torch.ones(1, dtype=torch.long) for _ in out]
+
+
+def toy_trainer(work_dir, model=None, batch_size=2, total_epochs=2, lr_decay={}, eval_cfg=None,
+                eval_dataset=None, **ckpt_cfg):
+    '''
+    A BasicTrainer of ToyDetector on a shuffled ToyDataset, ckpt_cfg overrides ckpt writing.
+    '''
+    from lib.trainer.trainer import BasicTrainer
+    dataloader = torch.utils.data.DataLoader(ToyDataset(), batch_size, shuffle=True, collate_fn=collate_toy)
+    ckpt_cfg = mmcv.ConfigDict(dict(dict(interval=1, async_write=False), **ckpt_cfg))
+    return BasicTrainer(dataloader, work_dir, model if model is not None else ToyDetector(),
+                        train_cfg=mmcv.ConfigDict(total_epochs=total_epochs),
+                        optimizer_cfg=mmcv.ConfigDict(type='SGD', lr=0.01, momentum=0.9),
+                        optim_cfg=mmcv.ConfigDict(grad_clip=None),
+                        lr_cfg=mmcv.ConfigDict(warmup_iters=3, warmup_ratio=0.1, lr_decay=lr_decay),
+                        ckpt_cfg=ckpt_cfg, report_cfg=mmcv.ConfigDict(interval=2),
+                        eval_cfg=eval_cfg, eval_dataset=eval_dataset)
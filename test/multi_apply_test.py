@@ -3,6 +3,7 @@ import os.path as osp
 cur_dir = osp.dirname(osp.realpath(__file__))
 sys.path.append(osp.join(cur_dir, '..'))
 from lib import utils
+import torch
 
 def func(a, b, c):
     return a, b, c
@@ -21,8 +22,41 @@ def test():
     unpack_res = utils.unpack_multi_result(result)
     print('unpacked result')
     print(unpack_res)
-    
+
+
+# picklable for the process backend
+def scaled_sum(x, scale):
+    return (x * scale).sum(), x.shape[0]
+
+def nested(x, scale):
+    return utils.multi_apply(scaled_sum, [x, x], scale)[0]
+
+def test_backends():
+    xs = [torch.randn(1000 * (i + 1), 64) for i in range(5)]
+    ref = utils.multi_apply(scaled_sum, xs, 2.0)
+    for backend in utils.MULTI_APPLY_BACKENDS:
+        utils.set_multi_apply(backend, num_workers=3, intra_op_threads=1)
+        with torch.no_grad():
+            res = utils.multi_apply(scaled_sum, xs, 2.0)
+            assert [r[1] for r in res] == [r[1] for r in ref]
+            assert all(torch.allclose(r[0], f[0]) for r, f in zip(res, ref))
+        # grad mode of the caller holds in workers, process falls back to serial with grad
+        ws = [x.clone().requires_grad_() for x in xs]
+        utils.sum_list([r[0] for r in utils.multi_apply(scaled_sum, ws, 2.0)]).backward()
+        assert all(torch.equal(w.grad, torch.full_like(w, 2.0)) for w in ws)
+        with torch.no_grad():
+            assert not any(r[0].requires_grad for r in utils.multi_apply(scaled_sum, ws, 2.0))
+        # calls in workers run serially
+        assert [r[1] for r in utils.multi_apply(nested, xs, 2.0)] == [r[1] for r in ref]
+        print('{} backend test passed'.format(backend))
+    utils.set_multi_apply('serial')
+    try:
+        utils.set_multi_apply('gpu')
+        assert False
+    except ValueError:
+        pass
 
 
 if __name__ == '__main__':
     test()
+    test_backends()
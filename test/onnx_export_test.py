@@ -0,0 +1,53 @@
+import sys, os, tempfile
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+sys.path.append(cur_dir)
+from lib.export import export_graphs, export_onnx, torch_runner
+from lib.onnx_post import PostProcessor, OnnxDetector
+from helpers import build_model, spread_scores, assert_same_preds
+import torch
+import numpy as np
+
+torch.manual_seed(2020)
+
+CONFIGS = ['retinanet_r50_fpn.py', 'fcos_r50_fpn.py', 'fcos_r50_fpn_atss_gfl.py',
+           'cascade_rcnn_r50_fpn.py', 'dh_rcnn_r50_fpn.py', 'libra_faster_rcnn_r50_fpn.py']
+# BFP pools to input dependent sizes, only the post-processor is tested
+UNSUPPORTED = ['libra_faster_rcnn_r50_fpn.py']
+
+
+def test_export(config_file, img_size=(320, 448)):
+    # min_score of the config keeps nms away from the bulk of low scores
+    model = build_model(config_file, min_score=None)
+    img = torch.randn(1, 3, *img_size)
+    img_metas = [{'img_shape': img_size + (3, ), 'pad_shape': img_size + (3, ), 'ori_shape': img_size + (3, ),
+                  'scale_factor': 1.0, 'flip': False}]
+    spread_scores(model, img, img_metas)
+    with torch.no_grad():
+        ref_preds = model.forward_test(img, img_metas)
+
+    # graphs are exported at another input size, outputs must not depend on it
+    graphs, meta = export_graphs(model, img_size=(256, 320))
+    preds = PostProcessor(meta, torch_runner(graphs)).forward_test(img.numpy(), img_metas)
+    assert_same_preds(preds, ref_preds)
+
+    # onnxruntime is required, graphs as exported may differ from the torch modules, e.g. in inputs
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prefix = osp.join(tmp_dir, osp.splitext(config_file)[0])
+        if config_file in UNSUPPORTED:
+            try:
+                export_onnx(model, prefix, img_size=(256, 320))
+            except ValueError:
+                print('{}: post-processor test passed, onnx export is rejected'.format(config_file))
+                return
+            raise AssertionError('{} is exported'.format(config_file))
+        export_onnx(model, prefix, img_size=(256, 320))
+        preds = OnnxDetector(prefix + '.json').forward_test(img.numpy(), img_metas)
+        assert_same_preds(preds, ref_preds)
+    print('{}: onnx export test passed'.format(config_file))
+
+
+if __name__ == '__main__':
+    for config_file in CONFIGS:
+        test_export(config_file)
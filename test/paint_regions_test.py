@@ -0,0 +1,72 @@
+import sys, time
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+sys.path.append(cur_dir)
+from lib.region import paint_regions
+from lib.heads.fcos_head import paint_image_area, make_level_blanks
+from helpers import random_bboxes
+import torch
+
+torch.manual_seed(2020)
+
+STRIDES = [4, 8, 16, 32, 64]
+
+
+# the per box painting the heads used to do
+def paint_value(canvas, bbox, scale, val):
+    bbox = bbox * scale
+    bbox = bbox.round().long()
+    canvas[..., bbox[1]:bbox[3]+1, bbox[0]:bbox[2]+1] = val.view(-1, 1, 1) if canvas.dim() == 3 else val
+    return canvas
+
+
+def blank_maps(c, img_w=800, img_h=600):
+    shape = lambda s: ([c] if c > 0 else []) + [(img_h + s - 1) // s, (img_w + s - 1) // s]
+    return [torch.full(shape(s), -1.0) for s in STRIDES]
+
+
+def test_parity(n, c, with_priority):
+    bboxes = random_bboxes(n, 800, 600, 2, 302)
+    levels = torch.randint(0, len(STRIDES), (n, ))
+    values = torch.randn(c, n) if c > 0 else torch.randint(0, 3, (n, )).float()
+    priority = torch.randint(0, 3, (n, )) if with_priority else torch.zeros(n, dtype=torch.long)
+    scales = [1.0 / s for s in STRIDES]
+
+    ref = blank_maps(c)
+    start = time.time()
+    # lower priority first, the order of boxes is kept within a priority
+    for i in torch.sort(priority, stable=True)[1].tolist():
+        paint_value(ref[levels[i]], bboxes[:, i], scales[levels[i]], values[..., i])
+    ref_time = time.time() - start
+    for chunk_size in [1, 7, 32]:
+        cur = blank_maps(c)
+        start = time.time()
+        paint_regions(cur, bboxes, levels, values, scales, priority if with_priority else None, chunk_size)
+        cur_time = time.time() - start
+        assert all(torch.equal(r, m) for r, m in zip(ref, cur))
+    print('parity test passed with {} boxes of {} channels, per box {:.4f}s, batched {:.4f}s'.format(
+        n, max(c, 1), ref_time, cur_time))
+
+
+def test_image_area():
+    grids = [(150, 200), (75, 100), (38, 50), (19, 25), (10, 13)]
+    scales = [1.0 / s for s in STRIDES]
+    ref = make_level_blanks(grids, 1, -1, torch.long, 'cpu')
+    for i in range(len(grids)):
+        # fcos targets are [h, w, 1]
+        paint_value(ref[i][..., 0], torch.tensor([0, 0, 500.0, 333.0]), scales[i], 0)
+    cur = paint_image_area(make_level_blanks(grids, 1, -1, torch.long, 'cpu'), 500, 333, scales)
+    assert all(torch.equal(r, m) for r, m in zip(ref, cur))
+    # nothing to paint
+    assert all((m == -1).all() for m in paint_regions(blank_maps(0), torch.zeros(4, 0), torch.zeros(0).long(),
+                                                      torch.zeros(0), scales))
+    print('image area test passed')
+
+
+if __name__ == '__main__':
+    test_image_area()
+    test_parity(10, 0, False)
+    test_parity(100, 4, False)
+    test_parity(100, 0, True)
+    test_parity(300, 4, True)
@@ -0,0 +1,92 @@
+import sys
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+sys.path.append(cur_dir)
+from lib.quantize import quantize_int8, svd_linear, compress_fcs
+from helpers import build_model, fake_dataloader
+import torch
+import torch.ao.nn.quantized as nnq
+
+torch.manual_seed(2020)
+
+
+# relative error of outputs, centered so that a large constant part does not hide errors
+def rel_error(out, ref):
+    return ((out - ref).norm() / (ref - ref.mean()).norm()).item()
+
+def head_outputs(model, img):
+    with torch.no_grad():
+        feats = model.extract_feat(img)
+        outs = [out for outs in model.bbox_head(feats) if outs is not None for out in outs]
+    return list(feats) + outs
+
+
+def test_quantize_int8(config_file, skip):
+    model = build_model(config_file)
+    # convs of heads are initialized with std 0.01, outputs of their towers would be almost 0
+    for m in model.bbox_head.modules():
+        if isinstance(m, torch.nn.Conv2d):
+            m.reset_parameters()
+    dataloader = fake_dataloader([(128, 160), (96, 160), (128, 128)], (128, 160))
+    img = dataloader[-1]['img'].data[0]
+    ref = head_outputs(model, img)
+
+    units = quantize_int8(model, dataloader, num_imgs=2, skip=[skip])
+    assert {'backbone.conv1', 'backbone.layer1', 'backbone.layer4', 'neck.fpn_convs.0',
+            'bbox_head.cls_convs', 'bbox_head.reg_convs'} <= set(units)
+    for name in units:
+        assert any(isinstance(m, nnq.Conv2d) for m in model.get_submodule(name).modules()), name
+    assert skip not in units and type(model.get_submodule(skip)) is torch.nn.Conv2d
+    assert model.get_submodule(skip).weight.dtype == torch.float32
+
+    errors = [rel_error(out, r) for out, r in zip(head_outputs(model, img), ref)]
+    assert max(errors) < 0.15, errors
+    print('{}: int8 test passed, {} units, max relative error {:.4f}'.format(config_file, len(units), max(errors)))
+
+
+def test_svd_linear():
+    fc = torch.nn.Linear(256, 64)
+    x = torch.randn(10, 256)
+    with torch.no_grad():
+        assert torch.allclose(svd_linear(fc, 64)(x), fc(x), atol=1e-5)
+        low = svd_linear(fc, 16)
+    assert sum(p.numel() for p in low.parameters()) == 16 * (256 + 64) + 64
+    print('svd_linear test passed')
+
+
+def test_compress_fcs(config_file='cascade_rcnn_r50_fpn.py'):
+    model = build_model(config_file)
+    rois = [torch.randn(50, 256, 7, 7), torch.randn(30, 256, 7, 7)]
+    with torch.no_grad():
+        refs = [head(rois) for head in model.rcnn_head]
+    compressed = compress_fcs(model, dynamic_int8=True)
+    assert compressed['rcnn_head.2.shared_fcs.0'] == ['int8'] and compressed['rcnn_head.2.classifier'] == ['int8']
+    with torch.no_grad():
+        for head, ref in zip(model.rcnn_head, refs):
+            assert any(isinstance(m, torch.ao.nn.quantized.dynamic.Linear) for m in head.modules())
+            for outs, ref_outs in zip(head(rois), ref):
+                errors = [rel_error(out, r) for out, r in zip(outs, ref_outs)]
+                assert max(errors) < 0.15, errors
+
+    # weights are random, i.e. of full rank, so only which layers are factorized is checked
+    model = build_model(config_file)
+    compressed = compress_fcs(model, svd_rank=256)
+    # classifier and regressor are too narrow to save compute with rank 256
+    assert 'rcnn_head.0.shared_fcs.0' in compressed and 'rcnn_head.0.classifier' not in compressed
+    assert model.rcnn_head[0].shared_fcs[0][0].out_features == 256
+
+    # each layer is reported once with all of its transforms
+    model = build_model(config_file)
+    compressed = compress_fcs(model, svd_rank=256, dynamic_int8=True)
+    assert compressed['rcnn_head.0.shared_fcs.0'] == ['svd', 'int8']
+    assert compressed['rcnn_head.0.classifier'] == ['int8']
+    assert 'rcnn_head.0.shared_fcs' not in compressed
+    print('{}: compress fcs test passed'.format(config_file))
+
+
+if __name__ == '__main__':
+    test_svd_linear()
+    test_compress_fcs()
+    test_quantize_int8('retinanet_r50_fpn.py', 'bbox_head.retina_cls')
+    test_quantize_int8('fcos_r50_fpn.py', 'bbox_head.fcos_cls')
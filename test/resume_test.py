@@ -0,0 +1,79 @@
+import sys, tempfile, random
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+sys.path.append(cur_dir)
+from lib.trainer.hooks import Hook
+from helpers import toy_trainer
+import torch
+import numpy as np
+
+
+def seed_all(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+class CountEpochHook(Hook):
+    def __init__(self, priority=2):
+        super(CountEpochHook, self).__init__(priority)
+        self.started = []
+
+    def before_epoch(self):
+        self.started.append(self.trainer.cur_epoch)
+
+
+# interrupts training after stop_iters iterations, CkptHook has a higher priority and saves first
+class StopHook(Hook):
+    def __init__(self, stop_iters, priority=2):
+        super(StopHook, self).__init__(priority)
+        self.stop_iters = stop_iters
+
+    def after_step(self):
+        if self.trainer.finished_iters == self.stop_iters:
+            raise KeyboardInterrupt
+
+
+def run(work_dir, stop_iters=None, resume_from=None):
+    trainer = toy_trainer(work_dir, total_epochs=3, lr_decay={2: 0.1}, state_interval=1, state_max_keep=100)
+    hooks = [CountEpochHook()] + ([StopHook(stop_iters)] if stop_iters is not None else [])
+    for hook in hooks:
+        hook.trainer = trainer
+        trainer.add_hook(hook)
+    if resume_from is not None:
+        trainer.resume(resume_from)
+    try:
+        trainer.train()
+    except SystemExit:
+        assert stop_iters is not None
+    return trainer, hooks[0].started
+
+
+# 6 iterations per epoch, stopping at 8 is in the middle of epoch 2, where lr decays
+def test_resume(stop_iters=8):
+    seed_all(2020)
+    trainer, started = run(tempfile.mkdtemp())
+    params = [p.detach().clone() for p in trainer.model.parameters()]
+    assert all(torch.isfinite(p).all() for p in params)
+
+    work_dir = tempfile.mkdtemp()
+    seed_all(2020)
+    stopped, stopped_started = run(work_dir, stop_iters)
+    assert stopped.finished_iters == stop_iters
+    # another seed, random states must come from the ckpt
+    seed_all(1)
+    resumed, resumed_started = run(work_dir, resume_from=osp.join(work_dir, 'state_iter_{}.pth'.format(stop_iters)))
+
+    assert stopped.model.seen + resumed.model.seen == trainer.model.seen
+    assert len(resumed.model.seen) == len(trainer.model.seen) - stop_iters * 2
+    # before_epoch, which decays lr, is not called again for the resumed epoch
+    assert started == [1, 2, 3] and stopped_started == [1, 2] and resumed_started == [3]
+    assert resumed.get_lr() == trainer.get_lr()
+    for p, ref in zip(resumed.model.parameters(), params):
+        assert torch.equal(p.detach(), ref)
+    print('resume test passed, resumed at iteration {}'.format(stop_iters))
+
+
+if __name__ == '__main__':
+    test_resume()
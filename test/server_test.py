@@ -0,0 +1,77 @@
+import sys, io, json, asyncio, tempfile
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+sys.path.append(cur_dir)
+from lib.server import InferenceServer, Client
+from lib.tester import BasicTester
+from lib import utils
+from helpers import build_model
+import torch
+import numpy as np
+
+torch.manual_seed(2020)
+
+
+# requests carry images as .npy bytes of already normalized [3, H, W] arrays, padded to 32
+def npy_preprocess(body):
+    img = torch.from_numpy(np.load(io.BytesIO(body)))
+    h, w = img.shape[1:]
+    pad_h, pad_w = (h + 31) // 32 * 32, (w + 31) // 32 * 32
+    img = torch.nn.functional.pad(img, (0, pad_w - w, 0, pad_h - h))
+    img_meta = {'img_shape': (h, w, 3), 'pad_shape': (pad_h, pad_w, 3), 'ori_shape': (h, w, 3),
+                'scale_factor': 1.0, 'flip': False}
+    return img, img_meta
+
+def npy_bytes(img):
+    buf = io.BytesIO()
+    np.save(buf, img.numpy())
+    return buf.getvalue()
+
+
+def test_server(config_file='retinanet_r50_fpn.py', max_batch=4):
+    model = build_model(config_file)
+    tester = BasicTester(model, model.train_cfg, model.test_cfg, torch.device('cpu'))
+    imgs = [torch.randn(3, 160, 224), torch.randn(3, 150, 200), torch.randn(3, 96, 128)]
+    refs = []
+    for img in imgs:
+        img_data, img_meta = npy_preprocess(npy_bytes(img))
+        with torch.no_grad():
+            bboxes, scores, _ = model.forward_test(img_data[None], [img_meta])
+        refs.append((utils.xyxy2xywh(bboxes[0]).t(), scores[0]))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ckpt = osp.join(tmp_dir, 'model.pth')
+        torch.save(model.state_dict(), ckpt)
+
+        async def run():
+            server = InferenceServer(tester, preprocess=npy_preprocess, max_batch=max_batch, max_wait_ms=200)
+            await server.start(port=0)
+            clients = [Client(port=server.port) for _ in range(8)]
+            bodies = [npy_bytes(imgs[i % len(imgs)]) for i in range(len(clients))]
+            # a reload in the middle of requests must not fail any of them
+            results = await asyncio.gather(
+                *[c.request('POST', '/predict', b) for c, b in zip(clients, bodies)],
+                Client(port=server.port).request('POST', '/reload', json.dumps({'ckpt': ckpt}).encode()))
+            bad = await clients[0].request('POST', '/reload', b'{}')
+            _, stats = await clients[0].request('GET', '/stats')
+            for c in clients:
+                c.close()
+            await server.stop()
+            return results, bad, stats
+
+        results, bad, stats = asyncio.run(run())
+    assert results[-1][0] == 200 and bad[0] == 400
+    for i, (status, res) in enumerate(results[:-1]):
+        assert status == 200, res
+        ref_bbox, ref_score = refs[i % len(imgs)]
+        assert np.allclose(np.array(res['bbox']).reshape(-1, 4), ref_bbox.numpy(), atol=0.02)
+        assert np.allclose(res['score'], ref_score.numpy(), atol=1e-3)
+    # 8 requests of 3 sizes, images of the same size are batched
+    assert stats['served'] == 8 and stats['reloads'] == 1 and stats['batches'] < 8, stats
+    assert max(int(k) for k in stats['batch_sizes']) <= max_batch
+    print('inference server test passed, batch sizes: {}'.format(stats['batch_sizes']))
+
+
+if __name__ == '__main__':
+    test_server()
@@ -0,0 +1,62 @@
+import sys
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+sys.path.append(cur_dir)
+from lib.static import StaticDetector
+from helpers import build_model, spread_scores, assert_same_preds, fake_img_meta
+import torch, math
+
+torch.manual_seed(2020)
+
+CONFIGS = ['retinanet_r50_fpn.py', 'fcos_r50_fpn.py', 'fcos_r50_fpn_atss_gfl.py']
+PAD_SHAPE = (192, 256)
+
+
+def make_input(img_shapes):
+    img = torch.zeros(len(img_shapes), 3, *PAD_SHAPE)
+    for i, (h, w) in enumerate(img_shapes):
+        img[i, :, :h, :w] = torch.randn(3, h, w)
+    return img, [fake_img_meta(i, h, w, PAD_SHAPE) for i, (h, w) in enumerate(img_shapes)]
+
+
+def test_static(config_file, modes):
+    model = build_model(config_file, min_score=None)
+    img, img_metas = make_input([(192, 256), (160, 200)])
+    spread_scores(model, img, img_metas)
+    with torch.no_grad():
+        ref_preds = model.forward_test(img, img_metas)
+    for mode in modes:
+        static = StaticDetector(model, mode)
+        assert_same_preds(static.forward_test(img, img_metas), ref_preds)
+        # a second input shape, traced graphs are kept per shape
+        assert_same_preds(static.forward_test(img[:1, :, :160], img_metas[:1]),
+                          model.forward_test(img[:1, :, :160], img_metas[:1]))
+    print('{}: static inference test passed in {} modes'.format(config_file, ', '.join(modes)))
+
+
+# small bboxes are masked out before topk in predict_dense, instead of removed as in forward_test
+def test_small_bboxes(config_file='fcos_r50_fpn.py'):
+    model = build_model(config_file, min_score=None)
+    img, img_metas = make_input([(192, 256), (160, 200)])
+    spread_scores(model, img, img_metas)
+    # ltrb of about 40 everywhere, bboxes clamped at borders of images are small
+    with torch.no_grad():
+        model.bbox_head.fcos_reg.bias.fill_(math.log(40.0 / model.bbox_head.reg_std))
+    model.test_cfg.min_bbox_size = 64
+    model.test_cfg.pre_nms = 20
+    with torch.no_grad():
+        bboxes, scores, ctr_scores, valid = model.forward_dense(
+            img, torch.tensor([[192, 256], [160, 200]]), torch.tensor([1.0, 1.0]))
+        ref_preds = model.forward_test(img, img_metas)
+    w, h = bboxes[:, 2] - bboxes[:, 0] + 1, bboxes[:, 3] - bboxes[:, 1] + 1
+    assert (~valid).any() and ((w > 64) & (h > 64))[valid].all()
+    assert_same_preds(model.forward_post((bboxes, scores, ctr_scores, valid), img_metas), ref_preds)
+    print('{}: small bboxes test passed, {} of {} candidates valid'.format(
+        config_file, valid.sum().item(), valid.numel()))
+
+
+if __name__ == '__main__':
+    test_small_bboxes()
+    for config_file in CONFIGS:
+        test_static(config_file, ['eager', 'trace', 'compile'])
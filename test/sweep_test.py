@@ -0,0 +1,66 @@
+import sys, copy, tempfile
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+sys.path.append(cur_dir)
+from lib.sweep import Candidates, collect_candidates, sweep
+from helpers import build_model, canonical_order, fake_dataloader, coco_gt_of
+import torch
+import numpy as np
+
+torch.manual_seed(2020)
+
+CONFIGS = ['retinanet_r50_fpn.py', 'fcos_r50_fpn.py', 'cascade_rcnn_r50_fpn.py']
+
+
+class FakeDataloader(list):
+    @property
+    def dataset(self):
+        return self
+
+
+def forward_test(model, data, setting):
+    model = copy.copy(model)
+    model.test_cfg = copy.deepcopy(model.test_cfg)
+    test_cfg = model.test_cfg.rcnn if 'rcnn' in model.test_cfg else model.test_cfg
+    for k, v in setting.items():
+        if v is not None:
+            test_cfg[k] = v
+    with torch.no_grad():
+        return model.forward_test(data['img'].data[0], data['img_meta'].data[0])
+
+
+def test_sweep(config_file):
+    model = build_model(config_file)
+    rcnn = 'rcnn' in model.test_cfg
+    dataloader = FakeDataloader(fake_dataloader([(192, 256), (160, 224)], (192, 256)))
+    settings = [dict(pre_nms=None if rcnn else pre_nms, min_score=min_score, nms_iou=nms_iou,
+                     max_per_img=50, nms_type=nms_type)
+                for pre_nms, min_score, nms_iou, nms_type in
+                [(1000, 0.0, 0.5, 'official'), (200, 0.01, 0.6, 'strict'), (50, 0.05, 0.4, 'official')]]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cand_file = osp.join(tmp_dir, 'cands')
+        collect_candidates(model, dataloader, cand_file, None if rcnn else 1000, 0.0, 'cpu', fp16=False)
+        cands = Candidates(cand_file)
+        assert cands.img_ids.tolist() == [1, 2]
+        # post-processing of each setting is the same as forward_test with it
+        for setting in settings:
+            for i, data in enumerate(dataloader):
+                ref_bbox, ref_score, ref_label = [x[0].numpy() for x in forward_test(model, data, setting)]
+                bbox, score, label = [x.numpy() for x in cands.post_process(i, setting)]
+                assert bbox.shape == ref_bbox.shape, (setting, bbox.shape, ref_bbox.shape)
+                bbox, score, label = canonical_order(bbox, score, label)
+                ref_bbox, ref_score, ref_label = canonical_order(ref_bbox, ref_score, ref_label)
+                assert np.allclose(bbox, ref_bbox, atol=1e-3) and np.allclose(score, ref_score, atol=1e-5)
+                assert (label == ref_label).all()
+
+        ref_preds = [[x[0] for x in forward_test(model, data, settings[1])] for data in dataloader]
+        results = sweep(cand_file, coco_gt_of(ref_preds, [1, 2], (192, 256)), settings, num_workers=2)
+    assert [r[0] for r in results] == settings
+    assert results[1][2] > 0.99, results[1]
+    print('{}: sweep test passed, mAP: {}'.format(config_file, ', '.join('{:.3f}'.format(r[1]) for r in results)))
+
+
+if __name__ == '__main__':
+    for config_file in CONFIGS:
+        test_sweep(config_file)
@@ -0,0 +1,87 @@
+import sys
+import os.path as osp
+cur_dir = osp.dirname(osp.realpath(__file__))
+sys.path.append(osp.join(cur_dir, '..'))
+sys.path.append(cur_dir)
+from lib.tta import TTADetector, unaug_bboxes, box_voting
+from helpers import build_model, canonical_order
+import torch
+import numpy as np
+
+torch.manual_seed(2020)
+
+CONFIGS = ['retinanet_r50_fpn.py', 'fcos_r50_fpn.py', 'cascade_rcnn_r50_fpn.py']
+
+
+def make_input(img_shapes, pad_shape):
+    img = torch.zeros(len(img_shapes), 3, *pad_shape)
+    img_metas = []
+    for i, (h, w) in enumerate(img_shapes):
+        img[i, :, :h, :w] = torch.randn(3, h, w)
+        img_metas.append({'img_shape': (h, w, 3), 'pad_shape': pad_shape + (3, ), 'ori_shape': (h, w, 3),
+                          'scale_factor': 1.0, 'flip': False, 'filename': '{:06d}.jpg'.format(i)})
+    return img, img_metas
+
+
+def test_unaug_bboxes():
+    bbox = torch.tensor([[10.0, 20.0, 59.0, 99.0], [0.0, 0.0, 199.0, 99.0]]).t()
+    img_w = torch.tensor([200.0, 200.0])
+    for flip in [False, True]:
+        flip = torch.tensor([flip, flip])
+        aug = bbox * 1.5
+        if flip.all():
+            aug = torch.stack([299 - aug[2], aug[1], 299 - aug[0], aug[3]])
+        back = unaug_bboxes(aug, img_w * 1.5, 1.5, 1.5, flip)
+        assert torch.allclose(back, bbox, atol=1e-4), (back, bbox)
+    print('unaug_bboxes test passed')
+
+
+def test_box_voting():
+    keep_bbox = torch.tensor([[0.0, 0.0, 9.0, 9.0]]).t()
+    bbox = torch.tensor([[0.0, 0.0, 9.0, 9.0], [2.0, 2.0, 11.0, 11.0], [50.0, 50.0, 59.0, 59.0]]).t()
+    score = torch.tensor([[0.6, 0.2, 0.9], [0.1, 0.9, 0.1]])
+    voted = box_voting(keep_bbox, torch.tensor([0]), bbox, score, 0, 0.4)
+    assert torch.allclose(voted, torch.tensor([[0.5, 0.5, 9.5, 9.5]]).t()), voted
+    print('box_voting test passed')
+
+
+# TTA of a single scale without flip is the same as forward_test
+def test_identity(config_file):
+    model = build_model(config_file)
+    img, img_metas = make_input([(192, 256), (160, 224)], (192, 256))
+    with torch.no_grad():
+        ref_preds = model.forward_test(img, img_metas)
+    preds = TTADetector(model, scales=(1.0, ), flip=False).forward_test(img, img_metas)
+    for bbox, score, label, ref_bbox, ref_score, ref_label in zip(*preds, *ref_preds):
+        assert bbox.shape == ref_bbox.shape, (bbox.shape, ref_bbox.shape)
+        bbox, score, label = canonical_order(bbox.numpy(), score.numpy(), label.numpy())
+        ref_bbox, ref_score, ref_label = canonical_order(ref_bbox.numpy(), ref_score.numpy(), ref_label.numpy())
+        assert np.allclose(bbox, ref_bbox, atol=1e-3)
+        assert np.allclose(score, ref_score, atol=1e-5)
+        assert (label == ref_label).all()
+    print('{}: TTA identity test passed'.format(config_file))
+
+
+# augmentations are batched into as few forwards as the padding allows
+def test_batching(config_file):
+    model = build_model(config_file)
+    batch_sizes = []
+    model.backbone.register_forward_pre_hook(lambda m, args: batch_sizes.append(args[0].shape[0]))
+    img, img_metas = make_input([(192, 256)], (192, 256))
+    for merge, max_pad_ratio, expected in [('nms', 0.0, [2, 2]), ('vote', 0.6, [4])]:
+        batch_sizes.clear()
+        tta = TTADetector(model, scales=(0.75, 1.0), flip=True, merge=merge, max_pad_ratio=max_pad_ratio)
+        bboxes, scores, labels = tta.forward_test(img, img_metas)
+        assert batch_sizes == expected, batch_sizes
+        bbox = bboxes[0]
+        assert bbox.shape[1] == scores[0].numel() == labels[0].numel() > 0
+        assert (bbox[0] >= 0).all() and (bbox[1] >= 0).all() and (bbox[2] <= 255).all() and (bbox[3] <= 191).all()
+    print('{}: TTA batching test passed'.format(config_file))
+
+
+if __name__ == '__main__':
+    test_unaug_bboxes()
+    test_box_voting()
+    for config_file in CONFIGS:
+        test_identity(config_file)
+        test_batching(config_file)
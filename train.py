@@ -6,6 +6,8 @@ parser.add_argument('--gpu', help='GPU cardinal, only support single GPU at mome
 parser.add_argument('--debug', action='store_true',
                     help='Output debug log into a file in work_dir.')
 parser.add_argument('--seed', help='Random seed.')
+parser.add_argument('--resume', help='Resume training from a ckpt saved by CkptHook, '
+                    'either a trainer state(state_iter_*.pth) or an epoch ckpt(epoch_*.pth).')
 
 args = parser.parse_args()
 
@@ -14,6 +16,7 @@ import os.path as osp
 import mmcv, torch, numpy as np
 from lib import datasets
 from lib.trainer import BasicTrainer
+from lib.utils import set_multi_apply
 import torch
 
 LOG_LEVEL = {'DEBUG': logging.DEBUG, 'INFO': logging.INFO, 'WARNING': logging.WARNING}
@@ -119,13 +122,26 @@ def main():
                                            1, dist=False,
                                            shuffle=config.data.train.loader.shuffle)
     
+    # a subset of test images is evaluated during training if eval_config is set
+    eval_cfg, eval_dataset = config.get('eval_config', None), None
+    if eval_cfg is not None:
+        eval_dataset = datasets.VOCDataset(
+            ann_file=config.data.test.ann_file,
+            img_prefix=config.data.test.img_prefix,
+            pipeline=config.data.test.pipeline
+        )
+
     train_cfg = config.train_cfg
     train_cfg.dataloader = dataloader
     train_cfg.work_dir = args.work_dir
     test_cfg = config.test_cfg
 
+    set_multi_apply(**config.get('multi_apply', {}))
     from lib.builder import build_module
     model = build_module(config.model, train_cfg=train_cfg, test_cfg=test_cfg)
+    if config.data.train.loader.get('dense_targets', False):
+        from lib import dense_targets
+        dense_targets.install(dataloader, model, train_cfg)
 
     trainer = BasicTrainer(
         dataloader,
@@ -138,7 +154,10 @@ def main():
         config.ckpt_config,
         config.report_config,
         None,
-        device=device
+        device=device,
+        channels_last=config.get('channels_last', False),
+        eval_cfg=eval_cfg,
+        eval_dataset=eval_dataset
     )
     
     # do not start to log until logging.basicConfig is set
@@ -146,9 +165,12 @@ def main():
     logging.info('Config: {}'.format(args.config_file))
     logging.info('Seed: {}'.format(args.seed))
     logging.info('GPU: {}'.format(args.gpu))
+    logging.info('Resume: {}'.format(args.resume))
     logging.info('Configuration details: {}'.format(config))
     
     trainer.init_detector()    
+    if args.resume is not None:
+        trainer.resume(args.resume)
     trainer.train()
     
 if __name__ == '__main__':